@@ -0,0 +1,98 @@
+import time
+
+import jax.numpy as jnp
+import jax.scipy as jsp
+import numpy as np
+from jax import jit, lax, vmap
+from jax.config import config
+
+from l2ws.algo_steps import get_osqp_factor, k_steps_train_osqp
+
+config.update("jax_enable_x64", True)
+
+
+def main():
+    """
+    benchmark of the vmapped osqp iterations with a static factor (k_steps_train_osqp, as in
+        the static-factor path of the models) against a batch-major kernel that keeps the batch
+        as a (d, B) matrix, so that each linear solve is one multi-right-hand-side lu_solve
+        and each matvec is one matrix-matrix product
+
+    the factor is not batched, so vmap already lowers the solves to triangular solves over
+        the batch and the matvecs to matrix-matrix products (see test_static_factor_batch_major
+        in tests/test_l2ws_model.py) and we report the times and the differences of the
+        outputs of the two
+    """
+    n, m, k, num_runs = 200, 150, 200, 3
+    sigma = 1
+    np.random.seed(0)
+    P_half = np.random.normal(size=(n, n))
+    P = jnp.array(P_half @ P_half.T / n)
+    A = jnp.array(np.random.normal(size=(m, n)))
+    rho = jnp.ones(m)
+    factor = get_osqp_factor(P, A, rho, sigma)
+
+    for batch_size in [100, 1000]:
+        c_mat = np.random.normal(size=(batch_size, n))
+        q_mat = jnp.array(np.hstack([c_mat, -np.ones((batch_size, m)),
+                                     np.ones((batch_size, m))]))
+        z0_mat = jnp.zeros((batch_size, n + m))
+
+        def train_osqp(z0, q):
+            return k_steps_train_osqp(k, z0, q, factor, A, rho, sigma, False, None, True)
+        vmap_fn = jit(vmap(train_osqp))
+        batch_major_fn = jit(lambda z0_mat, q_mat: batch_major_osqp(k, z0_mat.T, q_mat.T,
+                                                                      factor, A, rho, sigma))
+
+        vmap_time, (z_final, losses) = time_fn(vmap_fn, (z0_mat, q_mat), num_runs)
+        batch_major_time, (z_final_bm, losses_bm) = time_fn(batch_major_fn, (z0_mat, q_mat),
+                                                            num_runs)
+        print(f"osqp: n = {n}, m = {m}, {batch_size} problems, {k} iterations")
+        print(f"    vmap:        {vmap_time:.3f} s")
+        print(f"    batch-major: {batch_major_time:.3f} s")
+        print(f"    max difference of the final iterates: "
+              f"{jnp.abs(z_final - z_final_bm.T).max():.2e}")
+        print(f"    max difference of the losses: {jnp.abs(losses - losses_bm.T).max():.2e}")
+
+
+def batch_major_osqp(k, z0_mat, q_mat, factor, A, rho, sigma):
+    """
+    k osqp iterations (see fixed_point_osqp) of the columns of z0_mat with the problem data
+        in the columns of q_mat, z0_mat is warm-started with w = A x as in init_osqp
+    returns the final iterates and the (k, B) fixed point residuals
+    """
+    m, n = A.shape
+    z0_mat = jnp.concatenate([z0_mat[:n + m], A @ z0_mat[:n]])
+    c, l_bound, u_bound = q_mat[:n], q_mat[n:n + m], q_mat[n + m:]
+    rho = rho[:, None]
+
+    def step(z, _):
+        x, y, w = z[:n], z[n:n + m], z[n + m:]
+        x_next = jsp.linalg.lu_solve(factor, sigma * x - c + A.T @ (rho * w - y))
+        nu = rho * (A @ x_next - w) + y
+        w_tilde = w + (nu - y) / rho
+        w_next = jnp.clip(w_tilde + y / rho, a_min=l_bound, a_max=u_bound)
+        y_next = y + rho * (w_tilde - w_next)
+        z_next = jnp.concatenate([x_next, y_next, w_next])
+        return z_next, jnp.linalg.norm(z_next - z, axis=0)
+    return lax.scan(step, z0_mat, None, length=k)
+
+
+def time_fn(fn, args, num_runs):
+    """
+    returns the best wall clock time of fn(*args) over num_runs runs (after compiling) and
+        its output
+    """
+    out = fn(*args)
+    out[0].block_until_ready()
+    times = []
+    for _ in range(num_runs):
+        t0 = time.time()
+        out = fn(*args)
+        out[0].block_until_ready()
+        times.append(time.time() - t0)
+    return np.min(times), out
+
+
+if __name__ == '__main__':
+    main()
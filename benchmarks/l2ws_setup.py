@@ -1,6 +1,7 @@
 import sys
 
 import hydra
+from jax.config import config
 
 import l2ws.examples.jamming as jamming
 import l2ws.examples.lasso as lasso
@@ -17,6 +18,8 @@ import l2ws.examples.sparse_pca as sparse_pca
 import l2ws.examples.unconstrained_qp as unconstrained_qp
 import l2ws.examples.vehicle as vehicle
 
+config.update("jax_enable_x64", True)
+
 
 @hydra.main(config_path='configs/markowitz', config_name='markowitz_setup.yaml')
 def main_setup_markowitz(cfg):
@@ -17,6 +17,7 @@ import l2ws.examples.sparse_pca as sparse_pca
 import l2ws.examples.unconstrained_qp as unconstrained_qp
 import l2ws.examples.vehicle as vehicle
 from l2ws.utils.data_utils import copy_data_file, recover_last_datetime
+from l2ws.utils.precision_utils import enable_precision, get_precision_policy
 
 
 @hydra.main(config_path='configs/markowitz', config_name='markowitz_run.yaml')
@@ -29,6 +30,7 @@ def main_run_markowitz(cfg):
         agg_datetime = recover_last_datetime(orig_cwd, example, 'aggregate')
         cfg.data.datetime = agg_datetime
     copy_data_file(example, agg_datetime)
+    enable_precision(get_precision_policy(cfg.get('precision', 'float64')))
     markowitz.run(cfg)
 
 
@@ -42,6 +44,7 @@ def main_run_osc_mass(cfg):
         agg_datetime = recover_last_datetime(orig_cwd, example, 'aggregate')
         cfg.data.datetime = agg_datetime
     copy_data_file(example, agg_datetime)
+    enable_precision(get_precision_policy(cfg.get('precision', 'float64')))
     osc_mass.run(cfg)
 
 
@@ -55,6 +58,7 @@ def main_run_lasso(cfg):
         setup_datetime = recover_last_datetime(orig_cwd, example, 'data_setup')
         cfg.data.datetime = setup_datetime
     copy_data_file(example, setup_datetime)
+    enable_precision(get_precision_policy(cfg.get('precision', 'float64')))
     lasso.run(cfg)
 
 
@@ -68,6 +72,7 @@ def main_run_quadcopter(cfg):
         setup_datetime = recover_last_datetime(orig_cwd, example, 'data_setup')
         cfg.data.datetime = setup_datetime
     copy_data_file(example, setup_datetime)
+    enable_precision(get_precision_policy(cfg.get('precision', 'float64')))
     quadcopter.run(cfg)
 
 
@@ -81,6 +86,7 @@ def main_run_jamming(cfg):
         setup_datetime = recover_last_datetime(orig_cwd, example, 'data_setup')
         cfg.data.datetime = setup_datetime
     copy_data_file(example, setup_datetime)
+    enable_precision(get_precision_policy(cfg.get('precision', 'float64')))
     jamming.run(cfg)
 
 
@@ -94,6 +100,7 @@ def main_run_mnist(cfg):
         setup_datetime = recover_last_datetime(orig_cwd, example, 'data_setup')
         cfg.data.datetime = setup_datetime
     copy_data_file(example, setup_datetime)
+    enable_precision(get_precision_policy(cfg.get('precision', 'float64')))
     mnist.run(cfg)
 
 
@@ -107,6 +114,7 @@ def main_run_unconstrained_qp(cfg):
         setup_datetime = recover_last_datetime(orig_cwd, example, 'data_setup')
         cfg.data.datetime = setup_datetime
     copy_data_file(example, setup_datetime)
+    enable_precision(get_precision_policy(cfg.get('precision', 'float64')))
     unconstrained_qp.run(cfg)
 
 
@@ -120,6 +128,7 @@ def main_run_mpc(cfg):
         setup_datetime = recover_last_datetime(orig_cwd, example, 'data_setup')
         cfg.data.datetime = setup_datetime
     copy_data_file(example, setup_datetime)
+    enable_precision(get_precision_policy(cfg.get('precision', 'float64')))
     mpc.run(cfg)
 
 
@@ -133,6 +142,7 @@ def main_run_robust_kalman(cfg):
         setup_datetime = recover_last_datetime(orig_cwd, example, 'data_setup')
         cfg.data.datetime = setup_datetime
     copy_data_file(example, setup_datetime)
+    enable_precision(get_precision_policy(cfg.get('precision', 'float64')))
     robust_kalman.run(cfg)
 
 
@@ -146,6 +156,7 @@ def main_run_robust_pca(cfg):
         agg_datetime = recover_last_datetime(orig_cwd, example, 'aggregate')
         cfg.data.datetime = agg_datetime
     copy_data_file(example, agg_datetime)
+    enable_precision(get_precision_policy(cfg.get('precision', 'float64')))
     robust_pca.run(cfg)
 
 
@@ -159,6 +170,7 @@ def main_run_robust_ls(cfg):
         setup_datetime = recover_last_datetime(orig_cwd, example, 'data_setup')
         cfg.data.datetime = setup_datetime
     copy_data_file(example, setup_datetime)
+    enable_precision(get_precision_policy(cfg.get('precision', 'float64')))
     robust_ls.run(cfg)
 
 
@@ -172,6 +184,7 @@ def main_run_sparse_pca(cfg):
         setup_datetime = recover_last_datetime(orig_cwd, example, 'data_setup')
         cfg.data.datetime = setup_datetime
     copy_data_file(example, setup_datetime)
+    enable_precision(get_precision_policy(cfg.get('precision', 'float64')))
     sparse_pca.run(cfg)
 
 
@@ -185,6 +198,7 @@ def main_run_phase_retrieval(cfg):
         setup_datetime = recover_last_datetime(orig_cwd, example, 'data_setup')
         cfg.data.datetime = setup_datetime
     copy_data_file(example, setup_datetime)
+    enable_precision(get_precision_policy(cfg.get('precision', 'float64')))
     phase_retrieval.run(cfg)
 
 
@@ -198,6 +212,7 @@ def main_run_vehicle(cfg):
         agg_datetime = recover_last_datetime(orig_cwd, example, 'aggregate')
         cfg.data.datetime = agg_datetime
     copy_data_file(example, agg_datetime)
+    enable_precision(get_precision_policy(cfg.get('precision', 'float64')))
     vehicle.run(cfg)
 
 
@@ -5,6 +5,7 @@ import jax
 import jax.numpy as jnp
 import matplotlib.pyplot as plt
 import numpy as np
+from jax.config import config
 
 from l2ws.algo_steps import (
     create_M,
@@ -17,6 +18,8 @@ from l2ws.examples.robust_kalman import multiple_random_robust_kalman
 from l2ws.examples.sparse_pca import multiple_random_sparse_pca
 from l2ws.scs_problem import scs_jax
 
+config.update("jax_enable_x64", True)
+
 plt.rcParams.update({
     "text.usetex": True,
     "font.family": "serif",   # For talks, use sans-serif
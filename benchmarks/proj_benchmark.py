@@ -0,0 +1,103 @@
+import time
+from functools import partial
+
+import jax.numpy as jnp
+import numpy as np
+from jax import jit, vmap
+from jax.config import config
+
+from l2ws.algo_steps import count_num_repeated_elements, create_projection_fn, proj
+from l2ws.examples.phase_retrieval import static_canon as phase_retrieval_canon
+from l2ws.examples.robust_ls import random_robust_ls
+from l2ws.examples.sparse_pca import static_canon as sparse_pca_canon
+
+config.update("jax_enable_x64", True)
+
+
+def main():
+    """
+    microbenchmark of the fused cone projection (create_projection_fn) against the
+        previous projection built from proj()
+
+    the projections are applied to a batch of random vectors, as in training
+    """
+    batch_size, num_runs = 100, 200
+
+    # robust least squares: second order cones
+    P, A, c, b, cones = random_robust_ls(m_orig=500, n_orig=400, rho=1, b_center=1, b_range=1)
+    benchmark('robust_ls', cones, A.shape[1], batch_size, num_runs)
+
+    # many second order cones with interleaved sizes
+    interleaved_cones = dict(z=0, l=10, q=[3, 5] * 200, s=[])
+    benchmark('interleaved soc', interleaved_cones, 10, batch_size, num_runs)
+
+    # sparse pca: psd cone
+    out_dict = sparse_pca_canon(n_orig=30, k=10, factor=False)
+    cones = out_dict['cones_dict']
+    benchmark('sparse_pca', cones, out_dict['A_sparse'].shape[1], batch_size, num_runs)
+
+    # phase retrieval: psd cone
+    out_dict = phase_retrieval_canon(n_orig=40, d_mul=2, factor=False)
+    cones = out_dict['cones_dict']
+    benchmark('phase_retrieval', cones, out_dict['A_sparse'].shape[1], batch_size, num_runs)
+
+
+def benchmark(name, cones, n, batch_size, num_runs):
+    cones = {'q': [], 's': [], **cones}
+    m = cones['z'] + cones['l'] + sum(cones['q']) + sum(int(r * (r + 1) / 2) for r in cones['s'])
+    inputs = jnp.array(np.random.normal(size=(batch_size, n + m)))
+
+    fused_proj_fn = jit(vmap(create_projection_fn(cones, n)))
+    chain_proj_fn = jit(vmap(create_concatenate_projection_fn(cones, n)))
+    fused_compile_time, fused_time = time_fn(fused_proj_fn, inputs, num_runs)
+    chain_compile_time, chain_time = time_fn(chain_proj_fn, inputs, num_runs)
+    error = jnp.linalg.norm(fused_proj_fn(inputs) - chain_proj_fn(inputs))
+
+    print(f"{name}: n + m = {n + m}, batch of {batch_size}")
+    print(f"    concatenate chain: {chain_time * 1000:.3f} ms (compile {chain_compile_time:.2f} s)")
+    print(f"    fused:             {fused_time * 1000:.3f} ms (compile {fused_compile_time:.2f} s)")
+    print(f"    speedup {chain_time / fused_time:.2f}x, difference {error:.2e}")
+
+
+def time_fn(fn, inputs, num_runs):
+    """
+    returns the compile time and the fastest of num_runs evaluations
+    """
+    t0 = time.perf_counter()
+    fn(inputs).block_until_ready()
+    compile_time = time.perf_counter() - t0
+
+    times = np.zeros(num_runs)
+    for i in range(num_runs):
+        t0 = time.perf_counter()
+        fn(inputs).block_until_ready()
+        times[i] = time.perf_counter() - t0
+    return compile_time, times.min()
+
+
+def create_concatenate_projection_fn(cones, n):
+    """
+    the projection that create_projection_fn used to build from proj()
+    """
+    if len(cones['q']) > 0:
+        soc_proj_sizes, soc_num_proj = count_num_repeated_elements(jnp.array(cones['q']))
+    else:
+        soc_proj_sizes, soc_num_proj = [], []
+    if len(cones['s']) > 0:
+        sdp_row_sizes, sdp_num_proj = count_num_repeated_elements(jnp.array(cones['s']))
+        sdp_vector_sizes = [int(row_size * (row_size + 1) / 2) for row_size in sdp_row_sizes]
+    else:
+        sdp_row_sizes, sdp_vector_sizes, sdp_num_proj = [], [], []
+    return partial(proj,
+                   n=n,
+                   zero_cone_int=int(cones['z']),
+                   nonneg_cone_int=int(cones['l']),
+                   soc_proj_sizes=soc_proj_sizes,
+                   soc_num_proj=soc_num_proj,
+                   sdp_row_sizes=sdp_row_sizes,
+                   sdp_vector_sizes=sdp_vector_sizes,
+                   sdp_num_proj=sdp_num_proj)
+
+
+if __name__ == '__main__':
+    main()
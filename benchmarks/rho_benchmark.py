@@ -0,0 +1,53 @@
+import numpy as np
+from jax import jit, vmap
+from jax.config import config
+
+from l2ws.algo_steps import get_osqp_factor, get_rho_bank, k_steps_eval_osqp
+from l2ws.examples.mpc import multiple_random_mpc_osqp
+
+config.update("jax_enable_x64", True)
+
+
+def main():
+    """
+    benchmark of the adaptive rho of osqp (see get_rho_bank) against the fixed rho
+
+    a batch of mpc problems is solved from a cold start with rho_vec scaled by rho_factor
+        (rho_factor = 1 is the default rho_vec of the mpc example) and we report the number
+        of iterations until both the primal and dual residuals are below tol
+    """
+    num_probs, k, tol, sigma = 5, 2000, 1e-4, 1
+    np.random.seed(0)
+    out = multiple_random_mpc_osqp(num_probs, T=10, nx=20, nu=10, sigma=sigma)
+    P, A, q_mat, rho_vec = out[1], out[2], out[3], out[-1]
+    m, n = A.shape
+    z0_mat = np.zeros((num_probs, m + n))
+
+    print(f"mpc: n = {n}, m = {m}, {num_probs} problems, tol {tol}, at most {k} iterations")
+    for rho_factor in [1e-3, 1, 1e3]:
+        rho = rho_factor * rho_vec
+        factor = get_osqp_factor(P, A, rho, sigma)
+        rho_bank = get_rho_bank(P, A, rho, sigma, True)
+        fixed_iters = iters_to_tol(k, z0_mat, q_mat, factor, P, A, rho, sigma, None, tol)
+        adaptive_iters = iters_to_tol(k, z0_mat, q_mat, factor, P, A, rho, sigma, rho_bank, tol)
+        print(f"rho_factor {rho_factor:g}")
+        print(f"    fixed rho:    mean {fixed_iters.mean():.1f}, max {fixed_iters.max()}")
+        print(f"    adaptive rho: mean {adaptive_iters.mean():.1f}, max {adaptive_iters.max()}")
+
+
+def iters_to_tol(k, z0_mat, q_mat, factor, P, A, rho, sigma, rho_bank, tol):
+    """
+    returns the number of iterations of each problem until its primal and dual residuals are
+        below tol (k if they never are)
+    """
+    def eval_osqp(z0, q):
+        out = k_steps_eval_osqp(k, z0, q, factor, P, A, rho, sigma, False, None, True,
+                                record=[0], rho_bank=rho_bank)
+        return out[3], out[4]
+    primal, dual = jit(vmap(eval_osqp))(z0_mat, q_mat)
+    converged = np.maximum(np.array(primal), np.array(dual)) <= tol
+    return np.where(converged.any(axis=1), converged.argmax(axis=1) + 1, k)
+
+
+if __name__ == '__main__':
+    main()
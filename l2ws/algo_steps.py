@@ -1,13 +1,55 @@
+import logging
+import time
 from functools import partial
 
+import jax
 import jax.numpy as jnp
 import jax.scipy as jsp
-from jax import grad, jit, lax, vmap
-
-from l2ws.utils.generic_utils import python_fori_loop, unvec_symm, vec_symm
+import numpy as np
+from jax import grad, jit, lax, random, vmap
+from jax.custom_batching import custom_vmap
+
+from l2ws.utils.factor_utils import (
+    CholeskyFactor,
+    InverseFactor,
+    osqp_cg_factor,
+    osqp_sparse_factor,
+    scs_cg_factor,
+    scs_quasi_definite_factor,
+    scs_sparse_factor,
+)
+from l2ws.utils.generic_utils import (
+    python_while_loop,
+    unvec_symm,
+    vec_symm,
+)
+from l2ws.utils.grad_utils import train_scan
 
 TAU_FACTOR = 10
 
+# largest system that the 'auto' factor_method considers inverting explicitly
+MAX_INVERSE_SIZE = 1000
+
+# subspace iterations per call of the low-rank psd projection
+PSD_SUBSPACE_ITERS = 2
+
+# defaults of the adaptive scale dict of scs (see get_scale_bank and scs_adaptive_step)
+#   num_scales: odd number of log-spaced scales that are factored ahead of time
+#   scale_range: the scales span [scale / scale_range, scale * scale_range]
+#   min_iters: number of steps a scale is kept before it can be updated
+#   update_factor: the scale is updated once the balancing factor is outside
+#       [1 / update_factor, update_factor] (same rule and constants as scs)
+ADAPTIVE_SCALE_DEFAULTS = dict(num_scales=13, scale_range=1e3, min_iters=100,
+                               update_factor=np.sqrt(10))
+
+# defaults of the adaptive rho dict of osqp (see get_rho_bank and osqp_adaptive_step)
+#   num_rhos: odd number of log-spaced multiples of rho that are factored ahead of time
+#   rho_range: the multiples span [1 / rho_range, rho_range]
+#   interval: number of steps between two checks of the residual ratio
+#   tolerance: rho is updated once the balancing factor is outside [1 / tolerance, tolerance]
+#       (adaptive_rho_tolerance of osqp)
+ADAPTIVE_RHO_DEFAULTS = dict(num_rhos=13, rho_range=1e3, interval=25, tolerance=5)
+
 
 # def fixed_point_extragrad(z, Q, R, A, c, b, eg_step):
 #     """
@@ -33,167 +75,321 @@ def cold_start_solve(fixed_point_fn, n, b_mat):
 
 
 def create_train_fn(fixed_point_fn):
-    def fp_train_generic(i, val, supervised, z_star, theta):
-        z, loss_vec = val
-        z_next = fixed_point_fn(z, theta)
-        if supervised:
-            diff = jnp.linalg.norm(z - z_star)
-        else:
-            diff = jnp.linalg.norm(z_next - z)
-        loss_vec = loss_vec.at[i].set(diff)
-        return z_next, loss_vec
-
-    def k_steps_train(k, z0, q, supervised, z_star, jit):
-        iter_losses = jnp.zeros(k)
-        fp_train_partial = partial(fp_train_generic, supervised=supervised, z_star=z_star, theta=q)
-        val = z0, iter_losses
-        start_iter = 0
-        if jit:
-            out = lax.fori_loop(start_iter, k, fp_train_partial, val)
-        else:
-            out = python_fori_loop(start_iter, k, fp_train_partial, val)
-        z_final, iter_losses = out
-        return z_final, iter_losses
+    def k_steps_train(k, z0, q, supervised, z_star, jit, anderson=None, diff_mode='unroll',
+                      segment_length=None, acc_dtype=None):
+        step_fn = partial(single_iterate_step, fixed_point_fn=partial(fixed_point_fn, theta=q))
+        metrics = dict(loss=get_loss_metric(supervised, z_star, acc_dtype))
+        state, metric_vals, _ = fixed_point_scan(step_fn, (z0,), 0, k, jit, metrics,
+                                                 anderson=anderson, diff_mode=diff_mode,
+                                                 segment_length=segment_length)
+        return state[0], metric_vals['loss']
     return k_steps_train
 
 
 def create_eval_fn(fixed_point_fn):
-    def fp_train_generic(i, val, supervised, z_star, theta):
-        z, loss_vec, z_all = val
-        z_next = fixed_point_fn(z, theta)
-        if supervised:
-            diff = jnp.linalg.norm(z - z_star)
-        else:
-            diff = jnp.linalg.norm(z_next - z)
-        loss_vec = loss_vec.at[i].set(diff)
-        z_all = z_all.at[i, :].set(z_next)
-        return z_next, loss_vec, z_all
-
-    def k_steps_train(k, z0, q, supervised, z_star, jit):
-        iter_losses = jnp.zeros(k)
-        z_all_plus_1 = jnp.zeros((k + 1, z0.size))
-        z_all_plus_1 = z_all_plus_1.at[0, :].set(z0)
-        fp_train_partial = partial(fp_train_generic, supervised=supervised, z_star=z_star, theta=q)
-        z_all = jnp.zeros((k, z0.size))
-        val = z0, iter_losses, z_all
-        start_iter = 0
-        if jit:
-            out = lax.fori_loop(start_iter, k, fp_train_partial, val)
-        else:
-            out = python_fori_loop(start_iter, k, fp_train_partial, val)
-        z_final, iter_losses, z_all = out
-        z_all_plus_1 = z_all_plus_1.at[1:, :].set(z_all)
-        return z_final, iter_losses, z_all_plus_1
-    return k_steps_train
+    def k_steps_eval(k, z0, q, supervised, z_star, jit, record=None, anderson=None,
+                     acc_dtype=None):
+        step_fn = partial(single_iterate_step, fixed_point_fn=partial(fixed_point_fn, theta=q))
+        metrics = dict(loss=get_loss_metric(supervised, z_star, acc_dtype))
+        state, metric_vals, history = fixed_point_scan(step_fn, (z0,), 0, k, jit, metrics,
+                                                       record_fn=record_iterate, record=record,
+                                                       anderson=anderson)
+        z_all_plus_1 = stack_history(z0, history[0], records_z0(k, record))
+        return state[0], metric_vals['loss'], z_all_plus_1
+    return k_steps_eval
+
+
+def fixed_point_scan(step_fn, state, lower, upper, jit, metrics=None, record_fn=None,
+                     record=None, anderson=None, diff_mode='unroll', segment_length=None,
+                     sparse_metrics=None, metric_steps=None):
+    """
+    the fixed point engine shared by the train and eval kernels: applies
+        state, aux = step_fn(state) for the steps lower, ..., upper - 1 with lax.scan
+
+    state is a tuple whose first entry is the iterate z (e.g., (z, y, t) for fista)
+        and aux holds the by-products of the step that the metrics or the history use
+        (e.g., (u, v) for scs)
+    metrics is a dict of callbacks metric(z, z_next, aux) that return a scalar (e.g., the
+        fixed point residual or the primal residual); only the requested metrics are computed
+        and the scan stacks their values
+    sparse_metrics is a dict of callbacks like metrics that are only evaluated at the steps
+        whose output iterate is in the policy metric_steps (see get_metric_mask) and are
+        nan at the other steps
+    record_fn(z_next, aux) returns the tuple of arrays that are stored under the
+        iterate-history policy record (see get_record_indices); the rows of the steps before
+        lower are left as zeros
+    anderson, diff_mode, and segment_length are as in train_scan (diff_mode only matters
+        when the kernel is differentiated)
+
+    returns (state_final, metric_vals, history) where metric_vals[name] has shape
+        (upper - lower,) and history[j] stacks the j-th output of record_fn over the recorded
+        steps in [0, upper)
+    """
+    metrics = {} if metrics is None else metrics
+    sparse_metrics = {} if sparse_metrics is None else sparse_metrics
+    step_slots, num_recorded, _ = get_record_slots(upper, record)
+    metric_mask = get_metric_mask(upper, metric_steps)
+
+    # the history is written into buffers in the carry rather than stacked by the scan:
+    #   under vmap the stacked outputs are step-major and would be transposed to batch-major
+    buffers = ()
+    if record_fn is not None:
+        def record_shapes(state):
+            state_next, aux = step_fn(state)
+            return record_fn(state_next[0], aux)
+        shapes = jax.eval_shape(record_shapes, state)
+        buffers = tuple(jnp.zeros((num_recorded,) + x.shape, dtype=x.dtype) for x in shapes)
+
+    def scan_body(carry, i):
+        state, buffers = carry[:-1], carry[-1]
+        state_next, aux = step_fn(state)
+        metric_vals = {name: metric(state[0], state_next[0], aux)
+                       for name, metric in metrics.items()}
+        if sparse_metrics:
+            def eval_sparse_metrics():
+                return {name: metric(state[0], state_next[0], aux)
+                        for name, metric in sparse_metrics.items()}
+            if metric_mask is None:
+                metric_vals.update(eval_sparse_metrics())
+            else:
+                # the predicate does not depend on the problem so under vmap the skipped
+                #   steps do not evaluate the metrics
+                shapes = jax.eval_shape(eval_sparse_metrics)
+                metric_vals.update(lax.cond(
+                    metric_mask[i], eval_sparse_metrics,
+                    lambda: {name: jnp.full(x.shape, jnp.nan, dtype=x.dtype)
+                             for name, x in shapes.items()}))
+        if record_fn is not None:
+            records = record_fn(state_next[0], aux)
+            buffers = tuple(record_step(buffer, i, x, step_slots)
+                            for buffer, x in zip(buffers, records))
+        return tuple(state_next) + (buffers,), metric_vals
+
+    init = tuple(state) + (buffers,)
+    xs = np.arange(lower, upper)
+    carry, metric_vals = train_scan(scan_body, init, xs, jit, anderson, diff_mode, segment_length)
+    return carry[:-1], metric_vals, carry[-1]
+
+
+def get_metric_mask(k, metric_steps):
+    """
+    returns the boolean mask over the steps 0, ..., k - 1 of the steps whose output iterate
+        z^{i + 1} is in the policy metric_steps (same as the record policy of
+        get_record_indices, e.g., r computes the metrics every r iterations) or None if
+        the metrics are computed at every step
+    """
+    if metric_steps is None:
+        return None
+    indices = get_record_indices(k, metric_steps)
+    mask = np.zeros(k, dtype=bool)
+    mask[indices[indices >= 1] - 1] = True
+    return jnp.array(mask)
 
 
-# def create_k_steps_eval(fixed_point_fn):
-#     iter_losses, obj_diffs = jnp.zeros(k), jnp.zeros(k)
-#     z_all_plus_1 = jnp.zeros((k + 1, z0.size))
-#     z_all_plus_1 = z_all_plus_1.at[0, :].set(z0)
-
-#     f_theta = partial(f, theta=q)
-
-#     fp_eval_partial = partial(fp_eval_extragrad,
-#                               supervised=supervised,
-#                               z_star=z_star,
-#                               f=f_theta,
-#                               proj_X=proj_X,
-#                               proj_Y=proj_Y,
-#                               eg_step=eg_step,
-#                               n=n
-#                               )
-#     z_all = jnp.zeros((k, z0.size))
-#     val = z0, iter_losses, z_all, obj_diffs
-#     start_iter = 0
-#     if jit:
-#         out = lax.fori_loop(start_iter, k, fp_eval_partial, val)
-#     else:
-#         out = python_fori_loop(start_iter, k, fp_eval_partial, val)
-#     z_final, iter_losses, z_all, obj_diffs = out
-#     z_all_plus_1 = z_all_plus_1.at[1:, :].set(z_all)
-#     return z_final, iter_losses, z_all_plus_1
-
-
-def k_steps_eval_extragrad(k, z0, q, f, proj_X, proj_Y, n, eg_step, supervised, z_star, jit):
-    iter_losses, obj_diffs = jnp.zeros(k), jnp.zeros(k)
-    z_all_plus_1 = jnp.zeros((k + 1, z0.size))
-    z_all_plus_1 = z_all_plus_1.at[0, :].set(z0)
+def single_iterate_step(state, fixed_point_fn):
+    """
+    step of the fixed point engine for the operators z_next = fixed_point_fn(z)
+    """
+    return (fixed_point_fn(state[0]),), None
 
-    f_theta = partial(f, theta=q)
 
-    fp_eval_partial = partial(fp_eval_extragrad,
-                              supervised=supervised,
-                              z_star=z_star,
-                              f=f_theta,
-                              proj_X=proj_X,
-                              proj_Y=proj_Y,
-                              eg_step=eg_step,
-                              n=n
-                              )
-    z_all = jnp.zeros((k, z0.size))
-    val = z0, iter_losses, z_all, obj_diffs
-    start_iter = 0
-    if jit:
-        out = lax.fori_loop(start_iter, k, fp_eval_partial, val)
-    else:
-        out = python_fori_loop(start_iter, k, fp_eval_partial, val)
-    z_final, iter_losses, z_all, obj_diffs = out
-    z_all_plus_1 = z_all_plus_1.at[1:, :].set(z_all)
-    return z_final, iter_losses, z_all_plus_1, obj_diffs
+def record_iterate(z_next, aux):
+    return (z_next,)
+
+
+def fixed_point_residual(z, z_next, aux, acc_dtype=None):
+    return acc_norm(z_next - z, acc_dtype)
 
 
-def k_steps_train_extragrad(k, z0, q, f, proj_X, proj_Y, n, eg_step, supervised, z_star, jit):
+def distance_to_opt(z, z_next, aux, z_star, acc_dtype=None):
+    return acc_norm(z - z_star, acc_dtype)
+
+
+def get_loss_metric(supervised, z_star, acc_dtype=None):
     """
-    f is a function that takes in theta in addition to x and y, i.e., f(theta, x, y)
+    the training loss: the distance of z to z_star if supervised else the fixed point residual
     """
-    iter_losses = jnp.zeros(k)
-    f_theta = partial(f, theta=q)
+    if supervised:
+        return partial(distance_to_opt, z_star=z_star, acc_dtype=acc_dtype)
+    return partial(fixed_point_residual, acc_dtype=acc_dtype)
+
+
+def objective_gap(z, z_next, aux, obj_fn, opt_obj, acc_dtype=None):
+    gap = obj_fn(z_next) - opt_obj
+    return gap.astype(get_acc_dtype(acc_dtype, gap))
+
+
+def get_record_indices(k, record):
+    """
+    returns the sorted iterates in {0, ..., k} that are stored under the recording policy
+
+    record is one of
+        None: every iterate z^0, ..., z^k (the default)
+        'none': no iterates
+        'last': only z^k
+        r (int): every r-th iterate z^0, z^r, z^{2r}, ...
+        list of ints: the given iterates (negative entries count back from z^k)
+    """
+    if record is None:
+        return np.arange(k + 1)
+    if record == 'none':
+        return np.zeros(0, dtype=int)
+    if record == 'last':
+        return np.array([k])
+    if isinstance(record, int):
+        return np.arange(0, k + 1, record)
+    indices = np.array(list(record), dtype=int)
+    indices = np.where(indices < 0, indices + k + 1, indices)
+    return np.unique(indices[(indices >= 0) & (indices <= k)])
+
+
+def get_record_slots(k, record):
+    """
+    returns (step_slots, num_recorded, record_z0) for the recording policy
+
+    step_slots[i] is the row of the history buffer that stores the output of step i
+        (i.e. z^{i + 1}) and equals num_recorded if that iterate is dropped
+    step_slots is None if every iterate is recorded
+    num_recorded is the number of rows of the buffer (not counting z^0)
+    """
+    if record is None:
+        return None, k, True
+    indices = get_record_indices(k, record)
+    steps = indices[indices >= 1] - 1
+    step_slots = np.full(k, steps.size)
+    step_slots[steps] = np.arange(steps.size)
+    record_z0 = bool(indices.size > 0 and indices[0] == 0)
+    return jnp.array(step_slots), steps.size, record_z0
+
+
+def record_step(all_z, i, z, step_slots):
+    if step_slots is None:
+        return all_z.at[i, :].set(z)
+    if all_z.shape[0] == 0:
+        # nothing is recorded
+        return all_z
+    return all_z.at[step_slots[i], :].set(z, mode='drop')
+
+
+def stack_history(z0, all_z, record_z0):
+    if record_z0:
+        return jnp.concatenate([jnp.expand_dims(z0, 0), all_z])
+    return all_z
+
+
+def records_z0(k, record):
+    return get_record_slots(k, record)[2]
+
+
+def record_first_step(history, first_records, k, record):
+    """
+    adds the records of step 0 (taken outside of fixed_point_scan, e.g., the first scs step)
+        to the history of fixed_point_scan
+    """
+    step_slots = get_record_slots(k, record)[0]
+    return tuple(record_step(all_x, 0, x, step_slots) for x, all_x in zip(first_records, history))
+
+
+def create_tol_fn(fixed_point_fn):
+    def k_steps_tol(k, z0, q, tol, jit, acc_dtype=None):
+        def step(z):
+            z_next = fixed_point_fn(z, q)
+            return z_next, acc_norm(z_next - z, acc_dtype)
+        return run_to_tol(step, z0, k, tol, jit)
+    return k_steps_tol
+
+
+def run_to_tol(step_fn, val, k, tol, jit, res=None):
+    """
+    applies step_fn until the residual drops below tol or k steps have been taken
+
+    step_fn maps the loop state val to (val_next, residual)
+    res is the residual of val (e.g., of a first step taken outside the loop), inf by default
+    returns (val_final, num_iters, residual)
+
+    under vmap, lax.while_loop keeps iterating while any lane has not converged
+        and freezes the lanes that have, so a batch stops as soon as its
+        slowest problem reaches its tolerance
+    """
+    # the residual keeps the dtype that step_fn returns it in (e.g., the accumulation dtype)
+    res_dtype = jax.eval_shape(step_fn, val)[1].dtype
+    res = jnp.inf if res is None else res
+    init_val = 0, val, jnp.asarray(res, dtype=res_dtype)
+
+    def cond_fn(loop_val):
+        i, _, res = loop_val
+        return jnp.logical_and(i < k, res > tol)
+
+    def body_fn(loop_val):
+        i, val, _ = loop_val
+        val_next, res = step_fn(val)
+        return i + 1, val_next, res
 
-    fp_train_partial = partial(fp_train_extragrad,
-                               supervised=supervised,
-                               z_star=z_star,
-                               f=f_theta,
-                               proj_X=proj_X,
-                               proj_Y=proj_Y,
-                               eg_step=eg_step,
-                               n=n
-                               )
-    val = z0, iter_losses
-    start_iter = 0
     if jit:
-        out = lax.fori_loop(start_iter, k, fp_train_partial, val)
+        out = lax.while_loop(cond_fn, body_fn, init_val)
     else:
-        out = python_fori_loop(start_iter, k, fp_train_partial, val)
-    z_final, iter_losses = out
-    return z_final, iter_losses
+        out = python_while_loop(cond_fn, body_fn, init_val)
+    num_iters, val_final, res = out
+    return val_final, num_iters, res
 
 
-def fp_train_extragrad(i, val, supervised, z_star, f, proj_X, proj_Y, eg_step, n):
-    z, loss_vec = val
-    z_next = fixed_point_extragrad(z, f, proj_X, proj_Y, eg_step, n)
-    if supervised:
-        diff = jnp.linalg.norm(z - z_star)
-    else:
-        diff = jnp.linalg.norm(z_next - z)
-    loss_vec = loss_vec.at[i].set(diff)
-    return z_next, loss_vec
+def check_tol_metric(tol_metric):
+    if tol_metric not in ['fixed_point', 'primal', 'dual']:
+        raise ValueError(f"tol_metric must be 'fixed_point', 'primal', or 'dual', not {tol_metric}")
 
 
-# fp_train_extragrad(i, val, supervised, z_star, Q, R, A, c, b, eg_step)
-def fp_eval_extragrad(i, val, supervised, z_star, f, proj_X, proj_Y, eg_step, n):
-    z, loss_vec, z_all, obj_diffs = val
-    z_next = fixed_point_extragrad(z, f, proj_X, proj_Y, eg_step, n)
-    if supervised:
-        diff = jnp.linalg.norm(z - z_star)
-    else:
-        diff = jnp.linalg.norm(z_next - z)
-    loss_vec = loss_vec.at[i].set(diff)
-    obj = 0
-    opt_obj = 0
-    obj_diffs = obj_diffs.at[i].set(obj - opt_obj)
-    z_all = z_all.at[i, :].set(z_next)
-    return z_next, loss_vec, z_all, obj_diffs
+def get_acc_dtype(acc_dtype, x):
+    """
+    the dtype that the norms of x are accumulated in: acc_dtype (the accumulation dtype of
+        the precision policy, see l2ws/utils/precision_utils.py) or the dtype of x if None
+    """
+    return x.dtype if acc_dtype is None else jnp.dtype(acc_dtype)
+
+
+def acc_norm(x, acc_dtype=None):
+    """
+    2-norm of x accumulated in acc_dtype (see get_acc_dtype) so that the losses and residuals
+        of float32 iterates can be reduced in float64
+    """
+    return jnp.linalg.norm(x.astype(get_acc_dtype(acc_dtype, x)))
+
+
+def k_steps_eval_extragrad(k, z0, q, f, proj_X, proj_Y, n, eg_step, supervised, z_star, jit,
+                           record=None, acc_dtype=None):
+    f_theta = partial(f, theta=q)
+    fixed_point_fn = partial(fixed_point_extragrad, f=f_theta, proj_X=proj_X, proj_Y=proj_Y,
+                             eg_step=eg_step, n=n)
+    step_fn = partial(single_iterate_step, fixed_point_fn=fixed_point_fn)
+    metrics = dict(loss=get_loss_metric(supervised, z_star, acc_dtype))
+    state, metric_vals, history = fixed_point_scan(step_fn, (z0,), 0, k, jit, metrics,
+                                                   record_fn=record_iterate, record=record)
+    z_all_plus_1 = stack_history(z0, history[0], records_z0(k, record))
+    obj_diffs = jnp.zeros(k, dtype=metric_vals['loss'].dtype)
+    return state[0], metric_vals['loss'], z_all_plus_1, obj_diffs
+
+
+def k_steps_train_extragrad(k, z0, q, f, proj_X, proj_Y, n, eg_step, supervised, z_star, jit,
+                            diff_mode='unroll', segment_length=None, acc_dtype=None):
+    """
+    f is a function that takes in theta in addition to x and y, i.e., f(theta, x, y)
+    """
+    f_theta = partial(f, theta=q)
+    fixed_point_fn = partial(fixed_point_extragrad, f=f_theta, proj_X=proj_X, proj_Y=proj_Y,
+                             eg_step=eg_step, n=n)
+    step_fn = partial(single_iterate_step, fixed_point_fn=fixed_point_fn)
+    metrics = dict(loss=get_loss_metric(supervised, z_star, acc_dtype))
+    state, metric_vals, _ = fixed_point_scan(step_fn, (z0,), 0, k, jit, metrics,
+                                             diff_mode=diff_mode, segment_length=segment_length)
+    return state[0], metric_vals['loss']
+
+
+def k_steps_tol_extragrad(k, z0, q, f, proj_X, proj_Y, n, eg_step, tol, jit, acc_dtype=None):
+    f_theta = partial(f, theta=q)
+
+    def step(z):
+        z_next = fixed_point_extragrad(z, f_theta, proj_X, proj_Y, eg_step, n)
+        return z_next, acc_norm(z_next - z, acc_dtype)
+    return run_to_tol(step, z0, k, tol, jit)
 
 
 def fixed_point_extragrad(z, f, proj_X, proj_Y, eg_step, n):
@@ -225,136 +421,301 @@ def form_osqp_matrix(P, A, rho_vec, sigma):
     return P + sigma * jnp.eye(n) + A.T @ jnp.diag(rho_vec) @ A
 
 
-def eval_ista_obj(z, A, b, lambd):
+def get_osqp_factors_from_q(q_mat, m, n, rho_vec, sigma=1):
+    """
+    returns the batched lu factors of P + sigma I + A^T diag(rho_vec) A of the problems whose
+        rows of q_mat hold (c, l, u, vec_symm(P), vec(A)) (osqp with dynamic matrices)
+    """
+    nc2 = int(n * (n + 1) / 2)
+    P_tensor = vmap(unvec_symm, in_axes=(0, None))(q_mat[:, 2 * m + n: 2 * m + n + nc2], n)
+    A_tensor = jnp.reshape(q_mat[:, 2 * m + n + nc2:], (-1, m, n))
+    matrices = vmap(form_osqp_matrix, in_axes=(0, 0, None, None))(P_tensor, A_tensor, rho_vec,
+                                                                   sigma)
+    return vmap(jsp.linalg.lu_factor)(matrices)
+
+
+def eval_ista_obj(z, A, b, lambd, gram=False):
+    """
+    if gram, A = A^T A and b = A^T b (see fixed_point_ista) and the objective is returned up
+        to the constant .5 ||b||^2 (it cancels in the objective gap)
+    """
+    if gram:
+        return .5 * z @ (A @ z) - b @ z + lambd * jnp.linalg.norm(z, ord=1)
     return .5 * jnp.linalg.norm(A @ z - b) ** 2 + lambd * jnp.linalg.norm(z, ord=1)
 
 
-def fp_train(i, val, q_r, factor, supervised, z_star, proj, hsde, homogeneous, scale_vec, alpha):
+def eval_gd_obj(z, P, c):
+    return .5 * z @ P @ z + c @ z
+
+
+def scs_step(state, q_r, factor, proj, hsde, homogeneous, scale_vec, alpha, verbose=False):
     """
+    step of the fixed point engine for scs: state = (z, psd_state) and aux = (u, v)
+
     q_r = r if hsde else q_r = q
     homogeneous tells us if we set tau = 1.0 or use the root_plus method
+    psd_state is None unless proj is a low-rank projection
     """
-    z, loss_vec = val
+    z, psd_state = state
     if hsde:
-        r = q_r
-        z_next, u, u_tilde, v = fixed_point_hsde(z, homogeneous, r, factor, proj, scale_vec, alpha)
-    else:
-        q = q_r
-        z_next, u, u_tilde, v = fixed_point(z, q, factor, proj, scale_vec, alpha)
-    if supervised:
-        # diff = jnp.linalg.norm(z[:-1] - z_star)
-        diff = jnp.linalg.norm(z[:-1] / z[-1] - z_star)
+        out = fixed_point_hsde(z, homogeneous, q_r, factor, proj, scale_vec, alpha,
+                               verbose=verbose, psd_state=psd_state)
     else:
-        diff = jnp.linalg.norm(z_next / z_next[-1] - z / z[-1])
-    loss_vec = loss_vec.at[i].set(diff)
-    return z_next, loss_vec
+        out = fixed_point(z, q_r, factor, proj, scale_vec, alpha, verbose=verbose,
+                          psd_state=psd_state)
+    z_next, u, u_tilde, v = out[:4]
+    if psd_state is not None:
+        psd_state = out[4]
+    return (z_next, psd_state), (u, v)
+
+
+def scs_adaptive_step(state, scale_bank, q_data, proj, P, A, alpha, verbose=False,
+                      acc_dtype=None):
+    """
+    step of the fixed point engine for scs (hsde) with the adaptive scale:
+        state = (z, psd_state, scale_state) and aux = (u, v)
+
+    scale_state = (idx, r_bank, iters, log_sum, log_count) (see init_scale_state)
+        idx: index of the current scale in scale_bank (see get_scale_bank)
+        r_bank: (M + diag(scale_vec))^{-1} q_data for every scale of the bank
+        iters: number of steps since the last update
+        log_sum: sum of the log_count log-ratios of the relative primal and dual residuals
+            since the last update
+    as in scs, the scale is multiplied by factor = sqrt(exp(log_sum / log_count)), rounded to
+        the nearest scale of the bank, once it has been kept for min_iters steps and factor is
+        outside [1 / update_factor, update_factor]
+    after an update, z is mapped so that v (and so s) is unchanged
+
+    each lane of a vmapped batch keeps its own idx and gathers its factor and r from the bank,
+        so a scale update is a lookup rather than a refactorization or a solve (under vmap
+        both branches of a lax.cond on idx would run in every step)
+    """
+    z, psd_state, (idx, r_bank, iters, log_sum, log_count) = state
+    n = A.shape[1]
+    factors, scale_vecs = scale_bank['factors'], scale_bank['scale_vecs']
+    scale_vec = scale_vecs[idx]
+    out = fixed_point_hsde(z, True, r_bank[idx], get_bank_factor(factors, idx), proj, scale_vec,
+                           alpha, verbose=verbose, psd_state=psd_state)
+    z_next, u, u_tilde, v = out[:4]
+    if psd_state is not None:
+        psd_state = out[4]
+
+    # geometric mean of sqrt(primal / dual) since the last update
+    primal_res, dual_res = scs_relative_residuals(u, v, P, A, q_data[:n], q_data[n:],
+                                                  acc_dtype)
+    log_sum = log_sum + jnp.log(primal_res) - jnp.log(dual_res)
+    log_count = log_count + 1
+    iters = iters + 1
+    log_factor = .5 * log_sum / log_count
+    update = (iters >= scale_bank['min_iters']) & \
+        (jnp.abs(log_factor) > np.log(scale_bank['update_factor']))
+    shift = jnp.round(log_factor / scale_bank['log_step']).astype(idx.dtype)
+    idx_next = jnp.where(update, jnp.clip(idx + shift, 0, scale_vecs.shape[0] - 1), idx)
+
+    # v = R (z + u - 2 u_tilde) is kept: z = R_next^{-1} v + 2 u_tilde - u
+    tau_factor = jnp.array([TAU_FACTOR], dtype=z.dtype)
+    full_scale_vec = jnp.concatenate([scale_vecs[idx_next], tau_factor])
+    z_rescaled = v / full_scale_vec + 2 * u_tilde - u
+    z_next = jnp.where(idx_next != idx, z_rescaled, z_next)
+    iters, log_sum, log_count = [jnp.where(update, jnp.zeros_like(x), x)
+                                 for x in [iters, log_sum, log_count]]
+    return (z_next, psd_state, (idx_next, r_bank, iters, log_sum, log_count)), (u, v)
+
+
+def init_scale_state(q_r, q_data, scale_bank, hsde, anderson=None, acc_dtype=None):
+    """
+    initial scale_state of scs_adaptive_step at the center scale of the bank
+        q_r = r for the center scale, r is solved from q_data once for the other scales
+    log_sum and log_count are kept in acc_dtype (see get_acc_dtype)
+    """
+    if not hsde:
+        raise ValueError("the adaptive scale requires hsde")
+    if anderson is not None:
+        raise ValueError("the adaptive scale does not support anderson acceleration")
+    center = scale_bank['scale_vecs'].shape[0] // 2
+    r_bank = vmap(lin_sys_solve, in_axes=(0, None))(scale_bank['factors'], q_data)
+    r_bank = r_bank.astype(q_r.dtype).at[center].set(q_r)
+    zero = jnp.zeros((), dtype=get_acc_dtype(acc_dtype, q_r))
+    return jnp.array(center), r_bank, jnp.array(0), zero, zero
+
+
+def get_bank_factor(factors, idx):
+    return jax.tree_util.tree_map(lambda x: x[idx], factors)
+
+
+def scs_relative_residuals(u, v, P, A, c, b, acc_dtype=None):
+    """
+    relative primal and dual residuals of the hsde iterates of scs
+        ||A x + s - b tau|| / max(||A x||, ||s||, ||b|| tau)
+        ||P x + A^T y + c tau|| / max(||P x||, ||A^T y||, ||c|| tau)
+    with (x, y, tau) = u and s = v[n:-1] (not divided by tau)
+    """
+    n = A.shape[1]
+    x, y, s, tau = u[:n], u[n:-1], v[n:-1], u[-1]
+    Ax, Px, ATy = A @ x, P @ x, A.T @ y
+    norm = partial(acc_norm, acc_dtype=acc_dtype)
+    primal = norm(Ax + s - b * tau) / jnp.maximum(
+        jnp.maximum(jnp.maximum(norm(Ax), norm(s)), norm(b) * tau), 1e-18)
+    dual = norm(Px + ATy + c * tau) / jnp.maximum(
+        jnp.maximum(jnp.maximum(norm(Px), norm(ATy)), norm(c) * tau), 1e-18)
+    return jnp.maximum(primal, 1e-18), jnp.maximum(dual, 1e-18)
+
+
+def scs_residual(z, z_next, aux, acc_dtype=None):
+    """
+    fixed point residual of the normalized scs iterates
+    """
+    return acc_norm(z_next / z_next[-1] - z / z[-1], acc_dtype)
+
+
+def scs_distance_to_opt(z, z_next, aux, z_star, acc_dtype=None):
+    return acc_norm(z[:-1] / z[-1] - z_star, acc_dtype)
+
 
+def scs_primal_residual(z, z_next, aux, A, b, hsde, acc_dtype=None):
+    u, v = aux
+    x, y, s = extract_sol(u, v, A.shape[1], hsde)
+    return acc_norm(A @ x + s - b, acc_dtype)
 
-def k_steps_train_osqp(k, z0, q, factor, A, rho, sigma, supervised, z_star, jit):
-    iter_losses = jnp.zeros(k)
+
+def scs_dual_residual(z, z_next, aux, P, A, c, hsde, acc_dtype=None):
+    u, v = aux
+    x, y, s = extract_sol(u, v, A.shape[1], hsde)
+    return acc_norm(A.T @ y + P @ x + c, acc_dtype)
+
+
+def get_scs_problem_data(q_r, P, A, scale_vec, q_data=None):
+    """
+    returns (c, b) for the primal and dual residuals of scs
+
+    the kernels get q_r = (M + diag(scale_vec))^{-1} q_data so (c, b) is q_data if it is given
+        and (M + diag(scale_vec)) q_r otherwise, computed with P and A without forming M
+    """
     m, n = A.shape
+    if q_data is not None:
+        return q_data[:n], q_data[n:n + m]
+    x, y = q_r[:n], q_r[n:n + m]
+    c = P @ x + A.T @ y + scale_vec[:n] * x
+    b = -A @ x + scale_vec[n:n + m] * y
+    return c, b
+
+
+def record_scs(z_next, aux):
+    u, v = aux
+    return z_next, u, v
 
-    # initialize z_init
-    z_init = jnp.zeros((n + 2 * m))
+
+def init_osqp(z0, A):
+    """
+    the osqp iterate is z = (x, y, w) and is warm-started with w = A x
+    """
+    m, n = A.shape
+    z_init = jnp.zeros((n + 2 * m), dtype=z0.dtype)
     z_init = z_init.at[:m + n].set(z0)
     w = A @ z0[:n]
     z_init = z_init.at[m + n:].set(w)
+    return z_init
 
-    fp_train_partial = partial(fp_train_osqp,
-                               supervised=supervised,
-                               z_star=z_star,
-                               factor=factor,
-                               A=A,
-                               q=q,
-                               rho=rho,
-                               sigma=sigma
-                               )
-    val = z_init, iter_losses
-    start_iter = 0
-    if jit:
-        out = lax.fori_loop(start_iter, k, fp_train_partial, val)
-    else:
-        out = python_fori_loop(start_iter, k, fp_train_partial, val)
-    z_final, iter_losses = out
-    return z_final, iter_losses
+
+def osqp_primal_residual(z, z_next, aux, A, acc_dtype=None):
+    """
+    aux is A @ x_next from the step (see osqp_step)
+    """
+    m, n = A.shape
+    return acc_norm(aux - z_next[n + m:], acc_dtype)
 
 
-def k_steps_eval_osqp(k, z0, q, factor, P, A, rho, sigma, supervised, z_star, jit):
-    iter_losses = jnp.zeros(k)
+def osqp_dual_residual(z, z_next, aux, P, A, q, acc_dtype=None):
     m, n = A.shape
+    return acc_norm(P @ z_next[:n] + A.T @ z_next[n:n + m] + q[:n], acc_dtype)
 
-    # initialize z_init
-    z_init = jnp.zeros((n + 2 * m))
-    z_init = z_init.at[:m + n].set(z0)
-    w = A @ z0[:n]
-    z_init = z_init.at[m + n:].set(w)
 
-    z_all_plus_1 = jnp.zeros((k + 1, z_init.size))
-    z_all_plus_1 = z_all_plus_1.at[0, :].set(z_init)
-    fp_eval_partial = partial(fp_eval_osqp,
-                              supervised=supervised,
-                              z_star=z_star,
-                              factor=factor,
-                              P=P,
-                              A=A,
-                              q=q,
-                              rho=rho,
-                              sigma=sigma
-                              )
-    z_all = jnp.zeros((k, z_init.size))
-    primal_resids, dual_resids = jnp.zeros(k), jnp.zeros(k)
-    val = z_init, iter_losses, z_all, primal_resids, dual_resids
-    start_iter = 0
-    if jit:
-        out = lax.fori_loop(start_iter, k, fp_eval_partial, val)
-    else:
-        out = python_fori_loop(start_iter, k, fp_eval_partial, val)
-    z_final, iter_losses, z_all, primal_resids, dual_resids = out
-    z_all_plus_1 = z_all_plus_1.at[1:, :].set(z_all)
-    return z_final, iter_losses, z_all_plus_1, primal_resids, dual_resids
+def k_steps_train_osqp(k, z0, q, factor, A, rho, sigma, supervised, z_star, jit, anderson=None,
+                       diff_mode='unroll', segment_length=None, acc_dtype=None):
+    z_init = init_osqp(z0, A)
+    fixed_point_fn = partial(fixed_point_osqp, factor=factor, A=A, q=q, rho=rho, sigma=sigma)
+    step_fn = partial(single_iterate_step, fixed_point_fn=fixed_point_fn)
+    metrics = dict(loss=get_loss_metric(supervised, z_star, acc_dtype))
+    state, metric_vals, _ = fixed_point_scan(step_fn, (z_init,), 0, k, jit, metrics,
+                                             anderson=anderson, diff_mode=diff_mode,
+                                             segment_length=segment_length)
+    return state[0], metric_vals['loss']
 
 
-def fp_train_osqp(i, val, supervised, z_star, factor, A, q, rho, sigma):
-    z, loss_vec = val
-    z_next = fixed_point_osqp(z, factor, A, q, rho, sigma)
-    if supervised:
-        diff = jnp.linalg.norm(z - z_star)
+def k_steps_eval_osqp(k, z0, q, factor, P, A, rho, sigma, supervised, z_star, jit,
+                      record=None, anderson=None, residual_steps=None, rho_bank=None,
+                      acc_dtype=None):
+    """
+    residual_steps is the policy of the iterates where the primal and dual residuals are
+        computed (see get_metric_mask), the residuals of the other iterates are nan
+    rho_bank turns on the adaptive rho (see get_rho_bank and osqp_adaptive_step), it starts at
+        the center rho of the bank (i.e., rho) and factor and rho are not used
+    """
+    z_init = init_osqp(z0, A)
+    if rho_bank is None:
+        step_fn = partial(osqp_step, factor=factor, A=A, q=q, rho=rho, sigma=sigma)
+        state = (z_init,)
     else:
-        diff = jnp.linalg.norm(z_next - z)
-    loss_vec = loss_vec.at[i].set(diff)
-    return z_next, loss_vec
-
+        step_fn = partial(osqp_adaptive_step, rho_bank=rho_bank, P=P, A=A, q=q, sigma=sigma,
+                          acc_dtype=acc_dtype)
+        state = (z_init, init_rho_state(rho_bank))
+    metrics = dict(loss=get_loss_metric(supervised, z_star, acc_dtype))
+    residuals = dict(primal=partial(osqp_primal_residual, A=A, acc_dtype=acc_dtype),
+                     dual=partial(osqp_dual_residual, P=P, A=A, q=q, acc_dtype=acc_dtype))
+    state, metric_vals, history = fixed_point_scan(step_fn, state, 0, k, jit, metrics,
+                                                   record_fn=record_iterate, record=record,
+                                                   anderson=anderson, sparse_metrics=residuals,
+                                                   metric_steps=residual_steps)
+    z_all_plus_1 = stack_history(z_init, history[0], records_z0(k, record))
+    return state[0], metric_vals['loss'], z_all_plus_1, metric_vals['primal'], \
+        metric_vals['dual']
+
+
+def k_steps_tol_osqp(k, z0, q, factor, P, A, rho, sigma, tol, jit, tol_metric='fixed_point',
+                     rho_bank=None, acc_dtype=None):
+    """
+    runs at most k steps of osqp and stops early once the residual given by tol_metric
+        ('fixed_point', 'primal', or 'dual') is below tol
+    rho_bank turns on the adaptive rho (see k_steps_eval_osqp), under vmap its residual
+        check is computed in every step (see osqp_adaptive_step)
 
-def fp_eval_osqp(i, val, supervised, z_star, factor, P, A, q, rho, sigma, lightweight=False):
-    m, n = A.shape
-    z, loss_vec, z_all, primal_residuals, dual_residuals = val
-    z_next = fixed_point_osqp(z, factor, A, q, rho, sigma)
-    if supervised:
-        diff = jnp.linalg.norm(z - z_star)
+    returns (z_final, num_iters, residual)
+    """
+    check_tol_metric(tol_metric)
+    z_init = init_osqp(z0, A)
+    if tol_metric == 'fixed_point':
+        metric = partial(fixed_point_residual, acc_dtype=acc_dtype)
+    elif tol_metric == 'primal':
+        metric = partial(osqp_primal_residual, A=A, acc_dtype=acc_dtype)
     else:
-        diff = jnp.linalg.norm(z_next - z)
-    loss_vec = loss_vec.at[i].set(diff)
-    z_all = z_all.at[i, :].set(z_next)
+        metric = partial(osqp_dual_residual, P=P, A=A, q=q, acc_dtype=acc_dtype)
 
-    # primal and dual residuals
-    if not lightweight:
-        pr = jnp.linalg.norm(A @ z_next[:n] - z_next[n + m:])
-        dr = jnp.linalg.norm(P @ z_next[:n] + A.T @ z_next[n:n + m] + q[:n])
-        primal_residuals = primal_residuals.at[i].set(pr)
-        dual_residuals = dual_residuals.at[i].set(dr)
-    return z_next, loss_vec, z_all, primal_residuals, dual_residuals
+    if rho_bank is None:
+        def step(z):
+            z_next, Ax_next = fixed_point_osqp(z, factor, A, q, rho, sigma, return_Ax=True)
+            return z_next, metric(z, z_next, Ax_next)
+        return run_to_tol(step, z_init, k, tol, jit)
 
+    def adaptive_step(state):
+        state_next, Ax_next = osqp_adaptive_step(state, rho_bank, P, A, q, sigma, acc_dtype)
+        return state_next, metric(state[0], state_next[0], Ax_next)
+    state_final, num_iters, res = run_to_tol(adaptive_step, (z_init, init_rho_state(rho_bank)),
+                                             k, tol, jit)
+    return state_final[0], num_iters, res
 
-def fixed_point_osqp(z, factor, A, q, rho, sigma):
+
+def fixed_point_osqp(z, factor, A, q, rho, sigma, return_Ax=False):
     # z = (x, y, w) w is the z variable in osqp terminology
+    # if return_Ax, A @ x_next is also returned (e.g., for the primal residual)
     m, n = A.shape
     x, y, w = z[:n], z[n:n + m], z[n + m:]
     c, l_bound, u_bound = q[:n], q[n:n + m], q[n + m:]
 
     # update (x, nu)
     rhs = sigma * x - c + A.T @ (rho * w - y)
-    x_next = lin_sys_solve(factor, rhs)
-    nu = rho * (A @ x_next - w) + y
+    x_next = lin_sys_solve(factor, rhs, x0=x)
+    Ax_next = A @ x_next
+    nu = rho * (Ax_next - w) + y
 
     # update w_tilde
     w_tilde = w + (nu - y) / rho
@@ -368,127 +729,96 @@ def fixed_point_osqp(z, factor, A, q, rho, sigma):
     # concatenate into the fixed point vector
     z_next = jnp.concatenate([x_next, y_next, w_next])
 
+    if return_Ax:
+        return z_next, Ax_next
     return z_next
 
 
-def fp_train_ista(i, val, supervised, z_star, A, b, lambd, ista_step):
-    z, loss_vec = val
-    z_next = fixed_point_ista(z, A, b, lambd, ista_step)
-    if supervised:
-        diff = jnp.linalg.norm(z - z_star)
-    else:
-        diff = jnp.linalg.norm(z_next - z)
-    loss_vec = loss_vec.at[i].set(diff)
-    return z_next, loss_vec
-
-
-def fp_train_gd(i, val, supervised, z_star, P, c, gd_step):
-    z, loss_vec = val
-    z_next = fixed_point_gd(z, P, c, gd_step)
-    if supervised:
-        diff = jnp.linalg.norm(z - z_star)
-    else:
-        diff = jnp.linalg.norm(z_next - z)
-    loss_vec = loss_vec.at[i].set(diff)
-    return z_next, loss_vec
-
-
-def fp_train_fista(i, val, supervised, z_star, A, b, lambd, ista_step):
-    z, y, t, loss_vec = val
-    z_next, y_next, t_next = fixed_point_fista(z, y, t, A, b, lambd, ista_step)
-    if supervised:
-        diff = jnp.linalg.norm(z - z_star)
-    else:
-        diff = jnp.linalg.norm(z_next - z)
-    # diff = eval_ista_obj(z_next, A, b, lambd)
-    loss_vec = loss_vec.at[i].set(diff)
-    return z_next, y_next, t_next, loss_vec
+def osqp_step(state, factor, A, q, rho, sigma):
+    """
+    step of the fixed point engine for osqp evaluation: aux = A @ x_next
+    """
+    z_next, Ax_next = fixed_point_osqp(state[0], factor, A, q, rho, sigma, return_Ax=True)
+    return (z_next,), Ax_next
 
 
-def fp_eval_ista(i, val, supervised, z_star, A, b, lambd, ista_step):
-    z, loss_vec, z_all, obj_diffs = val
-    z_next = fixed_point_ista(z, A, b, lambd, ista_step)
-    if supervised:
-        diff = jnp.linalg.norm(z - z_star)
-    else:
-        diff = jnp.linalg.norm(z_next - z)
-    loss_vec = loss_vec.at[i].set(diff)
-    obj = .5 * jnp.linalg.norm(A @ z_next - b) ** 2 + lambd * jnp.linalg.norm(z_next, ord=1)
-    opt_obj = .5 * jnp.linalg.norm(A @ z_star - b) ** 2 + lambd * jnp.linalg.norm(z_star, ord=1)
-    obj_diffs = obj_diffs.at[i].set(obj - opt_obj)
-    z_all = z_all.at[i, :].set(z_next)
-    return z_next, loss_vec, z_all, obj_diffs
-
-
-def fp_eval_gd(i, val, supervised, z_star, P, c, gd_step):
-    z, loss_vec, z_all, obj_diffs = val
-    z_next = fixed_point_gd(z, P, c, gd_step)
-    if supervised:
-        diff = jnp.linalg.norm(z - z_star)
-    else:
-        diff = jnp.linalg.norm(z_next - z)
-    loss_vec = loss_vec.at[i].set(diff)
-    obj = .5 * z_next @ P @ z_next + c @ z_next
-    opt_obj = .5 * z_star @ P @ z_star + c @ z_star
-    obj_diffs = obj_diffs.at[i].set(obj - opt_obj)
-    z_all = z_all.at[i, :].set(z_next)
-    return z_next, loss_vec, z_all, obj_diffs
-
-
-def fp_eval_fista(i, val, supervised, z_star, A, b, lambd, ista_step):
-    z, y, t, loss_vec, z_all = val
-    z_next, y_next, t_next = fixed_point_fista(z, y, t, A, b, lambd, ista_step)
-    if supervised:
-        diff = jnp.linalg.norm(z - z_star)
-    else:
-        diff = jnp.linalg.norm(z_next - z)
-    # diff = eval_ista_obj(z_next, A, b, lambd)
-    loss_vec = loss_vec.at[i].set(diff)
-    z_all = z_all.at[i, :].set(z_next)
-    return z_next, y_next, t_next, loss_vec, z_all
+def osqp_adaptive_step(state, rho_bank, P, A, q, sigma, acc_dtype=None):
+    """
+    step of the fixed point engine for osqp with the adaptive rho:
+        state = (z, rho_state) and aux = A @ x_next
+
+    rho_state = (idx, iters) where idx is the index of the current rho in rho_bank
+        (see get_rho_bank) and iters is the number of steps since the last check
+    every interval steps, rho is multiplied by factor = sqrt(primal / dual) of the relative
+        residuals (see osqp_relative_residuals), rounded to the nearest rho of the bank,
+        if factor is outside [1 / tolerance, tolerance] as in osqp
+    the iterate (x, y, w) is kept when rho changes
+
+    each lane of a vmapped batch keeps its own idx and gathers its factor from the bank, so a
+        rho update is a lookup rather than a refactorization
+    """
+    z, (idx, iters) = state
+    rho_vecs = rho_bank['rho_vecs']
+    factor = get_bank_factor(rho_bank['factors'], idx)
+    z_next, Ax_next = fixed_point_osqp(z, factor, A, q, rho_vecs[idx], sigma, return_Ax=True)
+    iters = iters + 1
+
+    def check():
+        primal_res, dual_res = osqp_relative_residuals(z_next, Ax_next, P, A, q, acc_dtype)
+        log_factor = .5 * (jnp.log(primal_res) - jnp.log(dual_res))
+        shift = jnp.round(log_factor / rho_bank['log_step']).astype(idx.dtype)
+        update = jnp.abs(log_factor) > np.log(rho_bank['tolerance'])
+        return jnp.where(update, jnp.clip(idx + shift, 0, rho_vecs.shape[0] - 1), idx)
+
+    # in a vmapped lax.scan (k_steps_eval_osqp) iters does not depend on the problem, so the
+    #   cond stays a cond and the checks are only done every interval steps
+    # in a vmapped lax.while_loop (k_steps_tol_osqp) the whole carry is batched, the cond
+    #   becomes a select and check runs in every step (two matvecs and the residual norms)
+    checked = iters >= rho_bank['interval']
+    idx = lax.cond(checked, check, lambda: idx)
+    iters = jnp.where(checked, 0, iters)
+    return (z_next, (idx, iters)), Ax_next
+
+
+def init_rho_state(rho_bank):
+    """
+    initial rho_state of osqp_adaptive_step at the center rho of the bank
+    """
+    return jnp.array(rho_bank['rho_vecs'].shape[0] // 2), jnp.array(0)
 
 
-def fp_eval(i, val, q_r, factor, proj, P, A, c, b, hsde, homogeneous, scale_vec, alpha,
-            lightweight=False, verbose=False):
+def osqp_relative_residuals(z, Ax, P, A, q, acc_dtype=None):
     """
-    q_r = r if hsde else q_r = q
-    homogeneous tells us if we set tau = 1.0 or use the root_plus method
+    relative primal and dual residuals of osqp with z = (x, y, w) and Ax = A @ x
+        ||A x - w|| / max(||A x||, ||w||)
+        ||P x + A^T y + c|| / max(||P x||, ||A^T y||, ||c||)
     """
     m, n = A.shape
-    z, z_prev, loss_vec, all_z, all_u, all_v, primal_residuals, dual_residuals = val
-
-    if hsde:
-        r = q_r
-        z_next, u, u_tilde, v = fixed_point_hsde(
-            z, homogeneous, r, factor, proj, scale_vec, alpha, verbose=verbose)
-    else:
-        q = q_r
-        z_next, u, u_tilde, v = fixed_point(z, q, factor, proj, scale_vec, alpha, verbose=verbose)
+    x, y, w, c = z[:n], z[n:n + m], z[n + m:], q[:n]
+    Px, ATy = P @ x, A.T @ y
+    norm = partial(acc_norm, acc_dtype=acc_dtype)
+    primal = norm(Ax - w) / jnp.maximum(jnp.maximum(norm(Ax), norm(w)), 1e-18)
+    dual = norm(Px + ATy + c) / jnp.maximum(
+        jnp.maximum(jnp.maximum(norm(Px), norm(ATy)), norm(c)), 1e-18)
+    return jnp.maximum(primal, 1e-18), jnp.maximum(dual, 1e-18)
 
-    diff = jnp.linalg.norm(z_next / z_next[-1] - z / z[-1])
-    loss_vec = loss_vec.at[i].set(diff)
 
-    # primal and dual residuals
-    if not lightweight:
-        x, y, s = extract_sol(u, v, n, hsde)
-        pr = jnp.linalg.norm(A @ x + s - b)
-        dr = jnp.linalg.norm(A.T @ y + P @ x + c)
-        primal_residuals = primal_residuals.at[i].set(pr)
-        dual_residuals = dual_residuals.at[i].set(dr)
-    all_z = all_z.at[i, :].set(z_next)
-    all_u = all_u.at[i, :].set(u)
-    all_v = all_v.at[i, :].set(v)
-    return z_next, z_prev, loss_vec, all_z, all_u, all_v, primal_residuals, dual_residuals
+def fista_step(state, A, b, lambd, ista_step, gram=False):
+    """
+    step of the fixed point engine for fista: state = (z, y, t)
+    """
+    z, y, t = state
+    return fixed_point_fista(z, y, t, A, b, lambd, ista_step, gram=gram), None
 
 
 def k_steps_train_scs(k, z0, q, factor, supervised, z_star, proj, jit, hsde, m, n, zero_cone_size,
-                      rho_x=1, scale=1, alpha=1.0):
-    iter_losses = jnp.zeros(k)
-    scale_vec = get_scale_vec(rho_x, scale, m, n, zero_cone_size, hsde=hsde)
-
-    fp_train_partial = partial(fp_train, q_r=q, factor=factor,
-                               supervised=supervised, z_star=z_star, proj=proj, hsde=hsde,
-                               homogeneous=True, scale_vec=scale_vec, alpha=alpha)
+                      rho_x=1, scale=1, alpha=1.0, anderson=None, diff_mode='unroll',
+                      segment_length=None, acc_dtype=None):
+    """
+    diff_mode sets how the unrolled iterations are differentiated (see train_scan)
+    """
+    scale_vec = get_scale_vec(rho_x, scale, m, n, zero_cone_size, hsde=hsde).astype(z0.dtype)
+    first_losses = jnp.zeros(0, dtype=get_acc_dtype(acc_dtype, z0))
 
     if hsde:
         # first step: iteration 0
@@ -498,205 +828,203 @@ def k_steps_train_scs(k, z0, q, factor, supervised, z_star, proj, jit, hsde, m,
         homogeneous = False
         z_next, u, u_tilde, v = fixed_point_hsde(
             z0, homogeneous, q, factor, proj, scale_vec, alpha)
-        iter_losses = iter_losses.at[0].set(jnp.linalg.norm(z_next - z0))
+        first_losses = jnp.expand_dims(acc_norm(z_next - z0, acc_dtype), 0)
         z0 = z_next
-    val = z0, iter_losses
-    start_iter = 1 if hsde else 0
-    if jit:
-        out = lax.fori_loop(start_iter, k, fp_train_partial, val)
-    else:
-        out = python_fori_loop(start_iter, k, fp_train_partial, val)
-    z_final, iter_losses = out
-    return z_final, iter_losses
-
-
-def k_steps_train_fista(k, z0, q, lambd, A, ista_step, supervised, z_star, jit):
-    iter_losses = jnp.zeros(k)
-
-    fp_train_partial = partial(fp_train_fista,
-                               supervised=supervised,
-                               z_star=z_star,
-                               A=A,
-                               b=q,
-                               lambd=lambd,
-                               ista_step=ista_step
-                               )
-    val = z0, z0, 1, iter_losses
-    start_iter = 0
-    if jit:
-        out = lax.fori_loop(start_iter, k, fp_train_partial, val)
-    else:
-        out = python_fori_loop(start_iter, k, fp_train_partial, val)
-    z_final, y_final, t_final, iter_losses = out
-    return z_final, iter_losses
-
-
-def k_steps_train_ista(k, z0, q, lambd, A, ista_step, supervised, z_star, jit):
-    iter_losses = jnp.zeros(k)
-
-    fp_train_partial = partial(fp_train_ista,
-                               supervised=supervised,
-                               z_star=z_star,
-                               A=A,
-                               b=q,
-                               lambd=lambd,
-                               ista_step=ista_step
-                               )
-    val = z0, iter_losses
-    start_iter = 0
-    if jit:
-        out = lax.fori_loop(start_iter, k, fp_train_partial, val)
-    else:
-        out = python_fori_loop(start_iter, k, fp_train_partial, val)
-    z_final, iter_losses = out
-    return z_final, iter_losses
-
-
-def k_steps_train_gd(k, z0, q, P, gd_step, supervised, z_star, jit):
-    iter_losses = jnp.zeros(k)
-
-    fp_train_partial = partial(fp_train_gd,
-                               supervised=supervised,
-                               z_star=z_star,
-                               P=P,
-                               c=q,
-                               gd_step=gd_step
-                               )
-    val = z0, iter_losses
-    start_iter = 0
-    if jit:
-        out = lax.fori_loop(start_iter, k, fp_train_partial, val)
-    else:
-        out = python_fori_loop(start_iter, k, fp_train_partial, val)
-    z_final, iter_losses = out
-    return z_final, iter_losses
-
-
-def k_steps_eval_fista(k, z0, q, lambd, A, ista_step, supervised, z_star, jit):
-    iter_losses = jnp.zeros(k)
-    z_all_plus_1 = jnp.zeros((k + 1, z0.size))
-    z_all_plus_1 = z_all_plus_1.at[0, :].set(z0)
-    fp_eval_partial = partial(fp_eval_fista,
-                              supervised=supervised,
-                              z_star=z_star,
-                              A=A,
-                              b=q,
-                              lambd=lambd,
-                              ista_step=ista_step
-                              )
-    z_all = jnp.zeros((k, z0.size))
-    val = z0, z0, 1, iter_losses, z_all
-    start_iter = 0
-    if jit:
-        out = lax.fori_loop(start_iter, k, fp_eval_partial, val)
-    else:
-        out = python_fori_loop(start_iter, k, fp_eval_partial, val)
-    z_final, y_final, t_final, iter_losses, z_all = out
-    z_all_plus_1 = z_all_plus_1.at[1:, :].set(z_all)
-    return z_final, iter_losses, z_all_plus_1
-
-
-def k_steps_eval_ista(k, z0, q, lambd, A, ista_step, supervised, z_star, jit):
-    iter_losses, obj_diffs = jnp.zeros(k), jnp.zeros(k)
-    z_all_plus_1 = jnp.zeros((k + 1, z0.size))
-    z_all_plus_1 = z_all_plus_1.at[0, :].set(z0)
-    fp_eval_partial = partial(fp_eval_ista,
-                              supervised=supervised,
-                              z_star=z_star,
-                              A=A,
-                              b=q,
-                              lambd=lambd,
-                              ista_step=ista_step
-                              )
-    z_all = jnp.zeros((k, z0.size))
-    val = z0, iter_losses, z_all, obj_diffs
-    start_iter = 0
-    if jit:
-        out = lax.fori_loop(start_iter, k, fp_eval_partial, val)
-    else:
-        out = python_fori_loop(start_iter, k, fp_eval_partial, val)
-    z_final, iter_losses, z_all, obj_diffs = out
-    z_all_plus_1 = z_all_plus_1.at[1:, :].set(z_all)
-    return z_final, iter_losses, z_all_plus_1, obj_diffs
-
-
-def k_steps_eval_gd(k, z0, q, P, gd_step, supervised, z_star, jit):
-    iter_losses = jnp.zeros(k)
-    z_all_plus_1 = jnp.zeros((k + 1, z0.size))
-    z_all_plus_1 = z_all_plus_1.at[0, :].set(z0)
-    fp_eval_partial = partial(fp_eval_gd,
-                              supervised=supervised,
-                              z_star=z_star,
-                              P=P,
-                              c=q,
-                              gd_step=gd_step
-                              )
-    z_all = jnp.zeros((k, z0.size))
-    obj_diffs = jnp.zeros(k)
-    val = z0, iter_losses, z_all, obj_diffs
-    start_iter = 0
-    if jit:
-        out = lax.fori_loop(start_iter, k, fp_eval_partial, val)
+
+    step_fn = partial(scs_step, q_r=q, factor=factor, proj=proj, hsde=hsde, homogeneous=True,
+                      scale_vec=scale_vec, alpha=alpha)
+    if supervised:
+        metrics = dict(loss=partial(scs_distance_to_opt, z_star=z_star, acc_dtype=acc_dtype))
     else:
-        out = python_fori_loop(start_iter, k, fp_eval_partial, val)
-    z_final, iter_losses, z_all, obj_diffs = out
-    z_all_plus_1 = z_all_plus_1.at[1:, :].set(z_all)
-    return z_final, iter_losses, z_all_plus_1, obj_diffs
+        metrics = dict(loss=partial(scs_residual, acc_dtype=acc_dtype))
+    start_iter = 1 if hsde else 0
+    state, metric_vals, _ = fixed_point_scan(step_fn, (z0, None), start_iter, k, jit, metrics,
+                                             anderson=anderson, diff_mode=diff_mode,
+                                             segment_length=segment_length)
+    iter_losses = jnp.concatenate([first_losses, metric_vals['loss']])
+    return state[0], iter_losses
+
+
+def k_steps_train_fista(k, z0, q, lambd, A, ista_step, supervised, z_star, jit,
+                        diff_mode='unroll', segment_length=None, gram=False, acc_dtype=None):
+    step_fn = partial(fista_step, A=A, b=q, lambd=lambd, ista_step=ista_step, gram=gram)
+    metrics = dict(loss=get_loss_metric(supervised, z_star, acc_dtype))
+    state = z0, z0, jnp.ones((), dtype=z0.dtype)
+    state, metric_vals, _ = fixed_point_scan(step_fn, state, 0, k, jit, metrics,
+                                             diff_mode=diff_mode, segment_length=segment_length)
+    return state[0], metric_vals['loss']
+
+
+def k_steps_train_ista(k, z0, q, lambd, A, ista_step, supervised, z_star, jit,
+                       diff_mode='unroll', segment_length=None, gram=False, acc_dtype=None):
+    """
+    if gram, A = A^T A and q = A^T b (see fixed_point_ista)
+    """
+    fixed_point_fn = partial(fixed_point_ista, A=A, b=q, lambd=lambd, ista_step=ista_step,
+                             gram=gram)
+    step_fn = partial(single_iterate_step, fixed_point_fn=fixed_point_fn)
+    metrics = dict(loss=get_loss_metric(supervised, z_star, acc_dtype))
+    state, metric_vals, _ = fixed_point_scan(step_fn, (z0,), 0, k, jit, metrics,
+                                             diff_mode=diff_mode, segment_length=segment_length)
+    return state[0], metric_vals['loss']
+
+
+def k_steps_train_gd(k, z0, q, P, gd_step, supervised, z_star, jit, diff_mode='unroll',
+                     segment_length=None, acc_dtype=None):
+    fixed_point_fn = partial(fixed_point_gd, P=P, c=q, gd_step=gd_step)
+    step_fn = partial(single_iterate_step, fixed_point_fn=fixed_point_fn)
+    metrics = dict(loss=get_loss_metric(supervised, z_star, acc_dtype))
+    state, metric_vals, _ = fixed_point_scan(step_fn, (z0,), 0, k, jit, metrics,
+                                             diff_mode=diff_mode, segment_length=segment_length)
+    return state[0], metric_vals['loss']
+
+
+def k_steps_eval_fista(k, z0, q, lambd, A, ista_step, supervised, z_star, jit, record=None,
+                       gram=False, acc_dtype=None):
+    step_fn = partial(fista_step, A=A, b=q, lambd=lambd, ista_step=ista_step, gram=gram)
+    metrics = dict(loss=get_loss_metric(supervised, z_star, acc_dtype))
+    state = z0, z0, jnp.ones((), dtype=z0.dtype)
+    state, metric_vals, history = fixed_point_scan(step_fn, state, 0, k, jit, metrics,
+                                                   record_fn=record_iterate, record=record)
+    z_all_plus_1 = stack_history(z0, history[0], records_z0(k, record))
+    return state[0], metric_vals['loss'], z_all_plus_1
+
+
+def k_steps_eval_ista(k, z0, q, lambd, A, ista_step, supervised, z_star, jit, record=None,
+                      opt_obj=None, gram=False, acc_dtype=None):
+    """
+    opt_obj is the optimal objective, computed from z_star (once, not at every step) if None
+    if gram, A = A^T A and q = A^T b (see fixed_point_ista)
+    """
+    fixed_point_fn = partial(fixed_point_ista, A=A, b=q, lambd=lambd, ista_step=ista_step,
+                             gram=gram)
+    step_fn = partial(single_iterate_step, fixed_point_fn=fixed_point_fn)
+    obj_fn = partial(eval_ista_obj, A=A, b=q, lambd=lambd, gram=gram)
+    if opt_obj is None:
+        opt_obj = obj_fn(z_star)
+    metrics = dict(loss=get_loss_metric(supervised, z_star, acc_dtype),
+                   obj_diff=partial(objective_gap, obj_fn=obj_fn, opt_obj=opt_obj,
+                                    acc_dtype=acc_dtype))
+    state, metric_vals, history = fixed_point_scan(step_fn, (z0,), 0, k, jit, metrics,
+                                                   record_fn=record_iterate, record=record)
+    z_all_plus_1 = stack_history(z0, history[0], records_z0(k, record))
+    return state[0], metric_vals['loss'], z_all_plus_1, metric_vals['obj_diff']
+
+
+def k_steps_eval_gd(k, z0, q, P, gd_step, supervised, z_star, jit, record=None, opt_obj=None,
+                    acc_dtype=None):
+    """
+    opt_obj is the optimal objective, computed from z_star (once, not at every step) if None
+    """
+    fixed_point_fn = partial(fixed_point_gd, P=P, c=q, gd_step=gd_step)
+    step_fn = partial(single_iterate_step, fixed_point_fn=fixed_point_fn)
+    obj_fn = partial(eval_gd_obj, P=P, c=q)
+    if opt_obj is None:
+        opt_obj = obj_fn(z_star)
+    metrics = dict(loss=get_loss_metric(supervised, z_star, acc_dtype),
+                   obj_diff=partial(objective_gap, obj_fn=obj_fn, opt_obj=opt_obj,
+                                    acc_dtype=acc_dtype))
+    state, metric_vals, history = fixed_point_scan(step_fn, (z0,), 0, k, jit, metrics,
+                                                   record_fn=record_iterate, record=record)
+    z_all_plus_1 = stack_history(z0, history[0], records_z0(k, record))
+    return state[0], metric_vals['loss'], z_all_plus_1, metric_vals['obj_diff']
+
+
+def k_steps_tol_ista(k, z0, q, lambd, A, ista_step, tol, jit, gram=False, acc_dtype=None):
+    def step(z):
+        z_next = fixed_point_ista(z, A, q, lambd, ista_step, gram=gram)
+        return z_next, acc_norm(z_next - z, acc_dtype)
+    return run_to_tol(step, z0, k, tol, jit)
+
+
+def k_steps_tol_fista(k, z0, q, lambd, A, ista_step, tol, jit, gram=False, acc_dtype=None):
+    def step(val):
+        z, y, t = val
+        z_next, y_next, t_next = fixed_point_fista(z, y, t, A, q, lambd, ista_step, gram=gram)
+        return (z_next, y_next, t_next), acc_norm(z_next - z, acc_dtype)
+    val_final, num_iters, res = run_to_tol(step, (z0, z0, jnp.ones((), dtype=z0.dtype)), k, tol,
+                                           jit)
+    return val_final[0], num_iters, res
+
+
+def k_steps_tol_gd(k, z0, q, P, gd_step, tol, jit, acc_dtype=None):
+    def step(z):
+        z_next = fixed_point_gd(z, P, q, gd_step)
+        return z_next, acc_norm(z_next - z, acc_dtype)
+    return run_to_tol(step, z0, k, tol, jit)
 
 
 def k_steps_eval_scs(k, z0, q, factor, proj, P, A, supervised, z_star, jit, hsde, zero_cone_size,
-                     rho_x=1, scale=1, alpha=1.0, lightweight=False):
+                     rho_x=1, scale=1, alpha=1.0, lightweight=False, record=None, anderson=None,
+                     psd_state=None, residual_steps=None, q_data=None, scale_bank=None,
+                     acc_dtype=None):
     """
     if k = 500 we store u_1, ..., u_500 and z_0, z_1, ..., z_500
         which is why we have all_z_plus_1
+    record is the iterate-history policy (see get_record_indices)
+        u_i and v_i are stored whenever z_i is stored
+    anderson is None or a dict of anderson acceleration parameters (see anderson_scan)
+    psd_state is the initial warm start if proj is a low-rank projection (see init_psd_state)
+    residual_steps is the policy of the iterates where the primal and dual residuals are
+        computed (see get_metric_mask), the residuals of the other iterates are nan
+    q_data = (c, b) is the problem data that q was solved from (see get_scs_problem_data)
+    scale_bank turns on the adaptive scale (see get_scale_bank and scs_adaptive_step), the
+        first step and q use the center scale of the bank (i.e., scale)
     """
-    all_u, all_z = jnp.zeros((k, z0.size)), jnp.zeros((k, z0.size))
-    all_z_plus_1 = jnp.zeros((k + 1, z0.size))
-    all_z_plus_1 = all_z_plus_1.at[0, :].set(z0)
-    all_v = jnp.zeros((k, z0.size))
-    iter_losses = jnp.zeros(k)
-    primal_residuals, dual_residuals = jnp.zeros(k), jnp.zeros(k)
+    z_init = z0
     m, n = A.shape
-    scale_vec = get_scale_vec(rho_x, scale, m, n, zero_cone_size, hsde=hsde)
+    scale_vec = get_scale_vec(rho_x, scale, m, n, zero_cone_size, hsde=hsde).astype(z0.dtype)
 
     if jit:
         verbose = False
     else:
         verbose = True
 
+    first_losses = jnp.zeros(0, dtype=get_acc_dtype(acc_dtype, z0))
     if hsde:
         # first step: iteration 0
         # we set homogeneous = False for the first iteration
         #   to match the SCS code which has the global variable FEASIBLE_ITERS
         #   which is set to 1
         homogeneous = False
-
-        z_next, u, u_tilde, v = fixed_point_hsde(
-            z0, homogeneous, q, factor, proj, scale_vec, alpha, verbose=verbose)
-        all_z = all_z.at[0, :].set(z_next)
-        all_u = all_u.at[0, :].set(u)
-        all_v = all_v.at[0, :].set(v)
-        iter_losses = iter_losses.at[0].set(jnp.linalg.norm(z_next - z0))
+        (z_next, psd_state), first_aux = scs_step((z0, psd_state), q, factor, proj, hsde,
+                                                  homogeneous, scale_vec, alpha, verbose=verbose)
+        first_records = record_scs(z_next, first_aux)
+        first_losses = jnp.expand_dims(acc_norm(z_next - z0, acc_dtype), 0)
         z0 = z_next
-    # c, b = q[:n], q[n:]
-    M = create_M(P, A)
-    rhs = (M + jnp.diag(scale_vec)) @ q
-    # get_scaled_factor(M, factor)
-    c, b = rhs[:n], rhs[n:]
-    # print('b', b)
-
-    fp_eval_partial = partial(fp_eval, q_r=q, factor=factor,
-                              proj=proj, P=P, A=A, c=c, b=b, hsde=hsde,
-                              homogeneous=True, scale_vec=scale_vec, alpha=alpha,
-                              verbose=verbose)
-    val = z0, z0, iter_losses, all_z, all_u, all_v, primal_residuals, dual_residuals
-    start_iter = 1 if hsde else 0
-    if jit:
-        out = lax.fori_loop(start_iter, k, fp_eval_partial, val)
+    c, b = get_scs_problem_data(q, P, A, scale_vec, q_data)
+
+    if scale_bank is None:
+        step_fn = partial(scs_step, q_r=q, factor=factor, proj=proj, hsde=hsde,
+                          homogeneous=True, scale_vec=scale_vec, alpha=alpha, verbose=verbose)
+        state = (z0, psd_state)
     else:
-        out = python_fori_loop(start_iter, k, fp_eval_partial, val)
-    z_final, z_penult, iter_losses, all_z, all_u, all_v, primal_residuals, dual_residuals = out
-    all_z_plus_1 = all_z_plus_1.at[1:, :].set(all_z)
+        q_data = jnp.concatenate([c, b])
+        step_fn = partial(scs_adaptive_step, scale_bank=scale_bank, q_data=q_data, proj=proj,
+                          P=P, A=A, alpha=alpha, verbose=verbose, acc_dtype=acc_dtype)
+        state = (z0, psd_state, init_scale_state(q, q_data, scale_bank, hsde, anderson,
+                                                 acc_dtype))
+    metrics = dict(loss=partial(scs_residual, acc_dtype=acc_dtype))
+    residuals = dict(primal=partial(scs_primal_residual, A=A, b=b, hsde=hsde,
+                                    acc_dtype=acc_dtype),
+                     dual=partial(scs_dual_residual, P=P, A=A, c=c, hsde=hsde,
+                                  acc_dtype=acc_dtype))
+    start_iter = 1 if hsde else 0
+    state, metric_vals, history = fixed_point_scan(step_fn, state, start_iter, k, jit,
+                                                   metrics, record_fn=record_scs, record=record,
+                                                   anderson=anderson, sparse_metrics=residuals,
+                                                   metric_steps=residual_steps)
+    if hsde:
+        history = record_first_step(history, first_records, k, record)
+    all_z, all_u, all_v = history
+    z_final = state[0]
+    iter_losses = jnp.concatenate([first_losses, metric_vals['loss']])
+
+    # the residuals of the first step are not computed
+    primal_residuals, dual_residuals = [
+        jnp.concatenate([jnp.zeros(start_iter, dtype=x.dtype), x])
+        for x in [metric_vals['primal'], metric_vals['dual']]]
+    all_z_plus_1 = stack_history(z_init, all_z, records_z0(k, record))
 
     # return z_final, iter_losses, primal_residuals, dual_residuals, all_z_plus_1, all_u, all_v
     if lightweight:
@@ -705,6 +1033,59 @@ def k_steps_eval_scs(k, z0, q, factor, proj, P, A, supervised, z_star, jit, hsde
     return z_final, iter_losses, all_z_plus_1, primal_residuals, dual_residuals, all_u, all_v
 
 
+def k_steps_tol_scs(k, z0, q, factor, proj, P, A, tol, jit, hsde, zero_cone_size,
+                    rho_x=1, scale=1, alpha=1.0, tol_metric='fixed_point', psd_state=None,
+                    q_data=None, scale_bank=None, acc_dtype=None):
+    """
+    runs at most k steps of scs and stops early once the residual given by tol_metric
+        ('fixed_point', 'primal', or 'dual') is below tol
+    psd_state is the initial warm start if proj is a low-rank projection (see init_psd_state)
+    q_data = (c, b) is the problem data that q was solved from (see get_scs_problem_data)
+    scale_bank turns on the adaptive scale (see k_steps_eval_scs)
+
+    returns (z_final, num_iters, residual, u_final, v_final)
+    """
+    check_tol_metric(tol_metric)
+    m, n = A.shape
+    scale_vec = get_scale_vec(rho_x, scale, m, n, zero_cone_size, hsde=hsde).astype(z0.dtype)
+    c, b = get_scs_problem_data(q, P, A, scale_vec, q_data)
+    if tol_metric == 'fixed_point':
+        metric = partial(scs_residual, acc_dtype=acc_dtype)
+    elif tol_metric == 'primal':
+        metric = partial(scs_primal_residual, A=A, b=b, hsde=hsde, acc_dtype=acc_dtype)
+    else:
+        metric = partial(scs_dual_residual, P=P, A=A, c=c, hsde=hsde, acc_dtype=acc_dtype)
+
+    if scale_bank is None:
+        step_fn = partial(scs_step, q_r=q, factor=factor, proj=proj, hsde=hsde,
+                          homogeneous=True, scale_vec=scale_vec, alpha=alpha)
+        scale_state = ()
+    else:
+        q_data = jnp.concatenate([c, b])
+        step_fn = partial(scs_adaptive_step, scale_bank=scale_bank, q_data=q_data, proj=proj,
+                          P=P, A=A, alpha=alpha, acc_dtype=acc_dtype)
+        scale_state = (init_scale_state(q, q_data, scale_bank, hsde, acc_dtype=acc_dtype),)
+
+    def step(val):
+        # val = (z, u, v, psd_state) + scale_state
+        z = val[0]
+        state_next, (u, v) = step_fn((z,) + tuple(val[3:]))
+        return (state_next[0], u, v) + tuple(state_next[1:]), metric(z, state_next[0], (u, v))
+
+    val = (z0, jnp.zeros_like(z0), jnp.zeros_like(z0), psd_state) + scale_state
+    start_iter, res = 0, None
+    if hsde and k > 0:
+        # first step is not homogeneous to match SCS (see k_steps_eval_scs), the loop does
+        #   not run if it already reaches tol
+        (z_next, psd_state), (u, v) = scs_step((z0, psd_state), q, factor, proj, hsde, False,
+                                               scale_vec, alpha)
+        val = (z_next, u, v, psd_state) + scale_state
+        start_iter, res = 1, metric(z0, z_next, (u, v))
+    val_final, num_iters, res = run_to_tol(step, val, k - start_iter, tol, jit, res)
+    z_final, u_final, v_final = val_final[:3]
+    return z_final, num_iters + start_iter, res, u_final, v_final
+
+
 def get_scale_vec(rho_x, scale, m, n, zero_cone_size, hsde=True):
     """
     Returns the non-identity DR scaling vector
@@ -741,18 +1122,196 @@ def get_scaled_factor(M, scale_vec):
     """
     scale_vec_diag = jnp.diag(scale_vec)
     factor = jsp.linalg.lu_factor(M + scale_vec_diag)
-
-    # this is to replace the lu factor and use cg
-    # M_plus_scale = M + scale_vec_diag
-    # def lhs_mat(x):
-    #     return M_plus_scale @ x
-    # factor = jit(lhs_mat)
     return factor
 
 
-def get_scaled_vec_and_factor(M, rho_x, scale, m, n, zero_cone_size, hsde=True):
+def get_scaled_vec_and_factor(M, rho_x, scale, m, n, zero_cone_size, hsde=True,
+                              factor_method='lu'):
+    """
+    factor_method is one of
+        'lu': dense lu factorization of M + diag(scale_vec)
+        'ldl': eliminates the dual block and stores the n x n cholesky factor
+            of the quasi-definite system (see QuasiDefiniteFactor)
+        'inverse': explicit inverse, only sensible for small m + n
+        'sparse_ldl': sparse LDL^T factorization computed on the host
+        'cg': matrix-free preconditioned conjugate gradient (nothing is factored)
+        'auto': the fastest of the direct methods above on this machine
+            (see get_fastest_factor)
+    """
     scale_vec = get_scale_vec(rho_x, scale, m, n, zero_cone_size, hsde=hsde)
-    return get_scaled_factor(M, scale_vec), scale_vec
+    P, A = M[:n, :n], -M[n:, :n]
+    if factor_method == 'auto':
+        factor_methods = ['lu', 'ldl', 'sparse_ldl']
+        if m + n <= MAX_INVERSE_SIZE:
+            factor_methods.append('inverse')
+        factors = {method: get_scaled_vec_and_factor(M, rho_x, scale, m, n, zero_cone_size,
+                                                     hsde=hsde, factor_method=method)[0]
+                   for method in factor_methods}
+        factor, factor_method = get_fastest_factor(factors, m + n)
+        return factor, scale_vec
+    if factor_method == 'lu':
+        return get_scaled_factor(M, scale_vec), scale_vec
+    if factor_method == 'ldl':
+        return scs_quasi_definite_factor(P, A, scale_vec), scale_vec
+    if factor_method == 'inverse':
+        return InverseFactor(jnp.linalg.inv(M + jnp.diag(scale_vec))), scale_vec
+    if factor_method == 'sparse_ldl':
+        return scs_sparse_factor(P, A, scale_vec), scale_vec
+    if factor_method == 'cg':
+        return scs_cg_factor(P, A, scale_vec), scale_vec
+    raise ValueError(f"unknown factor_method {factor_method} for scs")
+
+
+def get_adaptive_scale_params(adaptive_scale):
+    """
+    fills in the defaults of the adaptive scale dict (see ADAPTIVE_SCALE_DEFAULTS)
+    adaptive_scale=True gives the defaults
+    """
+    if adaptive_scale is True:
+        adaptive_scale = {}
+    params = dict(ADAPTIVE_SCALE_DEFAULTS)
+    params.update(adaptive_scale)
+    if params['num_scales'] < 1 or params['num_scales'] % 2 == 0:
+        raise ValueError(f"num_scales must be odd, got {params['num_scales']}")
+    if params['scale_range'] < 1 or params['update_factor'] <= 1:
+        raise ValueError("scale_range must be at least 1 and update_factor larger than 1")
+    return params
+
+
+def get_scale_bank(M, rho_x, scale, m, n, zero_cone_size, adaptive_scale, hsde=True,
+                   factor_method='lu'):
+    """
+    factors M + diag(scale_vec) for the num_scales log-spaced scales of the adaptive scale
+        (see get_adaptive_scale_params), the middle one is scale
+
+    returns the dict scale_bank with
+        factors: the factors of the scales stacked along a leading axis
+            (the factor of each scale has the same structure, so 'auto' is not supported)
+        scale_vecs: the (num_scales, m + n) matrix of the scale vectors
+        log_step: log of the ratio of consecutive scales
+        and min_iters, update_factor from the adaptive scale dict
+    """
+    if factor_method == 'auto':
+        raise ValueError("the adaptive scale needs an explicit factor_method, got 'auto'")
+    params = get_adaptive_scale_params(adaptive_scale)
+    num_scales = params['num_scales']
+    log_range = np.log(params['scale_range'])
+    log_offsets = np.linspace(-log_range, log_range, num_scales)
+    log_offsets[num_scales // 2] = 0
+    out = [get_scaled_vec_and_factor(M, rho_x, scale * np.exp(log_offset), m, n,
+                                     zero_cone_size, hsde=hsde, factor_method=factor_method)
+           for log_offset in log_offsets]
+    factors = jax.tree_util.tree_map(lambda *x: jnp.stack(x), *[factor for factor, _ in out])
+    scale_vecs = jnp.stack([scale_vec for _, scale_vec in out])
+    log_step = 2 * log_range / (num_scales - 1) if num_scales > 1 else 1.0
+    return dict(factors=factors, scale_vecs=scale_vecs, log_step=log_step,
+                min_iters=params['min_iters'], update_factor=params['update_factor'])
+
+
+def get_osqp_factor(P, A, rho_vec, sigma, factor_method='lu'):
+    """
+    factors the osqp matrix P + sigma I + A^T diag(rho_vec) A
+
+    factor_method is one of
+        'lu': dense lu factorization
+        'cholesky': dense cholesky factorization (the matrix is positive definite)
+        'inverse': explicit inverse, only sensible for small n
+        'sparse_ldl': sparse LDL^T factorization of the kkt matrix computed on the host
+        'cg': matrix-free preconditioned conjugate gradient (nothing is factored)
+        'auto': the fastest of the direct methods above on this machine
+            (see get_fastest_factor)
+    """
+    m, n = A.shape
+    if factor_method == 'auto':
+        factor_methods = ['lu', 'cholesky', 'sparse_ldl']
+        if n <= MAX_INVERSE_SIZE:
+            factor_methods.append('inverse')
+        factors = {method: get_osqp_factor(P, A, rho_vec, sigma, factor_method=method)
+                   for method in factor_methods}
+        factor, factor_method = get_fastest_factor(factors, n)
+        return factor
+    if factor_method == 'sparse_ldl':
+        return osqp_sparse_factor(P, A, rho_vec, sigma)
+    if factor_method == 'cg':
+        return osqp_cg_factor(P, A, rho_vec, sigma)
+    rho_vec = jnp.broadcast_to(rho_vec, (m,))
+    matrix = form_osqp_matrix(P, A, rho_vec, sigma)
+    if factor_method == 'lu':
+        return jsp.linalg.lu_factor(matrix)
+    if factor_method == 'cholesky':
+        return CholeskyFactor(jnp.linalg.cholesky(matrix))
+    if factor_method == 'inverse':
+        return InverseFactor(jnp.linalg.inv(matrix))
+    raise ValueError(f"unknown factor_method {factor_method} for osqp")
+
+
+def get_adaptive_rho_params(adaptive_rho):
+    """
+    fills in the defaults of the adaptive rho dict (see ADAPTIVE_RHO_DEFAULTS)
+    adaptive_rho=True gives the defaults
+    """
+    if adaptive_rho is True:
+        adaptive_rho = {}
+    params = dict(ADAPTIVE_RHO_DEFAULTS)
+    params.update(adaptive_rho)
+    if params['num_rhos'] < 1 or params['num_rhos'] % 2 == 0:
+        raise ValueError(f"num_rhos must be odd, got {params['num_rhos']}")
+    if params['rho_range'] < 1 or params['tolerance'] <= 1 or params['interval'] < 1:
+        raise ValueError("rho_range and interval must be at least 1 and tolerance larger than 1")
+    return params
+
+
+def get_rho_bank(P, A, rho_vec, sigma, adaptive_rho, factor_method='lu'):
+    """
+    factors P + sigma I + A^T diag(rho_vec) A for the num_rhos log-spaced multiples of rho_vec
+        of the adaptive rho (see get_adaptive_rho_params), the middle one is rho_vec itself
+        so the ratios between the entries of rho_vec (e.g., on the equality rows) are kept
+
+    returns the dict rho_bank with
+        factors: the factors of the rho vectors stacked along a leading axis
+            (the factor of each rho has the same structure, so 'auto' is not supported)
+        rho_vecs: the (num_rhos, m) matrix of the rho vectors
+        log_step: log of the ratio of consecutive rho vectors
+        and interval, tolerance from the adaptive rho dict
+    """
+    if factor_method == 'auto':
+        raise ValueError("the adaptive rho needs an explicit factor_method, got 'auto'")
+    params = get_adaptive_rho_params(adaptive_rho)
+    num_rhos = params['num_rhos']
+    log_range = np.log(params['rho_range'])
+    log_offsets = np.linspace(-log_range, log_range, num_rhos)
+    log_offsets[num_rhos // 2] = 0
+    rho_vec = jnp.broadcast_to(rho_vec, (A.shape[0],))
+    rho_vecs = jnp.stack([rho_vec * np.exp(log_offset) for log_offset in log_offsets])
+    factors = [get_osqp_factor(P, A, rho_vecs[j], sigma, factor_method=factor_method)
+               for j in range(num_rhos)]
+    factors = jax.tree_util.tree_map(lambda *x: jnp.stack(x), *factors)
+    log_step = 2 * log_range / (num_rhos - 1) if num_rhos > 1 else 1.0
+    return dict(factors=factors, rho_vecs=rho_vecs, log_step=log_step,
+                interval=params['interval'], tolerance=params['tolerance'])
+
+
+def get_fastest_factor(factors, size, num_solves=100):
+    """
+    factors is a dict that maps each factor_method to its factor
+    a short benchmark times num_solves jitted solves with each factor
+    returns the fastest factor and its factor_method
+    """
+    b = jnp.ones(size)
+    times = {}
+    for factor_method, factor in factors.items():
+        def body_fn(i, x):
+            return lin_sys_solve(factor, x) + b
+        solves = jit(lambda x: lax.fori_loop(0, num_solves, body_fn, x))
+
+        # compile before timing
+        solves(b).block_until_ready()
+        t0 = time.time()
+        solves(b).block_until_ready()
+        times[factor_method] = time.time() - t0
+    factor_method = min(times, key=times.get)
+    logging.info(f"factor solve times {times}, selected {factor_method}")
+    return factors[factor_method], factor_method
 
 
 def extract_sol(u, v, n, hsde):
@@ -764,7 +1323,7 @@ def extract_sol(u, v, n, hsde):
     return x, y, s
 
 
-def create_projection_fn(cones, n):
+def create_projection_fn(cones, n, psd_rank=None, psd_iters=PSD_SUBSPACE_ITERS):
     """
     cones is a dict with keys
     z: zero cone
@@ -785,37 +1344,57 @@ def create_projection_fn(cones, n):
     i.e. the cartesian product of the zero cone of length n and the dual
         cone of K
     For all of the cones we consider, the cones are self-dual
+
+    if psd_rank is given, the psd cones with more than psd_rank rows are projected with
+        create_low_rank_sdp_proj and the projection becomes
+        Pi(w, psd_state) -> (Pi(w), psd_state)
+        where psd_state holds the warm-start subspaces (see init_psd_state)
     """
     zero_cone, nonneg_cone = cones['z'], cones['l']
-    soc = 'q' in cones.keys() and len(cones['q']) > 0
-    sdp = 's' in cones.keys() and len(cones['s']) > 0
-    if soc:
-        soc_cones_array = jnp.array(cones['q'])
-
-        # soc_proj_sizes, soc_num_proj are lists
-        # need to convert to list so that the item is not a traced object
-        soc_proj_sizes, soc_num_proj = count_num_repeated_elements(soc_cones_array)
-    else:
-        soc_proj_sizes, soc_num_proj = [], []
-    if sdp:
-        sdp_cones_array = jnp.array(cones['s'])
+    soc_sizes = list(cones.get('q', []))
+    sdp_row_sizes = list(cones.get('s', []))
+    sdp_vector_sizes = [int(row_size * (row_size + 1) / 2) for row_size in sdp_row_sizes]
+
+    # start of each cone block in the input
+    start = n + int(zero_cone) + int(nonneg_cone)
+    soc_starts = start + np.cumsum([0] + soc_sizes[:-1]).astype(int)
+    start += sum(soc_sizes)
+    sdp_starts = start + np.cumsum([0] + sdp_vector_sizes[:-1]).astype(int)
+
+    # permute the cone blocks once so that the blocks of the same size are contiguous
+    #   each group is then projected with a single batched op
+    #   the groups keep the order of the first appearance of each size
+    perm = [np.arange(n + int(zero_cone) + int(nonneg_cone))]
+    soc_groups, sdp_groups = [], []
+    for size in dict.fromkeys(soc_sizes):
+        group_starts = soc_starts[np.array(soc_sizes) == size]
+        perm += [group_start + np.arange(size) for group_start in group_starts]
+        soc_groups.append((int(size), group_starts.size))
+    for row_size in dict.fromkeys(sdp_row_sizes):
+        vector_size = int(row_size * (row_size + 1) / 2)
+        group_starts = sdp_starts[np.array(sdp_row_sizes) == row_size]
+        perm += [group_start + np.arange(vector_size) for group_start in group_starts]
+        if psd_rank is not None and psd_rank < row_size:
+            low_rank_proj = create_low_rank_sdp_proj(int(row_size), psd_iters)
+        else:
+            low_rank_proj = None
+        sdp_groups.append((int(row_size), vector_size, group_starts.size, low_rank_proj))
+    perm = np.concatenate(perm).astype(int)
 
-        # soc_proj_sizes, soc_num_proj are lists
-        # need to convert to list so that the item is not a traced object
-        sdp_row_sizes, sdp_num_proj = count_num_repeated_elements(sdp_cones_array)
-        sdp_vector_sizes = [int(row_size * (row_size + 1) / 2) for row_size in sdp_row_sizes]
+    # no gathers are needed if the blocks are already grouped
+    if np.array_equal(perm, np.arange(perm.size)):
+        perm, inv_perm = None, None
     else:
-        sdp_row_sizes, sdp_vector_sizes, sdp_num_proj = [], [], []
+        inv_perm = jnp.array(np.argsort(perm))
+        perm = jnp.array(perm)
 
-    projection = partial(proj,
-                         n=n,
-                         zero_cone_int=int(zero_cone),
+    projection = partial(fused_proj,
+                         perm=perm,
+                         inv_perm=inv_perm,
+                         free_size=n + int(zero_cone),
                          nonneg_cone_int=int(nonneg_cone),
-                         soc_proj_sizes=soc_proj_sizes,
-                         soc_num_proj=soc_num_proj,
-                         sdp_row_sizes=sdp_row_sizes,
-                         sdp_vector_sizes=sdp_vector_sizes,
-                         sdp_num_proj=sdp_num_proj,
+                         soc_groups=tuple(soc_groups),
+                         sdp_groups=tuple(sdp_groups),
                          )
     return jit(projection)
 
@@ -860,10 +1439,15 @@ def root_plus(mu, eta, p, r, scale_vec):
     return (-b + jnp.sqrt(b ** 2 - 4 * a * c)) / (2 * a)
 
 
-def fixed_point_ista(z, A, b, lambd, ista_step):
+def fixed_point_ista(z, A, b, lambd, ista_step, gram=False):
     """
     applies the ista fixed point operator
+
+    if gram, A is the gram matrix A^T A and b is A^T b so that the gradient costs one n x n
+        matvec instead of two m x n matvecs (see ISTAmodel)
     """
+    if gram:
+        return soft_threshold(z + ista_step * (b - A @ z), ista_step * lambd)
     return soft_threshold(z + ista_step * A.T.dot(b - A.dot(z)), ista_step * lambd)
 
 
@@ -875,11 +1459,11 @@ def fixed_point_gd(z, P, c, gd_step):
     return z - gd_step * grad
 
 
-def fixed_point_fista(z, y, t, A, b, lambd, ista_step):
+def fixed_point_fista(z, y, t, A, b, lambd, ista_step, gram=False):
     """
     applies the fista fixed point operator
     """
-    z_next = fixed_point_ista(y, A, b, lambd, ista_step)
+    z_next = fixed_point_ista(y, A, b, lambd, ista_step, gram=gram)
     t_next = .5 * (1 + jnp.sqrt(1 + 4 * t ** 2))
     y_next = z_next + (t - 1) / t_next * (z_next - z)
     return z_next, y_next, t_next
@@ -892,14 +1476,20 @@ def soft_threshold(z, alpha):
     return jnp.clip(jnp.abs(z) - alpha, a_min=0) * jnp.sign(z)
 
 
-def fixed_point(z_init, q, factor, proj, scale_vec, alpha, verbose=False):
+def fixed_point(z_init, q, factor, proj, scale_vec, alpha, verbose=False, psd_state=None):
     """
     implements 1 iteration of algorithm 1 in https://arxiv.org/pdf/2212.08260.pdf
+
+    if psd_state is given, proj is a low-rank projection (see create_projection_fn)
+        and the updated psd_state is returned as a fifth output
     """
     rhs = jnp.multiply(z_init - q, scale_vec)
-    u_tilde = lin_sys_solve(factor, rhs)
+    u_tilde = lin_sys_solve(factor, rhs, x0=z_init - q)
     u_temp = 2 * u_tilde - z_init
-    u = proj(u_temp)
+    if psd_state is None:
+        u = proj(u_temp)
+    else:
+        u, psd_state = proj(u_temp, psd_state)
     v = jnp.multiply(u + z_init - 2 * u_tilde, scale_vec)
     z = z_init + alpha * (u - u_tilde)
     if verbose:
@@ -907,10 +1497,13 @@ def fixed_point(z_init, q, factor, proj, scale_vec, alpha, verbose=False):
         print('u_tilde', u_tilde)
         print('u', u)
         print('z', z)
+    if psd_state is not None:
+        return z, u, u_tilde, v, psd_state
     return z, u, u_tilde, v
 
 
-def fixed_point_hsde(z_init, homogeneous, r, factor, proj, scale_vec, alpha, verbose=False):
+def fixed_point_hsde(z_init, homogeneous, r, factor, proj, scale_vec, alpha, verbose=False,
+                     psd_state=None):
     """
     implements 1 iteration of algorithm 5.1 in https://arxiv.org/pdf/2004.02177.pdf
 
@@ -937,6 +1530,9 @@ def fixed_point_hsde(z_init, homogeneous, r, factor, proj, scale_vec, alpha, ver
     else
         no normalization
         tau_tilde = 1 (bias towards feasibility)
+
+    if psd_state is given, proj is a low-rank projection (see create_projection_fn)
+        and the updated psd_state is returned as a fifth output
     """
 
     if homogeneous:
@@ -949,19 +1545,24 @@ def fixed_point_hsde(z_init, homogeneous, r, factor, proj, scale_vec, alpha, ver
 
     # non identity DR scaling
     rhs = jnp.multiply(scale_vec, mu)
-    p = lin_sys_solve(factor, rhs)
+
+    # mu is the initial guess for iterative solves since p = mu when M = 0
+    p = lin_sys_solve(factor, rhs, x0=mu)
 
     # non identity DR scaling
     # p = jnp.multiply(scale_vec, p)
     if homogeneous:
         tau_tilde = root_plus(mu, eta, p, r, scale_vec)
     else:
-        tau_tilde = 1.0
+        tau_tilde = jnp.array(1.0, dtype=mu.dtype)
     w_tilde = p - r * tau_tilde
 
     # u, tau update
     w_temp = 2 * w_tilde - mu
-    w = proj(w_temp)
+    if psd_state is None:
+        w = proj(w_temp)
+    else:
+        w, psd_state = proj(w_temp, psd_state)
     tau = jnp.clip(2 * tau_tilde - eta, a_min=0)
 
     # mu, eta update
@@ -974,7 +1575,7 @@ def fixed_point_hsde(z_init, homogeneous, r, factor, proj, scale_vec, alpha, ver
     u_tilde = jnp.concatenate([w_tilde, jnp.array([tau_tilde])])
 
     # for s extraction - not needed for algorithm
-    full_scaled_vec = jnp.concatenate([scale_vec, jnp.array([TAU_FACTOR])])
+    full_scaled_vec = jnp.concatenate([scale_vec, jnp.array([TAU_FACTOR], dtype=scale_vec.dtype)])
     v = jnp.multiply(full_scaled_vec,  u + z_init - 2 * u_tilde)
 
     # z and u have size (m + n + 1)
@@ -984,6 +1585,8 @@ def fixed_point_hsde(z_init, homogeneous, r, factor, proj, scale_vec, alpha, ver
         print('u_tilde', u_tilde)
         print('u', u)
         print('z', z)
+    if psd_state is not None:
+        return z, u, u_tilde, v, psd_state
     return z, u, u_tilde, v
 
 
@@ -1001,14 +1604,166 @@ def create_M(P, A):
     return M
 
 
-def lin_sys_solve(factor, b):
+def lin_sys_solve(factor, b, x0=None):
     """
     solves the linear system
     Ax = b
-    where factor is the lu factorization of A
+    where factor is either the lu factorization of A or a factor object with a solve method
+        (e.g. SparseLDLFactor)
+    x0 is an initial guess that only iterative factors (CGFactor) use
     """
+    if hasattr(factor, 'solve'):
+        return factor.solve(b, x0=x0)
     return jsp.linalg.lu_solve(factor, b)
-    # return jsp.sparse.linalg.cg(factor, b)
+
+
+def fused_proj(input, psd_state=None, perm=None, inv_perm=None, free_size=0, nonneg_cone_int=0,
+               soc_groups=(), sdp_groups=()):
+    """
+    projects the input onto the cartesian product of the free (primal) variables, zero cone,
+        non-negative orthant, second order cones, and positive semidefinite cones
+
+    the input is gathered once with perm so that the cones of the same size are contiguous
+        (perm is None if they already are) and every group is projected with one batched op
+    soc_groups: tuple of (size, num_cones) for each distinct second order cone size
+    sdp_groups: tuple of (row_size, vector_size, num_cones, low_rank_proj) for each distinct
+        psd cone size where low_rank_proj is None if the group uses the full eigendecomposition
+    the projected pieces are concatenated and put back in place with the inverse permutation
+
+    psd_state is the tuple of warm-start subspaces of the low-rank groups
+        if it is given, (projection, psd_state) is returned
+    """
+    x = input if perm is None else input[perm]
+    start = free_size + nonneg_cone_int
+    pieces = [x[:free_size], jnp.clip(x[free_size:start], a_min=0)]
+    for size, num_cones in soc_groups:
+        end = start + size * num_cones
+        soc_input = jnp.reshape(x[start:end], (num_cones, size))
+        pieces.append(jnp.ravel(soc_proj_batch(soc_input)))
+        start = end
+    new_psd_state = []
+    for i, (row_size, vector_size, num_cones, low_rank_proj) in enumerate(sdp_groups):
+        end = start + vector_size * num_cones
+        sdp_input = jnp.reshape(x[start:end], (num_cones, vector_size))
+        if low_rank_proj is None:
+            sdp_out = sdp_proj_batch(sdp_input, row_size)
+            new_psd_state.append(None)
+        else:
+            sdp_out, V = low_rank_proj(sdp_input, psd_state[i])
+            new_psd_state.append(V)
+        pieces.append(jnp.ravel(sdp_out))
+        start = end
+    projection = jnp.concatenate(pieces)
+    if inv_perm is not None:
+        projection = projection[inv_perm]
+    if psd_state is None:
+        return projection
+    return projection, tuple(new_psd_state)
+
+
+def soc_proj_batch(X):
+    """
+    branchless projection of each row of X = (s, y) onto the second order cone
+        {(t, y) | ||y||_2 <= t}
+
+    same closed form as soc_projection with jnp.where in place of lax.cond
+    the tiny shift of ||y||_2 keeps the projection (and its gradient) finite at y = 0
+    """
+    s, y = X[:, 0], X[:, 1:]
+    y_norm = jnp.sqrt(jnp.sum(y ** 2, axis=1) + jnp.finfo(X.dtype).tiny)
+
+    # case 1: ||y|| >= |s|, otherwise (s, y) if s >= 0 and (0, 0) if s < 0
+    case1 = y_norm >= jnp.abs(s)
+    val = (s + y_norm) / (2 * y_norm)
+    t = jnp.where(case1, val * y_norm, jnp.where(s >= 0, s, 0.0))
+    alpha = jnp.where(case1, val, jnp.where(s >= 0, 1.0, 0.0))
+    return jnp.concatenate([t[:, None], alpha[:, None] * y], axis=1)
+
+
+def init_psd_state(cones, psd_rank, seed=0):
+    """
+    returns the initial psd_state of the projection from create_projection_fn(cones, n, psd_rank)
+
+    for every group of psd cones of the same size (in the order of create_projection_fn)
+        the state is a random orthonormal basis V with shape (num_cones, row_size, psd_rank)
+        or None if the group uses the full eigendecomposition
+    """
+    if psd_rank is None:
+        return None
+    sdp_row_sizes = list(cones.get('s', []))
+    psd_state = []
+    key = random.PRNGKey(seed)
+    for row_size in dict.fromkeys(sdp_row_sizes):
+        if psd_rank < row_size:
+            num_cones = sdp_row_sizes.count(row_size)
+            key, subkey = random.split(key)
+            V = random.normal(subkey, (num_cones, int(row_size), psd_rank))
+            psd_state.append(jnp.linalg.qr(V)[0])
+        else:
+            psd_state.append(None)
+    return tuple(psd_state)
+
+
+def create_low_rank_sdp_proj(n, num_iters):
+    """
+    returns psd_proj(x_mat, V) -> (x_proj_mat, V_next) that projects each row of x_mat
+        (a vectorized n x n symmetric matrix X) onto the psd cone using only the leading
+        eigenpairs of X
+
+    V (num_cones, n, r) is the subspace of the leading eigenvectors of the previous call
+        we run num_iters restarted block krylov steps from V: a rayleigh-ritz step on
+        span(V, X V) keeps the r largest ritz pairs, so X_proj = V diag(max(evals, 0)) V^T
+
+    the rank estimate r is exceeded if all of the r ritz values are positive (so r should be
+        larger than the expected rank), then we fall back to the full eigendecomposition
+    under vmap the fallback is taken for the whole batch if any matrix exceeds the rank so
+        that lax.cond is not turned into a select that always runs the full eigendecomposition
+    """
+    def low_rank_proj(x_mat, V):
+        X = vmap(unvec_symm, in_axes=(0, None))(x_mat, n)
+        r = V.shape[2]
+
+        def block_krylov_iter(i, val):
+            V, evals = val
+
+            # rayleigh-ritz on span(V, X V), keep the r largest ritz pairs
+            Q = jnp.linalg.qr(jnp.concatenate([V, X @ V], axis=2))[0]
+            evals, W = jnp.linalg.eigh(jnp.swapaxes(Q, 1, 2) @ X @ Q)
+            return Q @ W[:, :, -r:], evals[:, -r:]
+        evals = jnp.zeros((V.shape[0], r), dtype=X.dtype)
+        V, evals = lax.fori_loop(0, num_iters, block_krylov_iter, (V, evals))
+        X_proj = (V * jnp.clip(evals, 0)[:, None, :]) @ jnp.swapaxes(V, 1, 2)
+        exceeded = jnp.any(evals[:, 0] > 0)
+        return vmap(vec_symm)(X_proj), V, exceeded
+
+    def full_proj(x_mat, V):
+        X = vmap(unvec_symm, in_axes=(0, None))(x_mat, n)
+        evals, evecs = jnp.linalg.eigh(X)
+        X_proj = (evecs * jnp.clip(evals, 0)[:, None, :]) @ jnp.swapaxes(evecs, 1, 2)
+
+        # warm start the next call with the leading eigenvectors
+        return vmap(vec_symm)(X_proj), evecs[:, :, -V.shape[2]:]
+
+    @custom_vmap
+    def psd_proj(x_mat, V):
+        x_proj_mat, V_next, exceeded = low_rank_proj(x_mat, V)
+        return lax.cond(exceeded, full_proj, lambda x_mat, V: (x_proj_mat, V_next), x_mat, V)
+
+    @psd_proj.def_vmap
+    def psd_proj_vmap(axis_size, in_batched, x_mat, V):
+        # fold the batch into the cones so that the fallback is decided once for the batch
+        x_batched, V_batched = in_batched
+        if not x_batched:
+            x_mat = jnp.broadcast_to(x_mat, (axis_size,) + x_mat.shape)
+        if not V_batched:
+            V = jnp.broadcast_to(V, (axis_size,) + V.shape)
+        num_cones, r = x_mat.shape[1], V.shape[-1]
+        x_proj_mat, V_next = psd_proj(jnp.reshape(x_mat, (axis_size * num_cones, -1)),
+                                      jnp.reshape(V, (axis_size * num_cones, n, r)))
+        out = (jnp.reshape(x_proj_mat, (axis_size, num_cones, -1)),
+               jnp.reshape(V_next, (axis_size, num_cones, n, r)))
+        return out, (True, True)
+    return psd_proj
 
 
 def proj(input, n, zero_cone_int, nonneg_cone_int, soc_proj_sizes, soc_num_proj, sdp_row_sizes,
@@ -1,6 +1,10 @@
 from functools import partial
 
-from l2ws.algo_steps import k_steps_eval_extragrad, k_steps_train_extragrad
+from l2ws.algo_steps import (
+    k_steps_eval_extragrad,
+    k_steps_tol_extragrad,
+    k_steps_train_extragrad,
+)
 from l2ws.l2ws_model import L2WSmodel
 
 
@@ -28,10 +32,16 @@ class EGmodel(L2WSmodel):
         #                                 eg_step=eg_step, jit=self.jit)
         self.k_steps_train_fn = partial(
             k_steps_train_extragrad, f=f, proj_X=proj_X, proj_Y=proj_Y, n=n, 
-            eg_step=eg_step, jit=self.jit)
+            eg_step=eg_step, jit=self.jit, diff_mode=self.diff_mode,
+            segment_length=self.segment_length, acc_dtype=self.precision['accumulation'])
         self.k_steps_eval_fn = partial(k_steps_eval_extragrad,
                                        f=f, proj_X=proj_X, proj_Y=proj_Y, n=n, 
-                                       eg_step=eg_step, jit=self.jit)
+                                       eg_step=eg_step, jit=self.jit, record=self.record,
+                                       acc_dtype=self.precision['accumulation'])
+        self.k_steps_tol_fn = partial(k_steps_tol_extragrad,
+                                      f=f, proj_X=proj_X, proj_Y=proj_Y, n=n,
+                                      eg_step=eg_step, jit=self.jit,
+                                      acc_dtype=self.precision['accumulation'])
 
         # old
         # self.q_mat_train, self.q_mat_test = input_dict['q_mat_train'], input_dict['q_mat_test']
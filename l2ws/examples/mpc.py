@@ -123,7 +123,8 @@ def setup_probs(setup_cfg):
     # z_stars = jnp.vstack([z_stars_train, z_stars_test])
 
     # osqp_setup_script(theta_mat, q_mat, P, A, output_filename, z_stars=z_stars)
-    osqp_setup_script(theta_mat, q_mat, P, A, output_filename, z_stars=None)
+    osqp_setup_script(theta_mat, q_mat, P, A, output_filename, z_stars=None,
+                      equilibrate=cfg.get("equilibrate", None))
     # import pdb
     # pdb.set_trace()
 
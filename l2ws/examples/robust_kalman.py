@@ -837,7 +837,9 @@ def setup_probs(setup_cfg):
     # scs_instances = []
 
 
-    x_stars, y_stars, s_stars = setup_script(q_mat, thetas, solver, data, cones_dict, output_filename, solve=True)
+    x_stars, y_stars, s_stars = setup_script(q_mat, thetas, solver, data, cones_dict,
+                                             output_filename, solve=True,
+                                             equilibrate=cfg.get("equilibrate", None))
 
     time_limit = cfg.dt * cfg.T
     ts, delt = np.linspace(0, time_limit, cfg.T-1, endpoint=True, retstep=True)
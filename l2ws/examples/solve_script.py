@@ -5,6 +5,7 @@ import matplotlib.pyplot as plt
 import time
 import jax.numpy as jnp
 from l2ws.scs_problem import SCSinstance
+from l2ws.utils.equilibration_utils import get_ruiz_scaling
 import pdb
 import cvxpy as cp
 from scipy.sparse import csc_matrix, save_npz, load_npz
@@ -207,13 +208,17 @@ def direct_osqp_setup_script(theta_mat, q_mat, P, A, output_filename, z_stars=No
     return z_stars
 
 
-def osqp_setup_script(theta_mat, q_mat, P, A, output_filename, z_stars=None):
+def osqp_setup_script(theta_mat, q_mat, P, A, output_filename, z_stars=None, equilibrate=None):
     # def solve_many_probs_cvxpy(A, b_mat, lambd):
     """
     solves many lasso problems where each problem has a different b vector
+
+    if equilibrate is given (True or a dict, see get_ruiz_scaling), the ruiz scaling is saved
+        with the (unscaled) data so that the run scales the problems consistently
     """
     m, n = A.shape
     N = q_mat.shape[0]
+    ruiz = get_ruiz_data(P, A, equilibrate)
 
     # setup cvxpy
     x, w = cp.Variable(n), cp.Variable(m)
@@ -248,7 +253,8 @@ def osqp_setup_script(theta_mat, q_mat, P, A, output_filename, z_stars=None):
         output_filename,
         thetas=jnp.array(theta_mat),
         z_stars=z_stars,
-        q_mat=q_mat
+        q_mat=q_mat,
+        **ruiz
     )
 
     # save solve times
@@ -379,9 +385,28 @@ def gd_setup_script(c_mat, P, output_filename):
     plt.clf()
 
 
-def setup_script(q_mat, theta_mat, solver, data, cones_dict, output_filename, solve=True):
+def get_ruiz_data(P, A, equilibrate, cones=None):
+    """
+    returns the dict of the ruiz scaling (D, E) that is saved with the setup data
+        (empty if equilibrate is None or False)
+    """
+    if not equilibrate:
+        return {}
+    D, E = get_ruiz_scaling(P, A, equilibrate, cones=cones)
+    return dict(ruiz_D=D, ruiz_E=E)
+
+
+def setup_script(q_mat, theta_mat, solver, data, cones_dict, output_filename, solve=True,
+                 equilibrate=None):
+    """
+    solves the scs problems and saves the setup data
+
+    if equilibrate is given (True or a dict, see get_ruiz_scaling), the ruiz scaling is saved
+        with the (unscaled) data so that the run scales the problems consistently
+    """
     N = q_mat.shape[0]
     m, n = data['A'].shape
+    ruiz = get_ruiz_data(data['P'], data['A'], equilibrate, cones=cones_dict)
 
     solve_times = np.zeros(N)
     x_stars = jnp.zeros((N, n))
@@ -425,7 +450,8 @@ def setup_script(q_mat, theta_mat, solver, data, cones_dict, output_filename, so
                     x_stars=x_stars,
                     y_stars=y_stars,
                     s_stars=s_stars,
-                    q_mat=q_mat
+                    q_mat=q_mat,
+                    **ruiz
                 )
     # save the data
     log.info("final saving final data...")
@@ -436,7 +462,8 @@ def setup_script(q_mat, theta_mat, solver, data, cones_dict, output_filename, so
         x_stars=x_stars,
         y_stars=y_stars,
         s_stars=s_stars,
-        q_mat=q_mat
+        q_mat=q_mat,
+        **ruiz
     )
 
     # save solve times
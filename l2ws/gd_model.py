@@ -1,6 +1,6 @@
 from functools import partial
 
-from l2ws.algo_steps import k_steps_eval_gd, k_steps_train_gd
+from l2ws.algo_steps import k_steps_eval_gd, k_steps_tol_gd, k_steps_train_gd
 from l2ws.l2ws_model import L2WSmodel
 
 
@@ -18,6 +18,12 @@ class GDmodel(L2WSmodel):
         n = P.shape[0]
         self.output_size = n
 
-        self.k_steps_train_fn = partial(k_steps_train_gd, P=P, gd_step=gd_step, jit=self.jit)
-        self.k_steps_eval_fn = partial(k_steps_eval_gd, P=P, gd_step=gd_step, jit=self.jit)
+        acc_dtype = self.precision['accumulation']
+        self.k_steps_train_fn = partial(k_steps_train_gd, P=P, gd_step=gd_step, jit=self.jit,
+                                        diff_mode=self.diff_mode,
+                                        segment_length=self.segment_length, acc_dtype=acc_dtype)
+        self.k_steps_eval_fn = partial(k_steps_eval_gd, P=P, gd_step=gd_step, jit=self.jit,
+                                       record=self.record, acc_dtype=acc_dtype)
+        self.k_steps_tol_fn = partial(k_steps_tol_gd, P=P, gd_step=gd_step, jit=self.jit,
+                                      acc_dtype=acc_dtype)
         self.out_axes_length = 5
@@ -2,6 +2,7 @@ from functools import partial
 
 from l2ws.algo_steps import (
     k_steps_eval_ista,
+    k_steps_tol_ista,
     k_steps_train_ista,
 )
 from l2ws.l2ws_model import L2WSmodel
@@ -22,8 +23,42 @@ class ISTAmodel(L2WSmodel):
         m, n = A.shape
         self.output_size = n
 
+        # gram formulation of the kernels (see fixed_point_ista): one n x n matvec with A^T A
+        #   per step instead of two m x n matvecs with A, by default (None) it is used when
+        #   it is cheaper, i.e., n <= 2m
+        #   the rows A^T b are computed for all the problems at the first call of get_q_mat,
+        #   so the gram formulation is not used with streamed training problems
+        self.gram = input_dict.get('gram', None)
+        if self.gram is None:
+            self.gram = n <= 2 * m and self.stream is None
+        if self.gram and self.stream is not None:
+            raise ValueError("the gram formulation needs the training problems on the device")
+        self.A = A
+        self.ATb_mat_train, self.ATb_mat_test = None, None
+        if self.gram:
+            A = A.T @ A
+
+        acc_dtype = self.precision['accumulation']
         self.k_steps_train_fn = partial(k_steps_train_ista, A=A, lambd=lambd, 
-                                        ista_step=ista_step, jit=self.jit)
+                                        ista_step=ista_step, jit=self.jit,
+                                        diff_mode=self.diff_mode,
+                                        segment_length=self.segment_length,
+                                        gram=self.gram, acc_dtype=acc_dtype)
+        self.k_steps_tol_fn = partial(k_steps_tol_ista, A=A, lambd=lambd,
+                                      ista_step=ista_step, jit=self.jit, gram=self.gram,
+                                      acc_dtype=acc_dtype)
         self.k_steps_eval_fn = partial(k_steps_eval_ista, A=A, lambd=lambd, 
-                                       ista_step=ista_step, jit=self.jit)
+                                       ista_step=ista_step, jit=self.jit, record=self.record,
+                                       gram=self.gram, acc_dtype=acc_dtype)
         self.out_axes_length = 5
+
+    def get_q_mat(self, train=True):
+        """
+        returns b_mat, or the rows A^T b in the gram formulation (one gemm for all the problems)
+        """
+        if not self.gram:
+            return super().get_q_mat(train)
+        if self.ATb_mat_train is None:
+            self.ATb_mat_train = self.q_mat_train @ self.A.astype(self.q_mat_train.dtype)
+            self.ATb_mat_test = self.q_mat_test @ self.A.astype(self.q_mat_test.dtype)
+        return self.ATb_mat_train if train else self.ATb_mat_test
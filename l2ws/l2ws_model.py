@@ -2,19 +2,21 @@ import logging
 import time
 from functools import partial
 
+import jax
 import jax.numpy as jnp
-import numpy as np
 import optax
-from jax import jit, random, vmap
-from jax.config import config
-from jaxopt import OptaxSolver
+from jax import jit, lax, random, tree_util, value_and_grad, vmap
 
-from l2ws.algo_steps import create_eval_fn, create_train_fn, lin_sys_solve
+from l2ws.algo_steps import create_eval_fn, create_tol_fn, create_train_fn, lin_sys_solve
+from l2ws.utils.data_utils import BatchStream, get_stream_params
+from l2ws.utils.generic_utils import cut_batch, get_bucket_size, pad_batch
+from l2ws.utils.grad_utils import check_diff_mode
+from l2ws.utils.lr_schedule_utils import get_lr_schedule_params, init_lr_state, update_lr
 from l2ws.utils.nn_utils import init_network_params, predict_y
+from l2ws.utils.precision_utils import cast_floating, enable_precision, get_precision_policy
 
 # from l2ws.scs_model import SCSmodel
 # from l2ws.scs_model import SCSmodel
-config.update("jax_enable_x64", True)
 
 
 class L2WSmodel(object):
@@ -38,12 +40,50 @@ class L2WSmodel(object):
                  algo_dict={}):
         dict = algo_dict
 
+        # precision policy (see l2ws/utils/precision_utils.py): the static data of the algorithm
+        #   is cast to the compute dtype, the datasets and factors to the storage dtype
+        self.precision = get_precision_policy(dict.get('precision', 'float64'))
+        enable_precision(self.precision)
+
+        # streaming of the training problems (None keeps them on the device), a dict with the
+        #   keys of STREAM_DEFAULTS in l2ws/utils/data_utils.py (True gives the defaults)
+        #   the training arrays stay on the host (e.g., memory-mapped) and train_stream puts
+        #   the batches on the device a chunk at a time, the dynamic factors of the training
+        #   problems are then computed for each batch with factors_fn(q_rows)
+        self.stream = dict.get('stream', None)
+        if self.stream is not None:
+            self.stream = get_stream_params(self.stream)
+        self.factors_fn = dict.get('factors_fn', None)
+        self.batch_stream, self.train_chunk_fn = None, None
+        host_dict = {key: dict.pop(key) for key in ['q_mat_train', 'b_mat_train', 'c_mat_train']
+                     if self.stream is not None and key in dict}
+        dict = cast_floating(dict, self.precision['compute'])
+        dict.update(host_dict)
+
         # essential pieces for the model
         self.initialize_essentials(jit, eval_unrolls, train_unrolls, train_inputs, test_inputs)
 
         # set defaults
         self.set_defaults()
 
+        # iterate-history recording policy of the eval kernels (None records every iterate)
+        self.record = dict.get('record', None)
+
+        # anderson acceleration of the fixed point iterations (None turns it off)
+        #   a dict with the keys of ANDERSON_DEFAULTS in l2ws/utils/anderson_utils.py
+        self.anderson = dict.get('anderson', None)
+
+        # how the training unrolls are differentiated, one of DIFF_MODES in
+        #   l2ws/utils/grad_utils.py ('checkpoint' recomputes segments of segment_length steps)
+        self.diff_mode = dict.get('diff_mode', 'unroll')
+        self.segment_length = dict.get('segment_length', None)
+
+        # the evaluation batches are padded to power of two sizes (see bucket_loss_fn) so that
+        #   a few executables serve every batch size, bucket_counts counts the hits and misses
+        self.bucket_batches = dict.get('bucket_batches', True)
+        self.bucketed_fns, self.bucket_keys = {}, set()
+        self.bucket_counts = {'hits': 0, 'misses': 0}
+
         # initialize algorithm specifics
         self.initialize_algo(dict)
 
@@ -54,6 +94,7 @@ class L2WSmodel(object):
         # self.setup_optimal_solutions(dict)
         self.setup_optimal_solutions(z_stars_train, z_stars_test, x_stars_train, x_stars_test, 
                                      y_stars_train, y_stars_test)
+        self.cast_to_storage()
 
         # create_all_loss_fns
         self.create_all_loss_fns(loss_method, regression)
@@ -77,6 +118,23 @@ class L2WSmodel(object):
             self.q_mat_test = self.theta_mat_test
 
 
+    def cast_to_storage(self):
+        """
+        casts the datasets and the factors to the storage dtype of the precision policy
+            (they are cast to the compute dtype inside the jitted loss functions)
+        """
+        storage = self.precision['storage']
+        for name in ['train_inputs', 'test_inputs', 'q_mat_train', 'q_mat_test',
+                     'z_stars_train', 'z_stars_test', 'x_stars_train', 'x_stars_test',
+                     'y_stars_train', 'y_stars_test', 'factor_static', 'factors_train',
+                     'factors_test']:
+            # the streamed training arrays are cast chunk by chunk (see BatchStream)
+            if self.stream is not None and name.endswith('_train'):
+                continue
+            if getattr(self, name, None) is not None:
+                setattr(self, name, cast_floating(getattr(self, name), storage))
+
+
     def set_defaults(self):
         # unless turned off in the subclass, these are the default settings
         self.factors_required = False
@@ -99,7 +157,10 @@ class L2WSmodel(object):
                                 x_stars_test=None, y_stars_train=None, y_stars_test=None):
         # if dict.get('z_stars_train', None) is not None:
         if z_stars_train is not None:
-            self.z_stars_train = jnp.array(z_stars_train) # jnp.array(dict['z_stars_train'])
+            if self.stream is not None:
+                self.z_stars_train = z_stars_train
+            else:
+                self.z_stars_train = jnp.array(z_stars_train) # jnp.array(dict['z_stars_train'])
             self.z_stars_test = jnp.array(z_stars_test) # jnp.array(dict['z_stars_test'])
         else:
             self.z_stars_train, self.z_stars_test = None, None
@@ -109,9 +170,12 @@ class L2WSmodel(object):
         loss_method = self.loss_method
 
         def predict(params, input, q, iters, z_star, factor):
+            input, q, z_star, factor = cast_floating((input, q, z_star, factor),
+                                                     self.precision['compute'])
+            eval_kwargs = {}
             if self.algo == 'scs':
-                # q = lin_sys_solve(self.factor, q)
-                q = lin_sys_solve(factor, q)
+                # the eval kernel reads c and b for the residuals from the problem data
+                eval_kwargs['q_data'], q = self.solve_q(q, factor)
             else:
                 pass
             # z0, alpha = self.predict_warm_start(params, input, bypass_nn, hsde=hsde)
@@ -151,13 +215,15 @@ class L2WSmodel(object):
                                        q=q,
                                        factor=factor,
                                        supervised=supervised,
-                                       z_star=z_star)
+                                       z_star=z_star,
+                                       **eval_kwargs)
                 else:
                     eval_out = eval_fn(k=iters,
                                        z0=z0,
                                        q=q,
                                        supervised=supervised,
-                                       z_star=z_star)
+                                       z_star=z_star,
+                                       **eval_kwargs)
                 z_final, iter_losses, z_all_plus_1 = eval_out[0], eval_out[1], eval_out[2]
 
                 # compute angle(z^{k+1} - z^k, z^k - z^{k-1})
@@ -176,35 +242,271 @@ class L2WSmodel(object):
         loss_fn = self.predict_2_loss(predict, diff_required)
         return loss_fn
 
-    def train_batch(self, batch_indices, params, state):
-        batch_inputs = self.train_inputs[batch_indices, :]
-        batch_q_data = self.q_mat_train[batch_indices, :]
-        batch_z_stars = self.z_stars_train[batch_indices, :] if self.supervised else None
+    def create_tol_loss_fn(self, bypass_nn):
+        """
+        creates the batched and jitted version of self.tol_fn
+        the arguments are (params, inputs, b, iters, tols) with factors appended
+            in the case where the factors change for each problem
+        """
+        def predict(params, input, q, iters, tol, factor):
+            input, q, factor = cast_floating((input, q, factor), self.precision['compute'])
+            tol_kwargs = {}
+            if self.algo == 'scs':
+                tol_kwargs['q_data'], q = self.solve_q(q, factor)
+            z0 = self.predict_warm_start(params, input, bypass_nn)
+
+            if self.factors_required:
+                return self.tol_fn(k=iters, z0=z0, q=q, tol=tol, factor=factor, **tol_kwargs)
+            return self.tol_fn(k=iters, z0=z0, q=q, tol=tol)
 
         if self.factors_required and not self.factor_static_bool:
-            # for only the case where the factors are needed
-            # batch_factors = self.factors[batch_indices, :, :]
-            batch_factors = (self.factors_train[0][batch_indices,
-                             :, :], self.factors_train[1][batch_indices, :])
-            results = self.optimizer.update(params=params,
-                                            state=state,
-                                            inputs=batch_inputs,
-                                            b=batch_q_data,
-                                            iters=self.train_unrolls,
-                                            z_stars=batch_z_stars,
-                                            factors=batch_factors)
+            batch_predict = vmap(predict, in_axes=(None, 0, 0, None, 0, (0, 0)))
+
+            @partial(jit, static_argnums=(3,))
+            def tol_loss_fn(params, inputs, b, iters, tols, factors):
+                return batch_predict(params, inputs, b, iters, tols, factors)
         else:
-            # for either of the following cases
-            #   1. factors needed, but are the same for all problems
-            #   2. no factors are needed
-            results = self.optimizer.update(params=params,
-                                            state=state,
-                                            inputs=batch_inputs,
-                                            b=batch_q_data,
-                                            iters=self.train_unrolls,
-                                            z_stars=batch_z_stars)
-        params, state = results
-        return state.value, params, state
+            predict_partial = partial(predict, factor=self.factor_static)
+            batch_predict = vmap(predict_partial, in_axes=(None, 0, 0, None, 0))
+
+            @partial(jit, static_argnums=(3,))
+            def tol_loss_fn(params, inputs, b, iters, tols):
+                return batch_predict(params, inputs, b, iters, tols)
+        return tol_loss_fn
+
+    def solve_q(self, q, factor):
+        """
+        returns (q, r) where r = (I + M)^{-1} q is the vector the scs kernels iterate with
+        q is either the problem data or the pair (q, r) if r is cached (see get_q_mat)
+        """
+        if isinstance(q, tuple):
+            return q
+        return q, lin_sys_solve(factor, q)
+
+    def get_q_mat(self, train=True):
+        """
+        returns the problem data of the train (or test) problems that is passed as b to the
+            loss functions, either q_mat or a tuple of arrays with one row per problem
+        """
+        return self.q_mat_train if train else self.q_mat_test
+
+    def set_optimizer(self):
+        """
+        creates the optax optimizer and initializes the state (opt_state, lr_state)
+        the learning rate is a hyperparameter of opt_state that the schedule (see
+            l2ws/utils/lr_schedule_utils.py) updates from lr_state after every epoch, so the
+            jitted training blocks of train_epochs are compiled once
+        """
+        if self.optimizer_method == 'adam':
+            optimizer_fn = optax.adam
+        elif self.optimizer_method == 'sgd':
+            optimizer_fn = optax.sgd
+        self.optimizer = optax.inject_hyperparams(optimizer_fn)(learning_rate=self.lr)
+        self.state = (self.optimizer.init(self.params),
+                      init_lr_state(self.lr_schedule, self.precision['accumulation']))
+        self.train_epochs_fns = {}
+
+    def update_lr(self, state, epoch_loss):
+        """
+        sets the learning rate of the next epoch in the state given the mean training loss of
+            the epoch that just finished
+        """
+        opt_state, lr_state = state
+        lr, lr_state = update_lr(opt_state.hyperparams['learning_rate'], lr_state, epoch_loss,
+                                 self.lr_schedule)
+        hyperparams = dict(opt_state.hyperparams, learning_rate=lr)
+        return opt_state._replace(hyperparams=hyperparams), lr_state
+
+    def get_lr(self):
+        """
+        returns the current learning rate
+        """
+        return float(self.state[0].hyperparams['learning_rate'])
+
+    def get_epoch_decay_points(self):
+        """
+        returns the list of epochs at which the plateau schedule decayed the learning rate
+        """
+        lr_state = self.state[1]
+        return [int(epoch) for epoch in lr_state['decay_epochs'][:int(lr_state['num_decays'])]]
+
+    def get_train_data(self):
+        """
+        returns the training arrays with one row per problem as the pytree
+            (inputs, q_data, z_stars, factors), z_stars is None if not supervised and factors
+            is None unless the factors change from problem to problem
+        """
+        z_stars = self.z_stars_train if self.supervised else None
+        factors = None
+        if self.factors_required and not self.factor_static_bool:
+            factors = self.factors_train
+        return self.train_inputs, self.get_q_mat(True), z_stars, factors
+
+    def train_step(self, batch, params, state):
+        """
+        one optimizer step on batch, a slice of the pytree of get_train_data
+        returns (loss, params, state)
+        """
+        batch_inputs, batch_q_data, batch_z_stars, batch_factors = batch
+        factors = {} if batch_factors is None else dict(factors=batch_factors)
+        loss, grads = value_and_grad(self.loss_fn_train)(params, batch_inputs, batch_q_data,
+                                                         self.train_unrolls, batch_z_stars,
+                                                         **factors)
+        opt_state, lr_state = state
+        updates, opt_state = self.optimizer.update(grads, opt_state, params)
+        return loss, optax.apply_updates(params, updates), (opt_state, lr_state)
+
+    def train_batch(self, batch_indices, params, state):
+        """
+        one optimizer step on the training problems batch_indices
+        returns (loss, params, state)
+        """
+        batch = tree_util.tree_map(lambda x: x[batch_indices, ...], self.get_train_data())
+        return self.train_step(batch, params, state)
+
+    def train_epochs(self, params, state, key, num_epochs):
+        """
+        runs num_epochs epochs of num_batches optimizer steps in one jitted function
+        each epoch draws a permutation of the training problems from key (carried in the loop),
+            reorders the training arrays once, and its batches are contiguous slices of them
+            (the N_train % batch_size problems left over in an epoch are skipped)
+        the learning rate schedule is applied at the end of each epoch (see update_lr)
+        params and state are donated, so the updated ones are written in place and the inputs
+            must not be used afterwards
+        returns (params, state, key, losses) where losses is the device array of the
+            num_epochs * num_batches batch losses
+        """
+        train_epochs_fn = self.get_train_epochs_fn(num_epochs)
+        return train_epochs_fn(params, state, key, self.get_train_data())
+
+    def get_train_epochs_fn(self, num_epochs):
+        """
+        returns the jitted training block of train_epochs for num_epochs epochs with the
+            arguments (params, state, key, data) where data is the pytree of get_train_data
+        """
+        if num_epochs not in self.train_epochs_fns:
+            def train_epochs_fn(params, state, key, data):
+                def epoch_body(carry, _):
+                    params, state, key = carry
+                    key, subkey = random.split(key)
+                    permutation = random.permutation(subkey, self.N_train)
+                    epoch_data = tree_util.tree_map(lambda x: x[permutation, ...], data)
+
+                    def batch_body(carry, batch_num):
+                        batch = tree_util.tree_map(
+                            lambda x: lax.dynamic_slice_in_dim(x, batch_num * self.batch_size,
+                                                               self.batch_size), epoch_data)
+                        loss, params, state = self.train_step(batch, *carry)
+                        return (params, state), loss
+                    (params, state), losses = lax.scan(batch_body, (params, state),
+                                                       jnp.arange(self.num_batches))
+                    state = self.update_lr(state, losses.mean())
+                    return (params, state, key), losses
+                (params, state, key), losses = lax.scan(epoch_body, (params, state, key), None,
+                                                        length=num_epochs)
+                return params, state, key, losses.reshape(-1)
+            self.train_epochs_fns[num_epochs] = jit(train_epochs_fn, donate_argnums=(0, 1))
+        return self.train_epochs_fns[num_epochs]
+
+    def train_stream(self, params, state, num_epochs):
+        """
+        the streamed counterpart of train_epochs: trains num_epochs epochs on the chunks of
+            self.batch_stream (created at the first call), each chunk is trained by one
+            jitted function while the next ones are prepared on the host
+        the epochs must be a whole number of chunks, params and state are donated
+        returns (params, state, losses) where losses is the device array of the
+            num_epochs * num_batches batch losses
+        """
+        chunk_batches = self.stream['chunk_batches'] or self.num_batches
+        num_chunks, remainder = divmod(num_epochs * self.num_batches, chunk_batches)
+        if remainder != 0:
+            raise ValueError("the epochs of a training block must be a whole number of chunks")
+        if self.batch_stream is None:
+            self.batch_stream = BatchStream(self.get_train_data(), self.batch_size,
+                                            chunk_batches, dtype=self.precision['storage'],
+                                            seed=self.stream['seed'],
+                                            buffer_size=self.stream['buffer_size'])
+        if self.train_chunk_fn is None:
+            self.train_chunk_fn = jit(self.create_train_chunk_fn(), donate_argnums=(0, 1))
+
+        chunk_losses = []
+        for _ in range(num_chunks):
+            chunk, epoch_ends = self.batch_stream.next_chunk()
+            params, state, losses = self.train_chunk_fn(params, state, chunk, epoch_ends)
+            chunk_losses.append(losses)
+        return params, state, jnp.concatenate(chunk_losses)
+
+    def close_stream(self):
+        """
+        stops the prefetch thread of self.batch_stream and frees its chunks on the device
+        a later call of train_stream starts a new stream from the seed of the stream dict
+        """
+        if self.batch_stream is not None:
+            self.batch_stream.close()
+            self.batch_stream = None
+
+    def create_train_chunk_fn(self):
+        """
+        returns the training function of a streamed chunk (params, state, chunk, epoch_ends)
+            -> (params, state, losses), a lax.scan over the batches of the chunk
+        the learning rate schedule is applied after the batches in epoch_ends with the mean of
+            the batch losses of the epoch (summed in the lr_state across chunks)
+        """
+        def end_epoch(state):
+            opt_state, lr_state = state
+            epoch_loss = lr_state['batch_loss_sum'] / self.num_batches
+            lr_state = dict(lr_state, batch_loss_sum=jnp.zeros_like(lr_state['batch_loss_sum']))
+            return self.update_lr((opt_state, lr_state), epoch_loss)
+
+        def train_chunk_fn(params, state, chunk, epoch_ends):
+            def batch_body(carry, xs):
+                params, state = carry
+                batch, epoch_end = xs
+                batch_inputs, batch_q_data, batch_z_stars, batch_factors = batch
+                if batch_factors is None and self.factors_fn is not None:
+                    batch_factors = self.factors_fn(batch_q_data)
+                batch = batch_inputs, batch_q_data, batch_z_stars, batch_factors
+                loss, params, (opt_state, lr_state) = self.train_step(batch, params, state)
+                batch_loss_sum = lr_state['batch_loss_sum'] + loss
+                state = opt_state, dict(lr_state, batch_loss_sum=batch_loss_sum)
+                state = lax.cond(epoch_end, end_epoch, lambda state: state, state)
+                return (params, state), loss
+            (params, state), losses = lax.scan(batch_body, (params, state), (chunk, epoch_ends))
+            return params, state, losses
+        return train_chunk_fn
+
+    def get_compile_jobs(self, num_epochs, eval_unrolls, eval_args):
+        """
+        returns the (name, jitted fn, args) of the executables of a run, so that
+            fn.lower(*args).compile() compiles the executable the run later calls
+            (see l2ws/utils/compile_utils.py)
+            eval_<name>: evaluate at eval_unrolls, eval_args maps name to the arguments
+                (inputs, b, z_stars, fixed_ws, factors) that evaluate is called with
+            short_test_eval: short_test_eval at train_unrolls
+            train_epochs: the training block of num_epochs epochs
+        the training block is last since its params and state are donated
+        """
+        jobs = []
+        for name, (inputs, b, z_stars, fixed_ws, factors) in eval_args.items():
+            args = (self.params, inputs, b, eval_unrolls, z_stars)
+            if self.factors_required and not self.factor_static_bool:
+                args = args + (factors,)
+            if fixed_ws:
+                jobs += self.get_bucketed_jobs(f"eval_{name}", 'fixed_ws',
+                                               self.loss_fn_fixed_ws, args)
+            else:
+                jobs += self.get_bucketed_jobs(f"eval_{name}", 'eval', self.loss_fn_eval, args)
+
+        args = (self.params, self.test_inputs, self.get_q_mat(False), self.train_unrolls,
+                self.z_stars_test)
+        if self.factors_required and not self.factor_static_bool:
+            args = args + (self.factors_test,)
+        jobs += self.get_bucketed_jobs('short_test_eval', 'eval', self.loss_fn_eval, args)
+
+        if self.stream is None:
+            train_args = (self.params, self.state, random.PRNGKey(0), self.get_train_data())
+            jobs.append(('train_epochs', self.get_train_epochs_fn(num_epochs), train_args))
+        return jobs
 
     def evaluate(self, k, inputs, b, z_stars, fixed_ws, factors=None, tag='test', light=False):
         if self.factors_required and not self.factor_static_bool:
@@ -213,6 +515,34 @@ class L2WSmodel(object):
         else:
             return self.static_eval(k, inputs, b, z_stars, tag=tag, fixed_ws=fixed_ws, light=light)
 
+    def evaluate_to_tol(self, k, inputs, b, tol, fixed_ws=False, factors=None):
+        """
+        runs at most k steps for each problem and stops once every problem has a
+            residual below tol
+        tol is either a scalar or a vector with one tolerance per problem
+
+        returns (num_iters, tol_out, time_per_prob)
+            num_iters has the number of iterations taken for each problem
+            time_per_prob is per real problem (the padded rows of the bucket are not counted)
+            tol_out is the batched output of self.tol_fn, (z_final, num_iters, residual, ...)
+        """
+        if fixed_ws:
+            curr_tol_fn = self.loss_fn_tol_fixed_ws
+        else:
+            curr_tol_fn = self.loss_fn_tol
+        num_probs, _ = inputs.shape
+        tols = jnp.broadcast_to(jnp.asarray(tol, dtype=float), (num_probs,))
+
+        test_time0 = time.time()
+
+        if self.factors_required and not self.factor_static_bool:
+            tol_out = curr_tol_fn(self.params, inputs, b, k, tols, factors)
+        else:
+            tol_out = curr_tol_fn(self.params, inputs, b, k, tols)
+        time_per_prob = (time.time() - test_time0)/num_probs
+
+        return tol_out[1], tol_out, time_per_prob
+
     def short_test_eval(self):
         # z_stars_test = self.z_stars_test if self.supervised else None
         z_stars_test = self.z_stars_test
@@ -220,13 +550,13 @@ class L2WSmodel(object):
         if self.factors_required and not self.factor_static_bool:
             test_loss, test_out, time_per_prob = self.dynamic_eval(self.train_unrolls,
                                                                    self.test_inputs,
-                                                                   self.q_mat_test,
+                                                                   self.get_q_mat(False),
                                                                    z_stars_test,
                                                                    factors=self.factors_test)
         else:
             test_loss, test_out, time_per_prob = self.static_eval(self.train_unrolls,
                                                                   self.test_inputs,
-                                                                  self.q_mat_test,
+                                                                  self.get_q_mat(False),
                                                                   z_stars_test)
 
         self.te_losses.append(test_loss)
@@ -297,16 +627,9 @@ class L2WSmodel(object):
         self.epochs, self.lr = nn_cfg.get('epochs', 10), nn_cfg.get('lr', 1e-3)
         self.decay_lr, self.min_lr = nn_cfg.get('decay_lr', False), nn_cfg.get('min_lr', 1e-7)
 
-        # auto-decay learning rate
-        # self.plateau_decay = input_dict.get('plateau_decay')
-        self.plateau_decay = plateau_decay
-
-        if self.plateau_decay is None:
-            self.plateau_decay = dict(min_lr=1e-7, decay_factor=5,
-                                      avg_window_size=50, tolerance=1e-2, patience=2)
-
-        self.dont_decay_until = 2 * self.plateau_decay.get('avg_window_size', 10)
-        self.epoch_decay_points = []
+        # learning rate schedule (constant, plateau, cosine or step)
+        self.lr_schedule = get_lr_schedule_params(nn_cfg, plateau_decay)
+        self.plateau_decay = self.lr_schedule['plateau']
 
         # batching
         batch_size = nn_cfg.get('batch_size', self.N_train)
@@ -325,39 +648,12 @@ class L2WSmodel(object):
         layer_sizes = [input_size] + hidden_layer_sizes + [output_size]
 
         # initialize weights of neural network
-        self.params = init_network_params(layer_sizes, random.PRNGKey(0))
+        self.params = cast_floating(init_network_params(layer_sizes, random.PRNGKey(0)),
+                                    self.precision['compute'])
 
         # initializes the optimizer
         self.optimizer_method = nn_cfg.get('method', 'adam')
-        if self.optimizer_method == 'adam':
-            self.optimizer = OptaxSolver(opt=optax.adam(
-                self.lr), fun=self.loss_fn_train, has_aux=False)
-        elif self.optimizer_method == 'sgd':
-            self.optimizer = OptaxSolver(opt=optax.sgd(
-                self.lr), fun=self.loss_fn_train, has_aux=False)
-        # self.state = self.optimizer.init_state(self.params)
-
-        # Initialize state with first elements of training data as inputs
-        batch_indices = jnp.arange(self.N_train)
-        input_init = self.train_inputs[batch_indices, :]
-        q_init = self.q_mat_train[batch_indices, :]
-        z_stars_init = self.z_stars_train[batch_indices, :] if self.supervised else None
-
-        if self.factors_required and not self.factor_static_bool:
-            batch_factors = (self.factors_train[0][batch_indices, :, :], 
-                             self.factors_train[1][batch_indices, :])
-            self.state = self.optimizer.init_state(init_params=self.params,
-                                                   inputs=input_init,
-                                                   b=q_init,
-                                                   iters=self.train_unrolls,
-                                                   z_stars=z_stars_init,
-                                                   factors=batch_factors)
-        else:
-            self.state = self.optimizer.init_state(init_params=self.params,
-                                                   inputs=input_init,
-                                                   b=q_init,
-                                                   iters=self.train_unrolls,
-                                                   z_stars=z_stars_init)
+        self.set_optimizer()
 
     # def setup_share_all(self, dict):
     #     if self.share_all:
@@ -392,16 +688,24 @@ class L2WSmodel(object):
         # to describe the final loss function (not the end-to-end loss fn)
         self.loss_method = loss_method
         self.supervised = supervised
+        check_diff_mode(self.diff_mode, loss_method)
 
         if not hasattr(self, 'train_fn') and not hasattr(self, 'k_steps_train_fn'):
             train_fn = create_train_fn(self.fixed_point_fn)
             eval_fn = create_eval_fn(self.fixed_point_fn)
-            self.train_fn = partial(train_fn, jit=self.jit)
-            self.eval_fn = partial(eval_fn, jit=self.jit)
+            tol_fn = create_tol_fn(self.fixed_point_fn)
+            acc_dtype = self.precision['accumulation']
+            self.train_fn = partial(train_fn, jit=self.jit, anderson=self.anderson,
+                                    diff_mode=self.diff_mode, segment_length=self.segment_length,
+                                    acc_dtype=acc_dtype)
+            self.eval_fn = partial(eval_fn, jit=self.jit, record=self.record,
+                                   anderson=self.anderson, acc_dtype=acc_dtype)
+            self.tol_fn = partial(tol_fn, jit=self.jit, acc_dtype=acc_dtype)
 
         if not hasattr(self, 'train_fn'):
             self.train_fn = self.k_steps_train_fn
             self.eval_fn = self.k_steps_eval_fn
+            self.tol_fn = getattr(self, 'k_steps_tol_fn', None)
 
         e2e_loss_fn = self.create_end2end_loss_fn
 
@@ -409,14 +713,91 @@ class L2WSmodel(object):
         self.loss_fn_train = e2e_loss_fn(bypass_nn=False, diff_required=True)
 
         # end-to-end loss fn for evaluation
-        self.loss_fn_eval = e2e_loss_fn(bypass_nn=False, diff_required=False)
+        self.loss_fn_eval = self.bucket_loss_fn(
+            'eval', e2e_loss_fn(bypass_nn=False, diff_required=False))
 
         # end-to-end added fixed warm start eval - bypasses neural network
-        self.loss_fn_fixed_ws = e2e_loss_fn(bypass_nn=True, diff_required=False)
+        self.loss_fn_fixed_ws = self.bucket_loss_fn(
+            'fixed_ws', e2e_loss_fn(bypass_nn=True, diff_required=False))
+
+        # run-to-tolerance evaluation (early exit once every problem has converged)
+        if self.tol_fn is not None:
+            self.loss_fn_tol = self.bucket_loss_fn(
+                'tol', self.create_tol_loss_fn(bypass_nn=False), mean_loss=False)
+            self.loss_fn_tol_fixed_ws = self.bucket_loss_fn(
+                'tol_fixed_ws', self.create_tol_loss_fn(bypass_nn=True), mean_loss=False)
 
         # end-to-end loss fn for evaluation of fixed ws - meant for light mode
         # self.loss_fn_fixed_ws_light = e2e_loss_fn(bypass_nn=True, diff_required=True)
 
+    def bucket_loss_fn(self, name, loss_fn, mean_loss=True):
+        """
+        wraps the jitted evaluation function loss_fn(params, inputs, b, iters, *batched) so
+            that the batch (inputs, b, and the batched arguments, e.g., z_stars or factors) is
+            padded to the bucket size of get_bucket_size and the outputs are cut back to
+            the rows of the real problems
+        if mean_loss, loss_fn returns (loss, out) and the loss is the mean over the real rows
+            of out[0] (the padded rows are masked out), otherwise the rows of out are cut
+        iters stays static, so there is one executable per (bucket size, iters)
+        the padding and the cutting are jitted too (pad_batch and cut_batch), so nothing is
+            compiled after the warm-up of get_bucketed_jobs
+        """
+        if not self.bucket_batches:
+            return loss_fn
+        self.bucketed_fns[name] = (loss_fn, mean_loss)
+
+        def bucketed_loss_fn(params, inputs, b, iters, *batched):
+            num = inputs.shape[0]
+            padded_args = self.pad_to_bucket(name, inputs, b, iters, *batched)
+            out = loss_fn(params, *padded_args)
+            return cut_batch(out, num, mean_loss)
+        return bucketed_loss_fn
+
+    def pad_to_bucket(self, name, inputs, b, iters, *batched, pad_fn=pad_batch):
+        """
+        pads the batched arguments of the bucketed function name to the bucket size with
+            pad_fn and counts a hit if the function already ran on arguments of these
+            shapes (a miss means a new executable is compiled)
+        returns the padded (inputs, b, iters, *batched)
+        """
+        size = get_bucket_size(inputs.shape[0])
+        padded_inputs, padded_b, padded_batched = pad_fn((inputs, b, batched), size)
+        leaves = tree_util.tree_leaves((padded_inputs, padded_b, padded_batched))
+        key = (name, iters) + tuple((x.shape, x.dtype) for x in leaves)
+        if key in self.bucket_keys:
+            self.bucket_counts['hits'] += 1
+        else:
+            self.bucket_counts['misses'] += 1
+            self.bucket_keys.add(key)
+            logging.info(f"{name} compiles the bucket of {size} problems and {iters} iterations")
+        return (padded_inputs, padded_b, iters) + padded_batched
+
+    def get_bucketed_jobs(self, job_name, name, loss_fn, args):
+        """
+        returns the warm-up jobs (see get_compile_jobs) of the executables that
+            loss_fn(*args) calls, loss_fn is the bucketed function name if bucketing
+        with bucketing these are the padding, the cutting and the padded loss_fn, the
+            padded shapes come from jax.eval_shape so nothing is compiled here
+        """
+        if name not in self.bucketed_fns:
+            return [(job_name, loss_fn, args)]
+        padded_fn, mean_loss = self.bucketed_fns[name]
+        params, inputs, b, iters, *batched = args
+        num, size = inputs.shape[0], get_bucket_size(inputs.shape[0])
+        batch = (inputs, b, tuple(batched))
+
+        def pad_shapes(batch, size):
+            return jax.eval_shape(partial(pad_batch, size=size), batch)
+        padded_args = (params,) + self.pad_to_bucket(name, inputs, b, iters, *batched,
+                                                     pad_fn=pad_shapes)
+
+        def padded_call(params, inputs, b, *batched):
+            return padded_fn(params, inputs, b, iters, *batched)
+        out = jax.eval_shape(padded_call, *padded_args[:3], *padded_args[4:])
+        return [(f"{job_name}_pad", pad_batch, (batch, size)),
+                (f"{job_name}_cut", cut_batch, (out, num, mean_loss)),
+                (job_name, padded_fn, padded_args)]
+
     def init_train_tracking(self):
         self.epoch = 0
         self.tr_losses = None
@@ -425,52 +806,6 @@ class L2WSmodel(object):
         self.tr_losses_batch = []
         self.te_losses = []
 
-    def decay_upon_plateau(self):
-        """
-        this method decays the learning rate upon hitting a plateau
-            on the training loss
-        self.avg_window_plateau: take the last avg_window number of epochs and compared it
-            against the previous avg_window number of epochs to compare
-        self.plateau_decay_factor: multiplicative factor we decay the learning rate by
-        self.plateau_tolerance: the tolerance condition decrease to check if we should decrease
-
-        we decay the learn rate by decay_factor if
-           self.tr_losses[-2*avg_window:-avg_window] - self.tr_losses[-avg_window:] <= tolerance
-        """
-        decay_factor = self.plateau_decay['decay_factor']
-
-        window_batches = self.plateau_decay['avg_window_size'] * self.num_batches
-        plateau_tolerance = self.plateau_decay['tolerance']
-        patience = self.plateau_decay['patience']
-
-        if self.plateau_decay['min_lr'] <= self.lr / decay_factor:
-            tr_losses_batch_np = np.array(self.tr_losses_batch)
-            prev_window_losses = tr_losses_batch_np[-2*window_batches:-window_batches].mean()
-            curr_window_losses = tr_losses_batch_np[-window_batches:].mean()
-            print('prev_window_losses', prev_window_losses)
-            print('curr_window_losses', curr_window_losses)
-            plateau = prev_window_losses - curr_window_losses <= plateau_tolerance
-            if plateau:
-                # keep track of the learning rate
-                self.lr = self.lr / decay_factor
-
-                # update the optimizer (restart) and reset the state
-                if self.optimizer_method == 'adam':
-                    self.optimizer = OptaxSolver(opt=optax.adam(
-                        self.lr), fun=self.loss_fn_train, has_aux=False)
-                elif self.optimizer_method == 'sgd':
-                    self.optimizer = OptaxSolver(opt=optax.sgd(
-                        self.lr), fun=self.loss_fn_train, has_aux=False)
-                self.state = self.optimizer.init_state(self.params)
-                logging.info(f"the decay rate is now {self.lr}")
-
-                # log the current decay epoch
-                self.epoch_decay_points.append(self.epoch)
-
-                # don't decay for another 2 * window number of epochs
-                wait_time = 2 * patience * self.plateau_decay['avg_window_size']
-                self.dont_decay_until = self.epoch + wait_time
-
     def train_full_batch(self, params, state):
         """
         wrapper for train_batch where the batch size is N_train
@@ -489,7 +824,7 @@ class L2WSmodel(object):
             nn_output = predict_y(params, input)
             z0 = nn_output
         if self.algo == 'scs':
-            z0_full = jnp.ones(z0.size + 1)
+            z0_full = jnp.ones(z0.size + 1, dtype=z0.dtype)
             z0_full = z0_full.at[:z0.size].set(z0)
         else:
             z0_full = z0
@@ -575,6 +910,10 @@ class L2WSmodel(object):
             # for either of the following cases
             #   1. no factors are needed (pass in None as a static argument)
             #   2. factor is constant for all problems (pass in the same factor as static argument)
+            # the factor is closed over (not batched) so the batching rules of vmap already run
+            #   the iterations batch-major: each linear solve is one multi-right-hand-side
+            #   triangular solve over the batch and each matvec is one matrix-matrix product
+            #   (see test_static_factor_batch_major and benchmarks/batch_major_benchmark.py)
             predict_partial = partial(predict, factor=self.factor_static)
             batch_predict = vmap(predict_partial,
                                  in_axes=(None, 0, 0, None, 0),
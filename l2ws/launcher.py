@@ -11,16 +11,18 @@ import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
 import scs
-from jax import lax, vmap
-from jax.config import config
+from jax import random, tree_util
 from scipy.sparse import csc_matrix, load_npz
 from scipy.spatial import distance_matrix
 
 from l2ws.algo_steps import (
+    create_M,
     create_projection_fn,
-    form_osqp_matrix,
+    get_osqp_factor,
+    get_osqp_factors_from_q,
     get_psd_sizes,
-    unvec_symm,
+    get_record_indices,
+    get_scaled_vec_and_factor,
     vec_symm,
 )
 from l2ws.eg_model import EGmodel
@@ -28,15 +30,24 @@ from l2ws.gd_model import GDmodel
 from l2ws.ista_model import ISTAmodel
 from l2ws.osqp_model import OSQPmodel
 from l2ws.scs_model import SCSmodel
-from l2ws.utils.generic_utils import count_files_in_directory, sample_plot, setup_permutation
+from l2ws.utils.anderson_utils import get_scs_acceleration_lookback
+from l2ws.utils.compile_utils import WarmUp, get_compilation_params, init_compilation_cache
+from l2ws.utils.data_utils import load_npz_memmap
+from l2ws.utils.equilibration_utils import (
+    equilibrate_matrices,
+    scale_osqp_z,
+    scale_q_mat,
+    scale_solutions,
+)
+from l2ws.utils.generic_utils import count_files_in_directory, sample_plot
 from l2ws.utils.mpc_utils import closed_loop_rollout
+from l2ws.utils.precision_utils import cast_floating, enable_precision, get_precision_policy
 
 plt.rcParams.update({
     "text.usetex": True,
     "font.family": "serif",   # For talks, use sans-serif
     "font.size": 16,
 })
-config.update("jax_enable_x64", True)
 
 
 class Workspace:
@@ -54,6 +65,24 @@ class Workspace:
         self.algo = algo
         self.static_flag = static_flag
         self.example = example
+
+        # persistent compilation cache and ahead-of-time warm-up
+        #   (see l2ws/utils/compile_utils.py)
+        self.compilation = get_compilation_params(cfg.get('compilation', None))
+        init_compilation_cache(self.compilation)
+        self.warm_up, self.compile_times = None, []
+
+        # precision policy of the run (see l2ws/utils/precision_utils.py)
+        #   the datasets are loaded in the storage dtype
+        self.precision = cfg.get('precision', 'float64')
+        self.storage_dtype = get_precision_policy(self.precision)['storage']
+        enable_precision(get_precision_policy(self.precision))
+
+        # streaming of the training problems (see STREAM_DEFAULTS in l2ws/utils/data_utils.py)
+        #   the datasets are then memory-mapped or host numpy arrays (self.xp is np instead of
+        #   jnp) and only the batches of training and evaluation are put on the device
+        self.stream = cfg.get('stream', None)
+        self.xp = np if self.stream is not None else jnp
         self.eval_unrolls = cfg.eval_unrolls
         self.eval_every_x_epochs = cfg.eval_every_x_epochs
         self.save_every_x_epochs = cfg.save_every_x_epochs
@@ -66,7 +95,8 @@ class Workspace:
         self.eval_batch_size_train = cfg.get('eval_batch_size_train', self.num_samples_train)
 
         self.pretrain_cfg = cfg.pretrain
-        self.key_count = 0
+        # carried through the jitted training blocks to draw the permutation of each epoch
+        self.train_key = random.PRNGKey(0)
         self.save_weights_flag = cfg.get('save_weights_flag', False)
         self.load_weights_datetime = cfg.get('load_weights_datetime', None)
         self.shifted_sol_fn = shifted_sol_fn
@@ -79,6 +109,19 @@ class Workspace:
         self.init_custom_visualization(cfg, custom_visualize_fn)
         self.vis_num = cfg.get('vis_num', 20)
 
+        # iterate-history recording policy of the eval kernels (see get_record_indices)
+        #   'needed' only keeps z^0, the plotted and visualized iterates, and the last iterate
+        self.record_iterates = cfg.get('record_iterates', None)
+        if self.record_iterates == 'needed':
+            needed_iterates = [0, -1] + list(self.plot_iterates)
+            if self.has_custom_visualization:
+                needed_iterates += list(self.iterates_visualize)
+            self.record_iterates = needed_iterates
+
+        # iterates where the scs and osqp eval kernels compute the primal and dual residuals
+        #   (same policies as record_iterates), the residual csv files are sparse otherwise
+        self.residual_steps = cfg.get('residual_steps', None)
+
         # from the run cfg retrieve the following via the data cfg
         N_train, N_test = cfg.N_train, cfg.N_test
         N = N_train + N_test
@@ -102,13 +145,21 @@ class Workspace:
 
         # load the data from problem to problem
         jnp_load_obj = self.load_setup_data(example, cfg.data.datetime, N_train, N)
-        thetas = jnp.array(jnp_load_obj['thetas'])
+        thetas = self.xp.asarray(jnp_load_obj['thetas'], dtype=self.storage_dtype)
         self.thetas_train = thetas[:N_train, :]
         self.thetas_test = thetas[N_train:N, :]
 
         train_inputs, test_inputs = self.normalize_inputs_fn(thetas, N_train, N_test)
         self.train_inputs, self.test_inputs = train_inputs, test_inputs
         self.skip_startup = cfg.get('skip_startup', False)
+
+        # ruiz scaling (D, E) saved with the setup data (see l2ws/utils/equilibration_utils.py)
+        #   the matrices, q_mat, and the optimal solutions are scaled here so that training,
+        #   evaluation, and solve_c all see the scaled problems, the visualizations unscale x
+        self.ruiz = None
+        if 'ruiz_D' in jnp_load_obj.keys():
+            self.ruiz = (np.array(jnp_load_obj['ruiz_D']), np.array(jnp_load_obj['ruiz_E']))
+            static_dict = self.equilibrate(algo, cfg, static_dict)
         self.setup_opt_sols(algo, jnp_load_obj, N_train, N)
 
         # everything below is specific to the algo
@@ -129,6 +180,69 @@ class Workspace:
             self.q_mat_test = thetas[N_train:N, :]
             self.create_gd_model(cfg, static_dict)
 
+        # compile the evaluation and training executables while the run starts up
+        if self.compilation['warm_up']:
+            self.warm_up = WarmUp(self.get_compile_jobs())
+
+    def get_compile_jobs(self):
+        """
+        returns the compile jobs of the warm-up in the order the run first uses them
+            the cold-start evaluations (also the evaluations during training) of the test and
+            train problems, the nearest neighbor evaluations, short_test_eval, and training
+        """
+        eval_args = {}
+        for train in [False, True]:
+            tag = 'train' if train else 'test'
+            eval_args[tag] = self.get_eval_args(False, train)
+            if self.l2ws_model.z_stars_train is not None:
+                eval_args[f"fixed_ws_{tag}"] = self.get_eval_args(True, train)
+        return self.l2ws_model.get_compile_jobs(self.epochs_jit, self.eval_unrolls, eval_args)
+
+    def get_eval_args(self, fixed_ws, train):
+        """
+        returns the arguments (inputs, b, z_stars, fixed_ws, factors) of the first batch that
+            evaluate_only passes to L2WSmodel.evaluate
+        the fixed warm starts have the shape of the nearest neighbor warm starts
+        """
+        num = self.num_samples_train if train else self.num_samples_test
+        batch_size = self.eval_batch_size_train if train else self.eval_batch_size_test
+        if fixed_ws:
+            inputs = self.l2ws_model.z_stars_train[:num, :]
+            if isinstance(self.l2ws_model, OSQPmodel):
+                inputs = inputs[:, :self.m + self.n]
+        else:
+            inputs = self.l2ws_model.train_inputs if train else self.l2ws_model.test_inputs
+            inputs = inputs[:num, :]
+        num = min(inputs.shape[0], batch_size)
+        inputs = inputs[:num, :]
+        b = tree_util.tree_map(lambda x: x[:num, :], self.l2ws_model.get_q_mat(train))
+        z_stars = self.l2ws_model.z_stars_train if train else self.l2ws_model.z_stars_test
+        if z_stars is not None:
+            z_stars = z_stars[:num, :]
+        factors = None
+        if not self.static_flag:
+            factors = self.factors_train if train else self.factors_test
+            if factors is None:
+                factors = self.l2ws_model.factors_fn(jnp.asarray(b))
+            factors = (factors[0][:num, :, :], factors[1][:num, :])
+        return inputs, b, z_stars, fixed_ws, factors
+
+    def wait_for_compile(self, name):
+        """
+        waits for the warm-up to compile the executable name, the compile time and the time
+            spent waiting for it are logged and written to compile_times.csv
+        """
+        if self.warm_up is None:
+            return
+        times = self.warm_up.wait(name)
+        if times is None:
+            return
+        compile_time, wait_time = times
+        print(f"compiled {name} in {compile_time:.2f}s (waited {wait_time:.2f}s)")
+        self.compile_times.append(dict(name=name, compile_time=compile_time,
+                                       wait_time=wait_time))
+        pd.DataFrame(self.compile_times).to_csv('compile_times.csv')
+
     def create_ista_model(self, cfg, static_dict):
         # get A, lambd, ista_step
         A, lambd = static_dict['A'], static_dict['lambd']
@@ -145,6 +259,12 @@ class Workspace:
                           lambd=lambd,
                           ista_step=ista_step,
                           A=A,
+                          record=self.record_iterates,
+                          precision=self.precision,
+                          diff_mode=cfg.get('diff_mode', 'unroll'),
+                          segment_length=cfg.get('segment_length', None),
+                          bucket_batches=cfg.get('bucket_batches', True),
+                          stream=self.stream,
                         #   nn_cfg=cfg.nn_cfg,
                         #   z_stars_train=self.z_stars_train,
                         #   z_stars_test=self.z_stars_test,
@@ -169,7 +289,13 @@ class Workspace:
                           c_mat_train=self.q_mat_train,
                           c_mat_test=self.q_mat_test,
                           gd_step=gd_step,
-                          P=P
+                          P=P,
+                          record=self.record_iterates,
+                          precision=self.precision,
+                          diff_mode=cfg.get('diff_mode', 'unroll'),
+                          segment_length=cfg.get('segment_length', None),
+                          bucket_batches=cfg.get('bucket_batches', True),
+                          stream=self.stream
                           )
         self.l2ws_model = GDmodel(train_unrolls=self.train_unrolls,
                                     eval_unrolls=self.eval_unrolls,
@@ -207,6 +333,12 @@ class Workspace:
                           nn_cfg=cfg.nn_cfg,
                           z_stars_train=self.z_stars_train,
                           z_stars_test=self.z_stars_test,
+                          record=self.record_iterates,
+                          precision=self.precision,
+                          diff_mode=cfg.get('diff_mode', 'unroll'),
+                          segment_length=cfg.get('segment_length', None),
+                          bucket_batches=cfg.get('bucket_batches', True),
+                          stream=self.stream,
                           )
         self.l2ws_model = EGmodel(input_dict)
 
@@ -228,6 +360,16 @@ class Workspace:
                               m=m,
                               n=n,
                               factor=factor,
+                              factor_method=cfg.get('factor_method', 'lu'),
+                              adaptive_rho=cfg.get('adaptive_rho', None),
+                              record=self.record_iterates,
+                              anderson=cfg.get('anderson', None),
+                              precision=self.precision,
+                              diff_mode=cfg.get('diff_mode', 'unroll'),
+                              segment_length=cfg.get('segment_length', None),
+                              bucket_batches=cfg.get('bucket_batches', True),
+                              stream=self.stream,
+                              residual_steps=self.residual_steps,
                             #   train_inputs=self.train_inputs,
                             #   test_inputs=self.test_inputs,
                             #   train_unrolls=self.train_unrolls,
@@ -247,41 +389,42 @@ class Workspace:
 
             t0 = time.time()
 
-            # form matrices (N, m + n, m + n) to be factored
-            nc2 = int(n * (n + 1) / 2)
-            q_mat = jnp.vstack([self.q_mat_train, self.q_mat_test])
-            N_train, _ = self.q_mat_train.shape[0], self.q_mat_test[0]
-            N = q_mat.shape[0]
-            unvec_symm_batch = vmap(unvec_symm, in_axes=(0, None), out_axes=(0))
-            P_tensor = unvec_symm_batch(q_mat[:, 2 * m + n: 2 * m + n + nc2], n)
-            A_tensor = jnp.reshape(q_mat[:, 2 * m + n + nc2:], (N, m, n))
+            # factor the matrices (N, m + n, m + n) of the problems
+            #   with streaming, the factors of the training problems are computed for each batch
+            #   with factors_fn instead of being stored (N_train x n x n)
             sigma = 1
-            batch_form_osqp_matrix = vmap(
-                form_osqp_matrix, in_axes=(0, 0, None, None), out_axes=(0))
+            factors_fn = partial(get_osqp_factors_from_q, m=m, n=n, rho_vec=rho_vec, sigma=sigma)
+            if self.stream is None:
+                q_mat = jnp.vstack([self.q_mat_train, self.q_mat_test])
+            else:
+                q_mat = jnp.asarray(self.q_mat_test)
+            N_train = 0 if self.stream is not None else self.q_mat_train.shape[0]
+            N = q_mat.shape[0]
 
             # try batching
             cutoff = 4000
-            matrices1 = batch_form_osqp_matrix(
-                P_tensor[:cutoff, :, :], A_tensor[:cutoff, :, :], rho_vec, sigma)
-            matrices2 = batch_form_osqp_matrix(
-                P_tensor[cutoff:, :, :], A_tensor[cutoff:, :, :], rho_vec, sigma)
-            # matrices =
-
-            # do factors
-            # factors0, factors1 = self.batch_factors(self.q_mat_train)
-            batch_lu_factor = vmap(jsp.linalg.lu_factor, in_axes=(0,), out_axes=(0, 0))
-            factors10, factors11 = batch_lu_factor(matrices1)
-            factors20, factors21 = batch_lu_factor(matrices2)
+            factors10, factors11 = factors_fn(q_mat[:cutoff, :])
+            factors20, factors21 = factors_fn(q_mat[cutoff:, :])
             factors0 = jnp.vstack([factors10, factors20])
             factors1 = jnp.vstack([factors11, factors21])
 
             t1 = time.time()
             print('batch factor time', t1 - t0)
 
-            self.factors_train = (factors0[:N_train, :, :], factors1[:N_train, :])
+            self.factors_train = None
+            if self.stream is None:
+                self.factors_train = (factors0[:N_train, :, :], factors1[:N_train, :])
             self.factors_test = (factors0[N_train:N, :, :], factors1[N_train:N, :])
 
             input_dict = dict(factor_static_bool=False,
+                              record=self.record_iterates,
+                              anderson=cfg.get('anderson', None),
+                              precision=self.precision,
+                              diff_mode=cfg.get('diff_mode', 'unroll'),
+                              segment_length=cfg.get('segment_length', None),
+                              bucket_batches=cfg.get('bucket_batches', True),
+                              stream=self.stream,
+                              residual_steps=self.residual_steps,
                               supervised=cfg.supervised,
                               rho=rho_vec,
                               q_mat_train=self.q_mat_train,
@@ -292,6 +435,7 @@ class Workspace:
                               test_inputs=self.test_inputs,
                               factors_train=self.factors_train,
                               factors_test=self.factors_test,
+                              factors_fn=factors_fn,
                             #   train_unrolls=self.train_unrolls,
                             #   eval_unrolls=self.eval_unrolls,
                             #   nn_cfg=cfg.nn_cfg,
@@ -375,7 +519,18 @@ class Workspace:
                      'scale': scale,
                      'alpha_relax': alpha_relax,
                      'cones': cones,
-                     'lightweight': cfg.get('lightweight', False)
+                     'lightweight': cfg.get('lightweight', False),
+                     'factor_method': cfg.get('factor_method', 'lu'),
+                     'record': self.record_iterates,
+                     'anderson': cfg.get('anderson', None),
+                     'precision': self.precision,
+                     'diff_mode': cfg.get('diff_mode', 'unroll'),
+                     'segment_length': cfg.get('segment_length', None),
+                     'bucket_batches': cfg.get('bucket_batches', True),
+                     'stream': self.stream,
+                     'residual_steps': self.residual_steps,
+                     'psd_rank': cfg.get('psd_rank', None),
+                     'adaptive_scale': cfg.get('adaptive_scale', None)
                      }
         self.l2ws_model = SCSmodel(train_unrolls=self.train_unrolls,
                                    eval_unrolls=self.eval_unrolls,
@@ -392,9 +547,56 @@ class Workspace:
                                    algo_dict=algo_dict)
         # self.l2ws_model = SCSmodel(input_dict)
 
+    def equilibrate(self, algo, cfg, static_dict):
+        """
+        scales q_mat_train and q_mat_test with the ruiz scaling self.ruiz and returns a copy of
+            static_dict with the scaled matrices and their factor
+        the optimal solutions are scaled in setup_opt_sols
+        """
+        if algo not in ['scs', 'osqp'] or not self.static_flag:
+            raise ValueError("ruiz equilibration requires scs or osqp with a static factor")
+        D, E = self.ruiz
+        m, n = D.size, E.size
+        static_dict = dict(static_dict)
+        if algo == 'scs':
+            M = static_dict['M']
+            P, A = equilibrate_matrices(M[:n, :n], -M[n:, :n], D, E)
+            static_dict['M'] = create_M(P, A)
+            static_dict['algo_factor'], _ = get_scaled_vec_and_factor(
+                static_dict['M'], cfg.get('rho_x', 1), cfg.get('scale', 1), m, n,
+                static_dict['cones_dict']['z'])
+        else:
+            P, A = equilibrate_matrices(static_dict['P'], static_dict['A'], D, E)
+            static_dict['P'], static_dict['A'] = P, A
+            static_dict['factor'] = get_osqp_factor(P, A, static_dict['rho'], 1)
+        self.q_mat_train, self.q_mat_test = cast_floating(
+            (scale_q_mat(self.q_mat_train, D, E, algo), scale_q_mat(self.q_mat_test, D, E, algo)),
+            self.storage_dtype)
+        if self.has_custom_visualization:
+            self.custom_visualize_fn = self.unscaled_visualize_fn(self.custom_visualize_fn)
+        return static_dict
+
+    def unscaled_visualize_fn(self, custom_visualize_fn):
+        """
+        wraps custom_visualize_fn so that it sees the x of the original (unscaled) problems
+            in the iterates and the solutions (the rest of z stays scaled)
+        """
+        E = jnp.array(self.ruiz[1])
+
+        def unscale(z):
+            return None if z is None else jnp.asarray(z).at[..., :E.size].multiply(E)
+
+        def visualize_fn(z_all, z_stars, z_prev, z_nn, *args, **kwargs):
+            return custom_visualize_fn(unscale(z_all), unscale(z_stars), unscale(z_prev),
+                                       unscale(z_nn), *args, **kwargs)
+        return visualize_fn
+
     def setup_opt_sols(self, algo, jnp_load_obj, N_train, N, num_plot=5):
         if algo != 'scs':
             z_stars = jnp_load_obj['z_stars']
+            if self.ruiz is not None:
+                z_stars = scale_osqp_z(z_stars, *self.ruiz)
+            z_stars = cast_floating(z_stars, self.storage_dtype)
             z_stars_train = z_stars[:N_train, :]
             z_stars_test = z_stars[N_train:N, :]
             self.plot_samples(num_plot, self.thetas_train, self.train_inputs, z_stars_train)
@@ -406,10 +608,14 @@ class Workspace:
             #     self.x_stars_test = z_stars_test[:, :self.n]
         else:
             if 'x_stars' in jnp_load_obj.keys():
-                x_stars = jnp_load_obj['x_stars']
-                y_stars = jnp_load_obj['y_stars']
-                s_stars = jnp_load_obj['s_stars']
-                z_stars = jnp.hstack([x_stars, y_stars + s_stars])
+                x_stars, y_stars, s_stars = (jnp_load_obj['x_stars'], jnp_load_obj['y_stars'],
+                                             jnp_load_obj['s_stars'])
+                if self.ruiz is not None:
+                    x_stars, y_stars, s_stars = scale_solutions(*self.ruiz, x_stars, y_stars,
+                                                                s_stars)
+                x_stars, y_stars, s_stars = cast_floating((x_stars, y_stars, s_stars),
+                                                          self.storage_dtype)
+                z_stars = self.xp.hstack([x_stars, y_stars + s_stars])
                 x_stars_train = x_stars[:N_train, :]
                 y_stars_train = y_stars[:N_train, :]
 
@@ -470,13 +676,13 @@ class Workspace:
             col_sums = thetas.mean(axis=0)
             std_devs = thetas.std(axis=0)
             inputs_normalized = (thetas - col_sums) / std_devs  # thetas.std(axis=0)
-            inputs = jnp.array(inputs_normalized)
+            inputs = self.xp.asarray(inputs_normalized)
 
             # save the col_sums and std deviations
             self.normalize_col_sums = col_sums
             self.normalize_std_dev = std_devs
         else:
-            inputs = jnp.array(thetas)
+            inputs = self.xp.asarray(thetas)
         train_inputs = inputs[:N_train, :]
         test_inputs = inputs[N_train:N, :]
 
@@ -491,11 +697,14 @@ class Workspace:
         folder = f"{orig_cwd}/outputs/{example}/data_setup_outputs/{datetime}"
         filename = f"{folder}/data_setup.npz"
 
-        if self.static_flag:
-            jnp_load_obj = jnp.load(filename)
+        if self.stream is not None:
+            # the arrays are extracted once to folder/mmap and memory-mapped from there
+            jnp_load_obj = load_npz_memmap(filename, f"{folder}/mmap")
         else:
             jnp_load_obj = jnp.load(filename)
-            q_mat = jnp.array(load_npz(f"{filename[:-4]}_q.npz").todense())
+        if not self.static_flag:
+            q_mat = self.xp.asarray(load_npz(f"{filename[:-4]}_q.npz").todense(),
+                                    dtype=self.storage_dtype)
             self.q_mat_train = q_mat[:N_train, :]
             self.q_mat_test = q_mat[N_train:N, :]
 
@@ -517,7 +726,7 @@ class Workspace:
             #                      jnp.array(factors1[N_train:N, :]))
 
         if 'q_mat' in jnp_load_obj.keys():
-            q_mat = jnp.array(jnp_load_obj['q_mat'])
+            q_mat = self.xp.asarray(jnp_load_obj['q_mat'], dtype=self.storage_dtype)
             q_mat_train = q_mat[:N_train, :]
             q_mat_test = q_mat[N_train:N, :]
             self.q_mat_train, self.q_mat_test = q_mat_train, q_mat_test
@@ -589,6 +798,8 @@ class Workspace:
         fixed_ws = col == 'nearest_neighbor' or col == 'prev_sol'
 
         # do the actual evaluation (most important step in thie method)
+        tag = 'train' if train else 'test'
+        self.wait_for_compile(f"eval_fixed_ws_{tag}" if fixed_ws else f"eval_{tag}")
         eval_batch_size = self.eval_batch_size_train if train else self.eval_batch_size_test
         eval_out = self.evaluate_only(fixed_ws, num, train, col, eval_batch_size)
 
@@ -639,7 +850,7 @@ class Workspace:
         # self.plot_angles(angles, r, train, col)
 
         # plot the warm-start predictions
-        z_all = out_train[2]
+        z_all = self.expand_recorded_iterates(out_train[2])
 
         if isinstance(self.l2ws_model, SCSmodel):
             out_train[6]
@@ -679,8 +890,9 @@ class Workspace:
         # self.solve_scs(z0_mat, train, col)
         # self.solve_scs(z_all, u_all, train, col)
         z0_mat = z_all[:, 0, :]
+        z0_recorded = 0 in get_record_indices(self.eval_unrolls, self.record_iterates)
 
-        if self.solve_c_num > 0:
+        if self.solve_c_num > 0 and z0_recorded:
             if 'solve_c' in dir(self.l2ws_model):
                 self.solve_c_helper(z0_mat, train, col)
 
@@ -690,6 +902,26 @@ class Workspace:
 
         return out_train
 
+    def expand_recorded_iterates(self, z_hist):
+        """
+        places the recorded iterates at their iteration index so that z_all[:, j, :] is z^j
+            for every iterate used for plotting and custom visualization
+        iterates that were not recorded are filled with nan
+        """
+        if self.record_iterates is None:
+            return z_hist
+        plotted_iterates = [0] + list(self.plot_iterates)
+        if self.has_custom_visualization:
+            plotted_iterates += list(self.iterates_visualize)
+        num_rows = max(plotted_iterates) + 1
+
+        record_indices = get_record_indices(self.eval_unrolls, self.record_iterates)
+        z_all = np.full((z_hist.shape[0], num_rows, z_hist.shape[2]), np.nan)
+        for row, j in enumerate(record_indices):
+            if j < num_rows:
+                z_all[:, j, :] = z_hist[:, row, :]
+        return z_all
+
     def solve_c_helper(self, z0_mat, train, col):
         """
         calls the self.solve_c method and does housekeeping
@@ -785,7 +1017,8 @@ class Workspace:
                          adaptive_scale=False,
                          rho_x=1,
                          alpha=1,
-                         acceleration_lookback=0,
+                         acceleration_lookback=get_scs_acceleration_lookback(
+                             self.l2ws_model.anderson),
                          eps_abs=1e-2,
                          eps_rel=1e-2)
 
@@ -1143,7 +1376,10 @@ class Workspace:
 
         # do all of the training
         test_zero = True if self.skip_startup else False
-        self.train(test_zero=test_zero)
+        try:
+            self.train(test_zero=test_zero)
+        finally:
+            self.l2ws_model.close_stream()
 
     def train(self, test_zero=False):
         """
@@ -1154,30 +1390,25 @@ class Workspace:
         num_epochs_jit = int(self.l2ws_model.epochs / self.epochs_jit)
         loop_size = int(self.l2ws_model.num_batches * self.epochs_jit)
 
-        # key_count updated to get random permutation for each epoch
-        # key_count = 0
-
         for epoch_batch in range(num_epochs_jit):
             epoch = int(epoch_batch * self.epochs_jit)
             if (test_zero and epoch == 0) or (epoch % self.eval_every_x_epochs == 0 and epoch > 0):
                 self.eval_iters_train_and_test(f"train_epoch_{epoch}", self.pretrain_on)
 
-            # if epoch > self.l2ws_model.dont_decay_until:
-            #     self.l2ws_model.decay_upon_plateau()
-
-            # setup the permutations
-            permutation = setup_permutation(
-                self.key_count, self.l2ws_model.N_train, self.epochs_jit)
-
-            # train the jitted epochs
+            # train the jitted epochs (the permutations are drawn and the learning rate schedule
+            #   is applied on the device)
             params, state, epoch_train_losses, time_train_per_epoch = self.train_jitted_epochs(
-                permutation, epoch)
+                epoch)
 
             # reset the global (params, state)
-            self.key_count += 1
             self.l2ws_model.epoch += self.epochs_jit
             self.l2ws_model.params, self.l2ws_model.state = params, state
 
+            # after the last block, the prefetched chunks must not stay on the device during
+            #   the evaluations
+            if epoch_batch == num_epochs_jit - 1:
+                self.l2ws_model.close_stream()
+
             gc.collect()
 
             prev_batches = len(self.l2ws_model.tr_losses_batch)
@@ -1195,89 +1426,28 @@ class Workspace:
             if epoch % self.save_every_x_epochs == 0:
                 self.plot_train_test_losses()
 
-    def train_jitted_epochs(self, permutation, epoch):
+    def train_jitted_epochs(self, epoch):
         """
-        train self.epochs_jit at a time
-        special case: the first time we call train_batch (i.e. epoch = 0)
+        train self.epochs_jit at a time with one jitted function (see L2WSmodel.train_epochs)
+        the params and the optimizer state of the model are donated and replaced by the caller
+        self.train_key is advanced by the block (with streaming the batches come from the
+            prefetch thread of the model, see L2WSmodel.train_stream)
         """
+        self.wait_for_compile('train_epochs')
         epoch_batch_start_time = time.time()
-        loop_size = int(self.l2ws_model.num_batches * self.epochs_jit)
-        epoch_train_losses = jnp.zeros(loop_size)
-        if epoch == 0:
-            # unroll the first iterate so that This allows `init_val` and `body_fun`
-            #   below to have the same output type, which is a requirement of
-            #   lax.while_loop and lax.scan.
-            batch_indices = lax.dynamic_slice(
-                permutation, (0,), (self.l2ws_model.batch_size,))
-
-            train_loss_first, params, state = self.l2ws_model.train_batch(
-                batch_indices, self.l2ws_model.params, self.l2ws_model.state)
-
-            epoch_train_losses = epoch_train_losses.at[0].set(train_loss_first)
-            start_index = 1
-            # self.train_over_epochs_body_simple_fn_jitted = jit(self.train_over_epochs_body_simple_fn)  # noqa
-            self.train_over_epochs_body_simple_fn_jitted = self.train_over_epochs_body_simple_fn
+        if self.stream is not None:
+            params, state, epoch_train_losses = self.l2ws_model.train_stream(
+                self.l2ws_model.params, self.l2ws_model.state, self.epochs_jit)
         else:
-            start_index = 0
-            params, state = self.l2ws_model.params, self.l2ws_model.state
-
-        # loop the last (self.l2ws_model.num_batches - 1) iterates if not
-        #   the first time calling train_batch
-        # init_val = epoch_train_losses, params, state
-        # import pdb
-        # pdb.set_trace()
-        # body_fn = partial(self.train_over_epochs_body_fn, permutation=permutation)
-        # val = lax.fori_loop(start_index, loop_size, body_fn, init_val)
-        # epoch_batch_end_time = time.time()
-        # time_diff = epoch_batch_end_time - epoch_batch_start_time
-        # time_train_per_epoch = time_diff / self.epochs_jit
-        # epoch_train_losses, params, state = val
-
-        init_val = epoch_train_losses, params, state, permutation
-        # import pdb
-        # pdb.set_trace()
-        # body_fn = self.train_over_epochs_body_simple_fn
-        val = lax.fori_loop(start_index, loop_size,
-                            self.train_over_epochs_body_simple_fn_jitted, init_val)
+            params, state, self.train_key, epoch_train_losses = self.l2ws_model.train_epochs(
+                self.l2ws_model.params, self.l2ws_model.state, self.train_key, self.epochs_jit)
+        epoch_train_losses.block_until_ready()
         epoch_batch_end_time = time.time()
         time_diff = epoch_batch_end_time - epoch_batch_start_time
         time_train_per_epoch = time_diff / self.epochs_jit
-        epoch_train_losses, params, state, permutation = val
 
         return params, state, epoch_train_losses, time_train_per_epoch
 
-    # @jit
-    def train_over_epochs_body_simple_fn(self, batch, val):
-        """
-        to be used as the body_fn in lax.fori_loop
-        need to call partial for the specific permutation
-        """
-        train_losses, params, state, permutation = val
-        start_index = batch * self.l2ws_model.batch_size
-        batch_indices = lax.dynamic_slice(
-            permutation, (start_index,), (self.l2ws_model.batch_size,))
-        # batch_indices = permutation[start_index: start_index + self.l2ws_model.batch_size]
-        train_loss, params, state = self.l2ws_model.train_batch(
-            batch_indices, params, state)
-        train_losses = train_losses.at[batch].set(train_loss)
-        val = train_losses, params, state, permutation
-        return val
-
-    def train_over_epochs_body_fn(self, batch, val, permutation):
-        """
-        to be used as the body_fn in lax.fori_loop
-        need to call partial for the specific permutation
-        """
-        train_losses, params, state = val
-        start_index = batch * self.l2ws_model.batch_size
-        batch_indices = lax.dynamic_slice(
-            permutation, (start_index,), (self.l2ws_model.batch_size,))
-        train_loss, params, state = self.l2ws_model.train_batch(
-            batch_indices, params, state)
-        train_losses = train_losses.at[batch].set(train_loss)
-        val = train_losses, params, state
-        return val
-
     def write_accuracies_csv(self, losses, train, col):
         df_acc = pd.DataFrame()
         df_acc['accuracies'] = np.array(self.accs)
@@ -1338,7 +1508,9 @@ class Workspace:
 
     def evaluate_only(self, fixed_ws, num, train, col, batch_size):
         tag = 'train' if train else 'test'
-        if self.static_flag:
+        # the factors of the streamed training problems are computed for each batch
+        compute_factors = not self.static_flag and train and self.factors_train is None
+        if self.static_flag or compute_factors:
             factors = None
         else:
             if train:
@@ -1352,29 +1524,27 @@ class Workspace:
                 z_stars = self.l2ws_model.z_stars_train[:num, :] 
             else: 
                 z_stars = self.l2ws_model.z_stars_test[:num, :]
+        # q_mat is either an array or a tuple of arrays with one row per problem (see get_q_mat)
+        q_mat = tree_util.tree_map(lambda x: x[:num, :], self.l2ws_model.get_q_mat(train))
         if col == 'prev_sol':
-            if train:
-                q_mat_full = self.l2ws_model.q_mat_train[:num, :] 
-            else:
-                q_mat_full = self.l2ws_model.q_mat_test[:num, :]
             non_first_indices = jnp.mod(jnp.arange(num), self.traj_length) != 0
-            q_mat = q_mat_full[non_first_indices, :]
+            q_mat = tree_util.tree_map(lambda x: x[non_first_indices, :], q_mat)
             z_stars = z_stars[non_first_indices, :]
             if factors is not None:
                 factors = (factors[0][non_first_indices, :, :], factors[1][non_first_indices, :])
-        else:
-            q_mat = self.l2ws_model.q_mat_train[:num,
-                                                :] if train else self.l2ws_model.q_mat_test[:num, :]
 
         inputs = self.get_inputs_for_eval(fixed_ws, num, train, col)
         # if inputs.shape[0]
         # import pdb
         # pdb.set_trace()
 
-        # do the batching
-        num_batches = int(num / batch_size)
+        # do the batching (the last batch holds the leftover problems, the model pads every
+        #   batch to a bucket size so it does not compile a new executable)
+        num_batches = int(np.ceil(inputs.shape[0] / batch_size))
         full_eval_out = []
         if num_batches <= 1:
+            if compute_factors:
+                factors = self.l2ws_model.factors_fn(jnp.asarray(q_mat))
             eval_out = self.l2ws_model.evaluate(
                 self.eval_unrolls, inputs, q_mat, z_stars, fixed_ws, factors=factors, tag=tag)
             return eval_out
@@ -1384,10 +1554,12 @@ class Workspace:
             start = i * batch_size
             end = (i + 1) * batch_size
             curr_inputs = inputs[start: end]
-            curr_q_mat = q_mat[start: end]
+            curr_q_mat = tree_util.tree_map(lambda x: x[start: end], q_mat)
 
             if factors is not None:
                 curr_factors = (factors[0][start:end, :, :], factors[1][start:end, :])
+            elif compute_factors:
+                curr_factors = self.l2ws_model.factors_fn(jnp.asarray(curr_q_mat))
             else:
                 curr_factors = None
             if z_stars is not None:
@@ -1401,16 +1573,19 @@ class Workspace:
             # eval_out_cpu = tuple(item.copy_to_host() for item in eval_out)
             # full_eval_out.append(eval_out_cpu)
             eval_out1_list = [eval_out[1][i] for i in range(len(eval_out[1]))]
-            eval_out1_list[2] = eval_out1_list[2][:, :25, :]
-            if isinstance(self.l2ws_model, SCSmodel):
-                eval_out1_list[6] = eval_out1_list[6][:, :25, :]
-            eval_out_cpu = (eval_out[0], tuple(eval_out1_list), eval_out[2])
+            if self.record_iterates is None:
+                eval_out1_list[2] = eval_out1_list[2][:, :25, :]
+                if isinstance(self.l2ws_model, SCSmodel):
+                    eval_out1_list[6] = eval_out1_list[6][:, :25, :]
+            eval_out_cpu = (eval_out[0], tuple(eval_out1_list), eval_out[2], curr_inputs.shape[0])
             full_eval_out.append(eval_out_cpu)
             del eval_out
             del eval_out_cpu
             del eval_out1_list
             gc.collect()
-        loss = np.array([curr_out[0] for curr_out in full_eval_out]).mean()
+        batch_sizes = np.array([curr_out[3] for curr_out in full_eval_out])
+        batch_losses = np.array([curr_out[0] for curr_out in full_eval_out])
+        loss = batch_losses @ batch_sizes / batch_sizes.sum()
         time_per_prob = np.array([curr_out[2] for curr_out in full_eval_out]).mean()
         out = self.stack_tuples([curr_out[1] for curr_out in full_eval_out])
 
@@ -1625,13 +1800,14 @@ class Workspace:
         plt.clf()
 
     def test_eval_write(self):
+        self.wait_for_compile('short_test_eval')
         test_loss, time_per_iter = self.l2ws_model.short_test_eval()
         # test_loss, time_per_iter = 1, 1
         last_epoch = np.array(self.l2ws_model.tr_losses_batch[-self.l2ws_model.num_batches:])
         moving_avg = last_epoch.mean()
         if self.test_writer is not None:
             self.test_writer.writerow({
-                'iter': self.l2ws_model.state.iter_num,
+                'iter': len(self.l2ws_model.tr_losses_batch),
                 'train_loss': moving_avg,
                 'test_loss': test_loss,
                 'time_per_iter': time_per_iter
@@ -1658,12 +1834,13 @@ class Workspace:
         plt.plot(epoch_axis, batch_losses, label='train')
 
         # include when learning rate decays
-        if len(self.l2ws_model.epoch_decay_points) > 0:
-            epoch_decay_points = self.l2ws_model.epoch_decay_points
+        epoch_decay_points = self.l2ws_model.get_epoch_decay_points()
+        if len(epoch_decay_points) > 0:
             epoch_decay_points_np = np.array(epoch_decay_points)
             batch_decay_points = epoch_decay_points_np * self.l2ws_model.num_batches
 
-            batch_decay_points_int = batch_decay_points.astype('int')
+            batch_decay_points_int = np.minimum(batch_decay_points.astype('int'),
+                                                len(batch_losses) - 1)
             decay_vals = batch_losses[batch_decay_points_int]
             plt.scatter(epoch_decay_points_np, decay_vals, c='r', label='lr decay')
         plt.yscale('log')
@@ -1754,6 +1931,10 @@ class Workspace:
                         obj_vals_diff_df,
                         train, col):
         self.plot_eval_iters_df(iters_df, train, col, 'fixed point residual', 'eval_iters')
+        if primal_residuals_df is not None and self.residual_steps is not None:
+            # the residuals are only computed at residual_steps, the plots interpolate them
+            primal_residuals_df = primal_residuals_df.interpolate(limit_area='inside')
+            dual_residuals_df = dual_residuals_df.interpolate(limit_area='inside')
         if primal_residuals_df is not None:
             self.plot_eval_iters_df(primal_residuals_df, train, col,
                                     'primal residual', 'primal_residuals')
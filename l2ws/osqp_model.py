@@ -5,8 +5,17 @@ import numpy as np
 import osqp
 from scipy.sparse import csc_matrix
 
-from l2ws.algo_steps import k_steps_eval_osqp, k_steps_train_osqp, unvec_symm
+from l2ws.algo_steps import (
+    get_adaptive_rho_params,
+    get_osqp_factor,
+    get_rho_bank,
+    k_steps_eval_osqp,
+    k_steps_tol_osqp,
+    k_steps_train_osqp,
+    unvec_symm,
+)
 from l2ws.l2ws_model import L2WSmodel
+from l2ws.utils.precision_utils import cast_floating
 
 
 class OSQPmodel(L2WSmodel):
@@ -23,6 +32,16 @@ class OSQPmodel(L2WSmodel):
         self.sigma = input_dict.get('sigma', 1)
         self.alpha = input_dict.get('alpha', 1)
         self.output_size = self.n + self.m
+        self.tol_metric = input_dict.get('tol_metric', 'fixed_point')
+
+        # policy of the iterates where the eval kernel computes the primal and dual residuals
+        #   (see get_metric_mask), None computes them at every iteration
+        self.residual_steps = input_dict.get('residual_steps', None)
+
+        # adaptive rho of the eval and tol kernels (None keeps rho fixed), a dict with the keys
+        #   of ADAPTIVE_RHO_DEFAULTS in l2ws/algo_steps.py (True gives the defaults)
+        #   the factors of all the rho vectors are computed here (see get_rho_bank)
+        self.adaptive_rho = input_dict.get('adaptive_rho', None)
 
         """
         break into the 2 cases
@@ -35,14 +54,39 @@ class OSQPmodel(L2WSmodel):
             self.A = input_dict['A']
             # self.P = input_dict.get('P', None)
             self.P = input_dict['P']
-            self.factor_static = input_dict['factor']
+
+            # refactor if a different factorization than the dense lu is requested
+            self.factor_method = input_dict.get('factor_method', 'lu')
+            if self.factor_method == 'lu':
+                self.factor_static = input_dict['factor']
+            else:
+                self.factor_static = get_osqp_factor(self.P, self.A, self.rho, self.sigma,
+                                                     factor_method=self.factor_method)
+            rho_bank = None
+            if self.adaptive_rho is not None:
+                rho_bank = get_rho_bank(self.P, self.A, self.rho, self.sigma, self.adaptive_rho,
+                                        factor_method=self.factor_method)
+                rho_bank = cast_floating(rho_bank, self.precision['compute'])
+            acc_dtype = self.precision['accumulation']
             self.k_steps_train_fn = partial(
-                k_steps_train_osqp, A=self.A, rho=self.rho, sigma=self.sigma, jit=self.jit)
+                k_steps_train_osqp, A=self.A, rho=self.rho, sigma=self.sigma, jit=self.jit,
+                anderson=self.anderson, diff_mode=self.diff_mode,
+                segment_length=self.segment_length, acc_dtype=acc_dtype)
             self.k_steps_eval_fn = partial(k_steps_eval_osqp, P=self.P,
-                                           A=self.A, rho=self.rho, sigma=self.sigma, jit=self.jit)
+                                           A=self.A, rho=self.rho, sigma=self.sigma, jit=self.jit,
+                                           record=self.record, anderson=self.anderson,
+                                           residual_steps=self.residual_steps,
+                                           rho_bank=rho_bank, acc_dtype=acc_dtype)
+            self.k_steps_tol_fn = partial(k_steps_tol_osqp, P=self.P, A=self.A, rho=self.rho,
+                                          sigma=self.sigma, jit=self.jit,
+                                          tol_metric=self.tol_metric, rho_bank=rho_bank,
+                                          acc_dtype=acc_dtype)
         else:
+            if self.adaptive_rho is not None:
+                raise ValueError("the adaptive rho requires the static factor")
             self.k_steps_train_fn = self.create_k_steps_train_fn_dynamic()
             self.k_steps_eval_fn = self.create_k_steps_eval_fn_dynamic()
+            self.k_steps_tol_fn = self.create_k_steps_tol_fn_dynamic()
             # self.k_steps_eval_fn = partial(k_steps_eval_osqp, rho=rho, sigma=sigma, jit=self.jit)
 
             self.factors_train = input_dict['factors_train']
@@ -70,7 +114,10 @@ class OSQPmodel(L2WSmodel):
             A = jnp.reshape(q[2 * m + n + nc2:], (m, n))
             return k_steps_train_osqp(k=k, z0=z0, q=q_bar,
                                       factor=factor, A=A, rho=self.rho, sigma=self.sigma,
-                                      supervised=supervised, z_star=z_star, jit=self.jit)
+                                      supervised=supervised, z_star=z_star, jit=self.jit,
+                                      anderson=self.anderson, diff_mode=self.diff_mode,
+                                      segment_length=self.segment_length,
+                                      acc_dtype=self.precision['accumulation'])
         return k_steps_train_osqp_dynamic
 
     def create_k_steps_eval_fn_dynamic(self):
@@ -89,9 +136,30 @@ class OSQPmodel(L2WSmodel):
             A = jnp.reshape(q[2 * m + n + nc2:], (m, n))
             return k_steps_eval_osqp(k=k, z0=z0, q=q_bar,
                                      factor=factor, P=P, A=A, rho=self.rho, sigma=self.sigma,
-                                     supervised=supervised, z_star=z_star, jit=self.jit)
+                                     supervised=supervised, z_star=z_star, jit=self.jit,
+                                     record=self.record, anderson=self.anderson,
+                                     residual_steps=self.residual_steps,
+                                     acc_dtype=self.precision['accumulation'])
         return k_steps_eval_osqp_dynamic
 
+    def create_k_steps_tol_fn_dynamic(self):
+        """
+        creates the self.k_steps_tol_fn function for the dynamic case
+        acts as a wrapper around the k_steps_tol_osqp function from algo_steps.py
+        """
+        m, n = self.m, self.n
+
+        def k_steps_tol_osqp_dynamic(k, z0, q, factor, tol):
+            nc2 = int(n * (n + 1) / 2)
+            q_bar = q[:2 * m + n]
+            P = unvec_symm(q[2 * m + n: 2 * m + n + nc2], n)
+            A = jnp.reshape(q[2 * m + n + nc2:], (m, n))
+            return k_steps_tol_osqp(k=k, z0=z0, q=q_bar,
+                                    factor=factor, P=P, A=A, rho=self.rho, sigma=self.sigma,
+                                    tol=tol, jit=self.jit, tol_metric=self.tol_metric,
+                                    acc_dtype=self.precision['accumulation'])
+        return k_steps_tol_osqp_dynamic
+
     def solve_c(self, z0_mat, q_mat, rel_tol, abs_tol, max_iter=40000):
         # assume M doesn't change across problems
         # static problem data
@@ -112,10 +180,17 @@ class OSQPmodel(L2WSmodel):
         c, l, u = np.zeros(n), np.zeros(m), np.zeros(m)  # noqa
         
         rho = 1
+
+        # the C implementation adapts rho at the same interval and tolerance as the eval kernel
+        adaptive_rho = dict(adaptive_rho=False)
+        if self.adaptive_rho is not None:
+            params = get_adaptive_rho_params(self.adaptive_rho)
+            adaptive_rho = dict(adaptive_rho=True, adaptive_rho_interval=params['interval'],
+                                adaptive_rho_tolerance=params['tolerance'])
         osqp_solver.setup(P=P_sparse, q=c, A=A_sparse, l=l, u=u, alpha=self.alpha, rho=rho, 
                           sigma=self.sigma, polish=False,
-                          adaptive_rho=False, scaling=0, max_iter=max_iter, verbose=True, 
-                          eps_abs=abs_tol, eps_rel=rel_tol)
+                          scaling=0, max_iter=max_iter, verbose=True, 
+                          eps_abs=abs_tol, eps_rel=rel_tol, **adaptive_rho)
 
         num = z0_mat.shape[0]
         solve_times = np.zeros(num)
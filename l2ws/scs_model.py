@@ -4,15 +4,23 @@ import cvxpy as cp
 import jax.numpy as jnp
 import numpy as np
 import scs
+from jax import vmap
 from scipy.sparse import csc_matrix
 
 from l2ws.algo_steps import (
     create_M,
+    create_projection_fn,
+    get_scale_bank,
     get_scaled_vec_and_factor,
+    init_psd_state,
     k_steps_eval_scs,
+    k_steps_tol_scs,
     k_steps_train_scs,
+    lin_sys_solve,
 )
 from l2ws.l2ws_model import L2WSmodel
+from l2ws.utils.anderson_utils import get_scs_acceleration_lookback
+from l2ws.utils.precision_utils import cast_floating
 
 
 class SCSmodel(L2WSmodel):
@@ -38,10 +46,6 @@ class SCSmodel(L2WSmodel):
         self.P = M[:self.n, :self.n]
         self.A = -M[self.n:, :self.n]
 
-        factor = input_dict['static_algo_factor']
-        self.factor = factor
-        self.factor_static = factor
-
         # hyperparameters of scs
         self.rho_x = input_dict.get('rho_x', 1)
         self.scale = input_dict.get('scale', 1)
@@ -49,8 +53,47 @@ class SCSmodel(L2WSmodel):
 
         # not a hyperparameter, but used for scale knob
         self.zero_cone_size = self.cones['z'] #input_dict['zero_cone_size']
+
+        # refactor if a different factorization than the dense lu is requested
+        self.factor_method = input_dict.get('factor_method', 'lu')
+        if self.factor_method == 'lu':
+            factor = input_dict['static_algo_factor']
+        else:
+            factor, _ = get_scaled_vec_and_factor(M, self.rho_x, self.scale, self.m, self.n,
+                                                  self.zero_cone_size,
+                                                  factor_method=self.factor_method)
+        self.factor = factor
+        self.factor_static = factor
+
+        # cache of r = (I + M)^{-1} q for the train and test problems (see get_q_mat)
+        self.r_mat_train, self.r_mat_test, self.r_factor = None, None, None
         lightweight = input_dict.get('lightweight', False)
 
+        # policy of the iterates where the eval kernel computes the primal and dual residuals
+        #   (see get_metric_mask), None computes them at every iteration
+        self.residual_steps = input_dict.get('residual_steps', None)
+
+        # the eval and tol kernels project the psd cones with more than psd_rank rows onto their
+        #   leading eigenpairs (training keeps the full eigendecomposition)
+        self.psd_rank = input_dict.get('psd_rank', None)
+        if self.psd_rank is None:
+            self.proj_eval = self.proj
+        else:
+            self.proj_eval = create_projection_fn(self.cones, self.n, psd_rank=self.psd_rank)
+        psd_state = cast_floating(init_psd_state(self.cones, self.psd_rank),
+                                  self.precision['compute'])
+
+        # adaptive scale of the eval and tol kernels (None keeps the scale fixed), a dict with
+        #   the keys of ADAPTIVE_SCALE_DEFAULTS in l2ws/algo_steps.py (True gives the defaults)
+        #   the factors of all the scales are computed here (see get_scale_bank)
+        self.adaptive_scale = input_dict.get('adaptive_scale', None)
+        scale_bank = None
+        if self.adaptive_scale is not None:
+            scale_bank = get_scale_bank(M, self.rho_x, self.scale, self.m, self.n,
+                                        self.zero_cone_size, self.adaptive_scale,
+                                        factor_method=self.factor_method)
+            scale_bank = cast_floating(scale_bank, self.precision['compute'])
+
         self.output_size = self.n + self.m
         self.out_axes_length = 8
 
@@ -60,15 +103,62 @@ class SCSmodel(L2WSmodel):
                                         m=self.m,
                                         n=self.n,
                                         zero_cone_size=self.zero_cone_size,
-                                        hsde=True)
-        self.k_steps_eval_fn = partial(k_steps_eval_scs, factor=factor, proj=self.proj,
+                                        hsde=True,
+                                        anderson=self.anderson,
+                                        diff_mode=self.diff_mode,
+                                        segment_length=self.segment_length,
+                                        acc_dtype=self.precision['accumulation'])
+        self.k_steps_eval_fn = partial(k_steps_eval_scs, factor=factor, proj=self.proj_eval,
                                        P=self.P, A=self.A,
                                        zero_cone_size=self.zero_cone_size,
                                        rho_x=self.rho_x, scale=self.scale,
                                        alpha=self.alpha_relax,
                                        jit=self.jit,
                                        hsde=True,
-                                       lightweight=lightweight)
+                                       lightweight=lightweight,
+                                       record=self.record,
+                                       anderson=self.anderson,
+                                       psd_state=psd_state,
+                                       residual_steps=self.residual_steps,
+                                       scale_bank=scale_bank,
+                                       acc_dtype=self.precision['accumulation'])
+        self.k_steps_tol_fn = partial(k_steps_tol_scs, factor=factor, proj=self.proj_eval,
+                                      P=self.P, A=self.A,
+                                      zero_cone_size=self.zero_cone_size,
+                                      rho_x=self.rho_x, scale=self.scale,
+                                      alpha=self.alpha_relax,
+                                      jit=self.jit,
+                                      hsde=True,
+                                      tol_metric=input_dict.get('tol_metric', 'fixed_point'),
+                                      psd_state=psd_state,
+                                      scale_bank=scale_bank,
+                                      acc_dtype=self.precision['accumulation'])
+
+    def get_q_mat(self, train=True):
+        """
+        returns (q_mat, r_mat) where the rows of r_mat are r = (I + M)^{-1} q so that the loss
+            functions do not solve the linear system for every problem in every batch
+        r_mat is computed (batched) at the first call and again only if the factor changes
+        if the factors change for each problem or the training problems are streamed (train),
+            the loss functions solve for r and only q_mat is returned
+        """
+        if not self.factor_static_bool or (train and self.stream is not None):
+            return super().get_q_mat(train)
+        if self.r_factor is not self.factor_static:
+            self.cache_r()
+        if train:
+            return self.q_mat_train, self.r_mat_train
+        return self.q_mat_test, self.r_mat_test
+
+    def cache_r(self):
+        # r_mat is kept in the compute dtype (it is the solve the loss functions would do)
+        compute = self.precision['compute']
+        factor = cast_floating(self.factor_static, compute)
+        batch_solve = vmap(partial(lin_sys_solve, factor))
+        if self.stream is None:
+            self.r_mat_train = batch_solve(cast_floating(self.q_mat_train, compute))
+        self.r_mat_test = batch_solve(cast_floating(self.q_mat_test, compute))
+        self.r_factor = self.factor_static
 
     # def setup_optimal_solutions(self, dict):
     def setup_optimal_solutions(self, 
@@ -84,13 +174,15 @@ class SCSmodel(L2WSmodel):
             # self.x_stars_train, self.x_stars_test = dict['x_stars_train'], dict['x_stars_test']
             # self.z_stars_train = jnp.array(dict['z_stars_train'])
             # self.z_stars_test = jnp.array(dict['z_stars_test'])
-            self.z_stars_train = jnp.array(z_stars_train)
+            # the streamed training solutions stay on the host
+            xp = np if self.stream is not None else jnp
+            self.z_stars_train = xp.asarray(z_stars_train)
             self.z_stars_test = jnp.array(z_stars_test)
-            self.x_stars_train = jnp.array(x_stars_train)
+            self.x_stars_train = xp.asarray(x_stars_train)
             self.x_stars_test = jnp.array(x_stars_test)
-            self.y_stars_train = jnp.array(y_stars_train)
+            self.y_stars_train = xp.asarray(y_stars_train)
             self.y_stars_test = jnp.array(y_stars_test)
-            self.u_stars_train = jnp.hstack([self.x_stars_train, self.y_stars_train])
+            self.u_stars_train = xp.hstack([self.x_stars_train, self.y_stars_train])
             self.u_stars_test = jnp.hstack([self.x_stars_test, self.y_stars_test])
         if z_stars_train is not None:
             self.z_stars_train = z_stars_train
@@ -116,10 +208,10 @@ class SCSmodel(L2WSmodel):
                          self.cones,
                          normalize=False,
                          scale=self.scale,
-                         adaptive_scale=False,
+                         adaptive_scale=self.adaptive_scale is not None,
                          rho_x=self.rho_x,
                          alpha=self.alpha_relax,
-                         acceleration_lookback=0,
+                         acceleration_lookback=get_scs_acceleration_lookback(self.anderson),
                          max_iters=max_iter,
                          eps_abs=abs_tol,
                          eps_rel=rel_tol,
@@ -136,6 +136,8 @@ def scs_jax(data, hsde=True, rho_x=1e-6, scale=.1, alpha=1.5, iters=5000, jit=Tr
 def ruiz_equilibrate(M, num_passes=20):
     """
     NOT USED ANYWHERE -- ONLY BRIEFLY TESTED
+    the setup data is equilibrated with the symmetric (and cone-aware) get_ruiz_scaling
+        in l2ws/utils/equilibration_utils.py
     """
     p, p_ = M.shape
     D, E = jnp.eye(p), jnp.eye(p)
@@ -0,0 +1,141 @@
+import jax.numpy as jnp
+from jax import lax
+
+from l2ws.utils.generic_utils import python_scan
+
+# defaults of the anderson acceleration dict
+#   mem: number of past differences kept in the ring buffer
+#   type: 1 (type-I) or 2 (type-II)
+#   regularization: tikhonov regularization of the small least-squares system
+#       (relative to the size of the stored differences)
+#   safeguard_factor: an extrapolated iterate is rejected if its fixed point residual is larger
+#       than safeguard_factor times the residual of the previous iterate
+ANDERSON_DEFAULTS = dict(mem=5, type=2, regularization=1e-10, safeguard_factor=1.0)
+
+
+def get_anderson_params(anderson):
+    """
+    fills in the defaults of the anderson dict
+    anderson=True gives the defaults
+    """
+    if anderson is True:
+        anderson = {}
+    params = dict(ANDERSON_DEFAULTS)
+    params.update(anderson)
+    if params['type'] not in [1, 2]:
+        raise ValueError(f"anderson type must be 1 or 2, got {params['type']}")
+    if params['mem'] < 1:
+        raise ValueError(f"anderson mem must be positive, got {params['mem']}")
+    return params
+
+
+def anderson_init(z0, mem):
+    """
+    returns the initial anderson state for the iterate z0
+
+    the state is (S, Y, z_prev, g_prev, z_safe, g_sq_prev, t, extrapolated) where
+        S[j], Y[j] are the ring buffers of iterate and residual differences
+            s = z^i - z^{i-1} and y = g^i - g^{i-1} with the residual g = z - T(z)
+        z_prev, g_prev are the previous iterate and its residual
+        z_safe = T(z_prev) is the plain iterate we fall back to if the safeguard rejects
+        g_sq_prev = ||g_prev||^2
+        t is the number of steps since the last reset
+        extrapolated tells us if the current iterate came from an anderson step
+    """
+    S = jnp.zeros((mem, z0.size), dtype=z0.dtype)
+    Y = jnp.zeros((mem, z0.size), dtype=z0.dtype)
+    g_sq_prev = jnp.array(jnp.inf, dtype=z0.dtype)
+    return S, Y, z0, jnp.zeros_like(z0), z0, g_sq_prev, jnp.array(0), jnp.array(False)
+
+
+def anderson_update(z, z_next, aa_state, params):
+    """
+    given the current iterate z and z_next = T(z), returns the next (accelerated) iterate
+        and the new anderson state
+
+    type-II: gamma = argmin ||g - Y^T gamma||_2 (regularized normal equations)
+    type-I: gamma solves (S Y^T) gamma = S g
+    the accelerated iterate is z_next - (S - Y)^T gamma
+
+    only fixed-size buffers and jnp.where are used so that the update can be jitted and
+        vmapped and is differentiable
+    """
+    S, Y, z_prev, g_prev, z_safe, g_sq_prev, t, extrapolated = aa_state
+    mem = S.shape[0]
+    g = z - z_next
+    g_sq = jnp.sum(g ** 2)
+
+    # safeguard: reject the extrapolated iterate if it increased the residual
+    reject = extrapolated & (g_sq > params['safeguard_factor'] ** 2 * g_sq_prev)
+
+    # store the newest differences in the ring buffer
+    slot = jnp.mod(t - 1, mem)
+    has_prev = t > 0
+    S = jnp.where(has_prev, S.at[slot].set(z - z_prev), S)
+    Y = jnp.where(has_prev, Y.at[slot].set(g - g_prev), Y)
+    num_filled = jnp.minimum(t, mem)
+    filled = jnp.arange(mem) < num_filled
+
+    # small (mem x mem) regularized system, the unfilled rows are decoupled with gamma_j = 0
+    if params['type'] == 1:
+        H, rhs = S @ Y.T, S @ g
+        reg_scale = (jnp.sum(S ** 2) + jnp.sum(Y ** 2)) / 2
+    else:
+        H, rhs = Y @ Y.T, Y @ g
+        reg_scale = jnp.sum(Y ** 2)
+    mask = jnp.outer(filled, filled)
+    reg = params['regularization'] * reg_scale + jnp.finfo(H.dtype).eps
+    H = jnp.where(mask, H, 0) + jnp.diag(jnp.where(filled, reg, 1.0))
+    gamma = jnp.linalg.solve(H, jnp.where(filled, rhs, 0))
+    z_aa = z_next - (S - Y).T @ gamma
+
+    accelerate = num_filled > 0
+    z_out = jnp.where(reject, z_safe, jnp.where(accelerate, z_aa, z_next))
+
+    # after a rejection we restart from z_safe with an empty memory
+    new_state = (jnp.where(reject, 0, S),
+                 jnp.where(reject, 0, Y),
+                 z,
+                 g,
+                 z_next,
+                 g_sq,
+                 jnp.where(reject, 0, t + 1),
+                 ~reject & accelerate)
+    return z_out, new_state
+
+
+def anderson_scan(f, init, xs, jit, anderson=None, scan=None):
+    """
+    runs the scan f(carry, x) -> (carry, y) over xs where carry[0] is the iterate
+        and f returns T(carry[0]) as the first entry of the new carry
+    scan(f, init, xs) runs the scan, by default lax.scan (or python_scan if jit is False)
+
+    if anderson is not None, the iterate is anderson-accelerated: the other entries of the
+        carry and the outputs y (losses, histories, residuals) are computed by f at the
+        accelerated iterates so the iterate histories record the operator outputs T(z^i)
+    """
+    if scan is None:
+        scan = lax.scan if jit else python_scan
+    if anderson is None:
+        return scan(f, init, xs)
+    params = get_anderson_params(anderson)
+    aa_state = anderson_init(init[0], params['mem'])
+
+    def aa_f(carry, x):
+        val, aa_state = carry
+        val_next, y = f(val, x)
+        z_next, aa_state = anderson_update(val[0], val_next[0], aa_state, params)
+        return ((z_next,) + tuple(val_next[1:]), aa_state), y
+    (out, aa_state), ys = scan(aa_f, (init, aa_state), xs)
+    return out, ys
+
+
+def get_scs_acceleration_lookback(anderson):
+    """
+    returns the acceleration_lookback of the C implementation of scs that matches the anderson
+        dict (positive for type-II, negative for type-I, 0 for no acceleration)
+    """
+    if anderson is None:
+        return 0
+    params = get_anderson_params(anderson)
+    return params['mem'] if params['type'] == 2 else -params['mem']
@@ -0,0 +1,78 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import jax
+from jax.experimental.compilation_cache import compilation_cache
+
+# compilation of the jitted functions of a run (run cfg compilation)
+#   cache_dir: directory of the persistent xla compilation cache shared by all runs (None to
+#       disable), jax keys each entry on the lowered computation, so the model config, the
+#       shapes and the static iters are part of the key
+#       (jax only uses the cache on gpu and tpu, or on cpu with
+#       XLA_FLAGS=--xla_cpu_use_xla_runtime=true)
+#   min_compile_time_secs: only executables that take longer to compile are written to the cache
+#   warm_up: compile the executables of the run ahead of time in a background thread
+COMPILATION_DEFAULTS = dict(cache_dir=os.path.join('~', '.cache', 'l2ws', 'jax'),
+                            min_compile_time_secs=1,
+                            warm_up=True)
+
+
+def get_compilation_params(compilation):
+    """
+    fills in the defaults of the compilation dict (see COMPILATION_DEFAULTS)
+    """
+    params = dict(COMPILATION_DEFAULTS)
+    params.update(compilation if compilation is not None else {})
+    return params
+
+
+def init_compilation_cache(params):
+    """
+    points jax to the persistent compilation cache of params['cache_dir']
+    the cache is initialized once per process, later calls keep the first directory
+    """
+    if params['cache_dir'] is None or compilation_cache.is_initialized():
+        return
+    cache_dir = os.path.expanduser(params['cache_dir'])
+    os.makedirs(cache_dir, exist_ok=True)
+    jax.config.update('jax_persistent_cache_min_compile_time_secs',
+                      params['min_compile_time_secs'])
+    compilation_cache.initialize_cache(cache_dir)
+
+
+def compile_job(fn, args):
+    """
+    lowers and compiles the jitted fn for the shapes (and static values) of args
+    jax reuses the executable when fn is later called with arguments of the same shapes
+    returns the compile time in seconds
+    """
+    t0 = time.time()
+    fn.lower(*args).compile()
+    return time.time() - t0
+
+
+class WarmUp(object):
+    def __init__(self, jobs):
+        """
+        compiles the jobs, a list of (name, jitted fn, args), one at a time in order in a
+            background thread
+        the jobs should be ordered by their first use since wait(name) blocks until the
+            job is compiled
+        """
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.futures = {name: self.executor.submit(compile_job, fn, args)
+                        for name, fn, args in jobs}
+        self.executor.shutdown(wait=False)
+
+    def wait(self, name):
+        """
+        blocks until the job name is compiled and returns (compile_time, wait_time)
+        returns None if there is no such job or it was already waited on
+        """
+        future = self.futures.pop(name, None)
+        if future is None:
+            return None
+        t0 = time.time()
+        compile_time = future.result()
+        return compile_time, time.time() - t0
@@ -1,7 +1,21 @@
 import os
+import queue
+import threading
+import zipfile
 
 import hydra
+import jax
+import numpy as np
 import yaml
+from jax import tree_util
+
+# streaming of the training problems from the host (run cfg stream, see BatchStream)
+#   chunk_batches: number of batches that are put on the device and trained on together
+#       (None is one epoch), the training blocks must be a whole number of chunks
+#   buffer_size: number of chunks on the device at a time, the one that trains and the ones
+#       the prefetch thread prepares (2 is double buffering)
+#   seed: seed of the permutations of the epochs
+STREAM_DEFAULTS = dict(chunk_batches=None, buffer_size=2, seed=0)
 
 
 def recover_last_datetime(orig_cwd, example, stage):
@@ -40,3 +54,151 @@ def copy_data_file(example, datetime):
     # write the yaml file to the train_outputs folder
     with open('data_setup_copied.yaml', 'w') as file:
         yaml.dump(setup_cfg, file)
+
+
+def get_stream_params(stream):
+    """
+    fills in the defaults of the stream dict (see STREAM_DEFAULTS)
+    stream=True gives the defaults
+    """
+    if stream is True:
+        stream = {}
+    params = dict(STREAM_DEFAULTS)
+    params.update(stream)
+    if params['buffer_size'] < 1:
+        raise ValueError("buffer_size must be at least 1")
+    return params
+
+
+def load_npz_memmap(filename, folder, chunk_bytes=2 ** 26):
+    """
+    loads the arrays of the npz archive filename as memory-mapped arrays
+    the first call extracts each member to folder/<key>.npy, copying chunk_bytes at a time so
+        that no array is ever fully in memory, and later calls reuse the extracted files
+        unless the archive is newer
+    object arrays (e.g., pickled dicts) are loaded into memory
+
+    returns a dict of the arrays
+    """
+    os.makedirs(folder, exist_ok=True)
+    arrays = {}
+    with zipfile.ZipFile(filename) as archive:
+        for member in archive.namelist():
+            key = member[:-4] if member.endswith('.npy') else member
+            path = os.path.join(folder, f"{key}.npy")
+            up_to_date = os.path.exists(path) and \
+                os.path.getmtime(path) >= os.path.getmtime(filename)
+            if not up_to_date:
+                with archive.open(member) as f:
+                    version = np.lib.format.read_magic(f)
+                    if version == (1, 0):
+                        shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+                    else:
+                        shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+                    if dtype.hasobject:
+                        arrays[key] = np.load(filename, allow_pickle=True)[key]
+                        continue
+                    out = np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=shape,
+                                                    fortran_order=fortran_order)
+                    flat_out = out.reshape(-1, order='F' if fortran_order else 'C')
+                    chunk_size = max(chunk_bytes // max(dtype.itemsize, 1), 1)
+                    for start in range(0, flat_out.size, chunk_size):
+                        num = min(chunk_size, flat_out.size - start)
+                        flat_out[start:start + num] = np.frombuffer(
+                            f.read(num * dtype.itemsize), dtype=dtype)
+                    out.flush()
+                    del flat_out, out
+            arrays[key] = np.load(path, mmap_mode='r')
+    return arrays
+
+
+class BatchStream(object):
+    def __init__(self, data, batch_size, chunk_batches, dtype=None, seed=0, buffer_size=2):
+        """
+        streams the training problems to the device in chunks of chunk_batches batches
+
+        data is a pytree of host arrays (e.g., memory-mapped) with one row per problem
+        each epoch goes over the rows in the order of a new random permutation (the
+            N % batch_size rows left over in an epoch are skipped) and the rows of each
+            batch are read in sorted order
+        a background thread gathers the rows of the next chunks, casts the floating arrays to
+            dtype, and puts them on the device, so that up to buffer_size chunks are on the
+            device at a time (the one that trains and the prefetched ones)
+        an exception in the thread is raised by the next call of next_chunk
+        close stops the thread and drops the prefetched chunks
+        """
+        self.data, self.batch_size, self.chunk_batches = data, batch_size, chunk_batches
+        self.dtype = dtype
+        self.num_rows = tree_util.tree_leaves(data)[0].shape[0]
+        self.num_batches = int(self.num_rows / batch_size)
+        self.rng = np.random.default_rng(seed)
+
+        # a slot is taken before a chunk is put on the device and given back once the
+        #   consumer asks for the chunk after it, so the training chunk holds one of them
+        self.slots = threading.Semaphore(buffer_size)
+        self.holds_slot = False
+        self.chunks = queue.Queue()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.prefetch, daemon=True)
+        self.thread.start()
+
+    def batch_indices(self):
+        """
+        generates (indices, epoch_end) for the batches of the epochs
+        """
+        while True:
+            permutation = self.rng.permutation(self.num_rows)
+            for i in range(self.num_batches):
+                indices = permutation[i * self.batch_size:(i + 1) * self.batch_size]
+                yield np.sort(indices), i == self.num_batches - 1
+
+    def gather(self, indices):
+        """
+        returns the pytree of the host rows indices, the floating ones cast to dtype
+        """
+        def gather_rows(x):
+            rows = np.asarray(x[indices])
+            if self.dtype is not None and np.issubdtype(rows.dtype, np.floating):
+                rows = rows.astype(self.dtype, copy=False)
+            return rows
+        return tree_util.tree_map(gather_rows, self.data)
+
+    def prefetch(self):
+        try:
+            batches = self.batch_indices()
+            while not self.stopped.is_set():
+                indices, epoch_ends = zip(*[next(batches) for _ in range(self.chunk_batches)])
+                rows = self.gather(np.concatenate(indices))
+                chunk = tree_util.tree_map(
+                    lambda x: x.reshape((self.chunk_batches, self.batch_size) + x.shape[1:]),
+                    rows)
+                while not self.slots.acquire(timeout=.1):
+                    if self.stopped.is_set():
+                        return
+                self.chunks.put(jax.device_put((chunk, np.array(epoch_ends))))
+        except Exception as e:
+            self.chunks.put(e)
+
+    def next_chunk(self):
+        """
+        returns (chunk, epoch_ends) where chunk is the device pytree of the next batches with
+            leaves of shape (chunk_batches, batch_size, ...) and epoch_ends marks the batches
+            that finish an epoch
+        the chunk returned by the previous call must no longer be in use
+        """
+        if self.holds_slot:
+            self.slots.release()
+            self.holds_slot = False
+        chunk = self.chunks.get()
+        if isinstance(chunk, Exception):
+            # the thread has stopped, so later calls raise the same exception
+            self.chunks.put(chunk)
+            raise chunk
+        self.holds_slot = True
+        return chunk
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+        while not self.chunks.empty():
+            self.chunks.get_nowait()
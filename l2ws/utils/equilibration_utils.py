@@ -0,0 +1,108 @@
+import numpy as np
+from scipy.sparse import bmat, csc_matrix, diags
+
+# ruiz equilibration of the setup data (see get_ruiz_scaling)
+#   num_passes: number of passes over the rows and columns of the kkt matrix
+#   min_scale, max_scale: bounds on the norms that are equilibrated (smaller norms, e.g. of
+#       empty rows, are left alone and larger ones are only partially scaled)
+RUIZ_DEFAULTS = dict(num_passes=20, min_scale=1e-4, max_scale=1e4)
+
+
+def get_ruiz_params(equilibrate):
+    """
+    fills in the defaults of the equilibrate dict (see RUIZ_DEFAULTS)
+    equilibrate=True gives the defaults
+    """
+    if equilibrate is True:
+        equilibrate = {}
+    params = dict(RUIZ_DEFAULTS)
+    params.update(equilibrate)
+    if params['num_passes'] < 1 or not 0 < params['min_scale'] <= 1 <= params['max_scale']:
+        raise ValueError("num_passes must be at least 1 and min_scale <= 1 <= max_scale")
+    return params
+
+
+def get_ruiz_scaling(P, A, equilibrate=True, cones=None):
+    """
+    symmetric ruiz equilibration of the (sparse) kkt matrix [[P, A^T], [A, 0]]
+
+    returns the positive vectors (D, E) so that the rows and columns of the scaled problem
+        P_hat = E P E, A_hat = D A E, c_hat = E c, (b_hat, l_hat, u_hat) = D (b, l, u)
+        have inf-norms close to 1
+    the solutions are related by x = E x_hat, y = D y_hat, s = s_hat / D (see scale_solutions)
+
+    if cones is given (scs), D is constant on each second-order and psd cone so that
+        the scaling maps each cone to itself
+    """
+    params = get_ruiz_params(equilibrate)
+    m, n = A.shape
+    P, A = csc_matrix(P), csc_matrix(A)
+    kkt = bmat([[P, A.T], [A, None]], format='csc')
+    blocks = get_cone_blocks(cones, n) if cones is not None else []
+
+    scaling = np.ones(n + m)
+    for _ in range(params['num_passes']):
+        # the kkt matrix is symmetric, the column norms are the row norms
+        norms = abs(kkt).max(axis=0).toarray().ravel()
+        norms = np.where(norms < params['min_scale'], 1, np.minimum(norms, params['max_scale']))
+        delta = 1 / np.sqrt(norms)
+        for start, end in blocks:
+            delta[start:end] = delta[start:end].mean()
+        kkt = diags(delta) @ kkt @ diags(delta)
+        scaling = scaling * delta
+    return scaling[n:], scaling[:n]
+
+
+def get_cone_blocks(cones, n):
+    """
+    returns the (start, end) indices into the kkt rows of the second-order and psd cones
+    """
+    blocks = []
+    start = n + cones['z'] + cones['l']
+    soc_sizes = list(cones.get('q', []))
+    sdp_vector_sizes = [int(size * (size + 1) / 2) for size in cones.get('s', [])]
+    for size in soc_sizes + sdp_vector_sizes:
+        blocks.append((start, start + size))
+        start += size
+    return blocks
+
+
+def equilibrate_matrices(P, A, D, E):
+    """
+    returns the scaled (dense) matrices (E P E, D A E)
+    """
+    return E[:, None] * P * E[None, :], D[:, None] * A * E[None, :]
+
+
+def scale_q_mat(q_mat, D, E, algo):
+    """
+    scales the rows of q_mat
+        scs: q = (c, b) -> (E c, D b)
+        osqp: q = (c, l, u) -> (E c, D l, D u)
+    """
+    num_bounds = 2 if algo == 'osqp' else 1
+    return q_mat * np.concatenate([E] + [D] * num_bounds)
+
+
+def scale_solutions(D, E, x_stars, y_stars, s_stars=None):
+    """
+    maps the solutions of the original problem to the solutions of the scaled problem
+        (x, y, s) -> (x / E, y / D, D s)
+    """
+    x_hat, y_hat = x_stars / E, y_stars / D
+    if s_stars is None:
+        return x_hat, y_hat
+    return x_hat, y_hat, s_stars * D
+
+
+def scale_osqp_z(z_stars, D, E):
+    """
+    maps the rows z = (x, y) or z = (x, y, w) of osqp to the scaled problem
+        where w = A x is scaled like the constraints (w -> D w)
+    """
+    m, n = D.size, E.size
+    x_hat, y_hat = scale_solutions(D, E, z_stars[:, :n], z_stars[:, n:n + m])
+    if z_stars.shape[1] == n + m:
+        return np.hstack([x_hat, y_hat])
+    return np.hstack([x_hat, y_hat, z_stars[:, n + m:] * D])
+
@@ -0,0 +1,320 @@
+import jax.numpy as jnp
+import jax.scipy as jsp
+import numpy as np
+from jax import lax
+from jax.tree_util import register_pytree_node_class
+from scipy.sparse import bmat, csc_matrix, diags, identity
+from scipy.sparse.linalg import splu
+
+# default relative tolerance and iteration cap of the matrix-free cg solves
+CG_TOL = 1e-10
+CG_MAXITER = 100
+
+
+@register_pytree_node_class
+class SparseLDLFactor(object):
+    """
+    sparse LDL^T factorization of a symmetric quasi-definite matrix K computed on the host
+        K[perm, :][:, perm] = L diag(d) L^T
+
+    the factor solves M x = b where K = diag(signs) M
+        the right-hand side is padded with zeros up to the size of K and only the first
+        num_out entries of the solution are returned
+    this lets scs factor S (M + diag(scale_vec)) with S = diag(1, ..., 1, -1, ..., -1) and
+        lets osqp factor its kkt matrix instead of P + sigma I + A^T diag(rho) A
+
+    the triangular solves are level scheduled on the host: the entries of L are grouped
+        into chunks that only depend on earlier chunks and a lax.scan runs over the chunks
+        so that the memory and the work of each solve scale with nnz(L)
+    """
+
+    def __init__(self, fwd, bwd, d, perm, signs, num_out):
+        self.fwd = fwd
+        self.bwd = bwd
+        self.d = d
+        self.perm = perm
+        self.signs = signs
+        self.num_out = num_out
+
+    def solve(self, b, x0=None):
+        rhs = jnp.zeros(self.d.size, dtype=jnp.result_type(b, self.d))
+        rhs = rhs.at[:b.size].set(b) * self.signs
+
+        # L diag(d) L^T y = rhs[perm]
+        y = chunked_triangular_solve(self.fwd, rhs[self.perm])
+        y = y / self.d
+        y = chunked_triangular_solve(self.bwd, y)
+
+        x = jnp.zeros_like(y).at[self.perm].set(y)
+        return x[:self.num_out]
+
+    def tree_flatten(self):
+        children = (self.fwd, self.bwd, self.d, self.perm, self.signs)
+        return children, self.num_out
+
+    @classmethod
+    def tree_unflatten(cls, num_out, children):
+        return cls(*children, num_out)
+
+
+@register_pytree_node_class
+class CholeskyFactor(object):
+    """
+    cholesky factor of a symmetric positive definite matrix (lower triangular, no pivots)
+    """
+
+    def __init__(self, L):
+        self.L = L
+
+    def solve(self, b, x0=None):
+        return jsp.linalg.cho_solve((self.L, True), b)
+
+    def tree_flatten(self):
+        return (self.L,), None
+
+    @classmethod
+    def tree_unflatten(cls, aux, children):
+        return cls(*children)
+
+
+@register_pytree_node_class
+class InverseFactor(object):
+    """
+    explicit inverse of a small matrix so that each solve is a single matvec
+    """
+
+    def __init__(self, inv):
+        self.inv = inv
+
+    def solve(self, b, x0=None):
+        return self.inv @ b
+
+    def tree_flatten(self):
+        return (self.inv,), None
+
+    @classmethod
+    def tree_unflatten(cls, aux, children):
+        return cls(*children)
+
+
+@register_pytree_node_class
+class QuasiDefiniteFactor(object):
+    """
+    solves (M + diag(scale_vec)) u = b for the scs matrix M = [P A^T; -A 0]
+        by eliminating the dual block with D = diag(scale_vec[n:])
+    the x block solves the positive definite system
+        (P + diag(scale_vec[:n]) + A^T D^{-1} A) x = b_x - A^T D^{-1} b_y
+        and then y = D^{-1} (b_y + A x)
+    only the n x n cholesky factor is stored on top of A
+    """
+
+    def __init__(self, L, A, d_inv):
+        self.L = L
+        self.A = A
+        self.d_inv = d_inv
+
+    def solve(self, b, x0=None):
+        n = self.L.shape[0]
+        b_x, b_y = b[:n], b[n:]
+        x = jsp.linalg.cho_solve((self.L, True), b_x - self.A.T @ (self.d_inv * b_y))
+        y = self.d_inv * (b_y + self.A @ x)
+        return jnp.concatenate([x, y])
+
+    def tree_flatten(self):
+        return (self.L, self.A, self.d_inv), None
+
+    @classmethod
+    def tree_unflatten(cls, aux, children):
+        return cls(*children)
+
+
+@register_pytree_node_class
+class CGFactor(object):
+    """
+    matrix-free solves with jacobi preconditioned conjugate gradient
+        the positive definite operator P + diag(d_x) + A^T diag(w) A is applied as
+        matvecs with P and A so no matrix is ever factored
+
+    for osqp the system is P + sigma I + A^T diag(rho) A (d_x = sigma, w = rho)
+    for scs (scs_system=True) the system is M + diag(scale_vec) and the dual block is
+        eliminated as in QuasiDefiniteFactor (d_x = scale_vec[:n], w = 1 / scale_vec[n:])
+
+    x0 is the initial guess for cg and the number of cg iterations is capped by maxiter
+    the solve is differentiable (jax solves the adjoint system with cg as well)
+    """
+
+    def __init__(self, P, A, d_x, w, diag, scs_system, tol, maxiter):
+        self.P = P
+        self.A = A
+        self.d_x = d_x
+        self.w = w
+        self.diag = diag
+        self.scs_system = scs_system
+        self.tol = tol
+        self.maxiter = maxiter
+
+    def matvec(self, x):
+        return self.P @ x + self.d_x * x + self.A.T @ (self.w * (self.A @ x))
+
+    def solve(self, b, x0=None):
+        n = self.P.shape[0]
+        if self.scs_system:
+            b_x, b_y = b[:n], b[n:]
+            rhs = b_x - self.A.T @ (self.w * b_y)
+        else:
+            rhs = b
+        x_guess = None if x0 is None else x0[:n]
+        x, _ = jsp.sparse.linalg.cg(self.matvec, rhs, x0=x_guess, tol=self.tol,
+                                    maxiter=self.maxiter, M=lambda v: v / self.diag)
+        if self.scs_system:
+            y = self.w * (b_y + self.A @ x)
+            return jnp.concatenate([x, y])
+        return x
+
+    def tree_flatten(self):
+        children = (self.P, self.A, self.d_x, self.w, self.diag)
+        return children, (self.scs_system, self.tol, self.maxiter)
+
+    @classmethod
+    def tree_unflatten(cls, aux, children):
+        return cls(*children, *aux)
+
+
+def cg_factor(P, A, d_x, w, scs_system, tol=CG_TOL, maxiter=CG_MAXITER):
+    diag = jnp.diag(P) + d_x + (A ** 2).T @ w
+    return CGFactor(P, A, d_x, w, diag, scs_system, tol, maxiter)
+
+
+def scs_cg_factor(P, A, scale_vec, tol=CG_TOL, maxiter=CG_MAXITER):
+    m, n = A.shape
+    return cg_factor(P, A, scale_vec[:n], 1 / scale_vec[n:], True, tol=tol, maxiter=maxiter)
+
+
+def osqp_cg_factor(P, A, rho_vec, sigma, tol=CG_TOL, maxiter=CG_MAXITER):
+    m, n = A.shape
+    d_x = sigma * jnp.ones(n)
+    w = jnp.broadcast_to(rho_vec, (m,))
+    return cg_factor(P, A, d_x, w, False, tol=tol, maxiter=maxiter)
+
+
+def scs_quasi_definite_factor(P, A, scale_vec):
+    m, n = A.shape
+    d_inv = 1 / scale_vec[n:]
+    H = P + jnp.diag(scale_vec[:n]) + A.T @ jnp.diag(d_inv) @ A
+    return QuasiDefiniteFactor(jnp.linalg.cholesky(H), A, d_inv)
+
+
+def chunked_triangular_solve(chunks, x):
+    """
+    solves a unit triangular system in place
+    chunks = (targets, sources, vals) each with shape (num_chunks, chunk_size)
+        and we apply x[target] -= val * x[source] one chunk at a time
+    padded entries have target = x.size and are dropped
+    """
+    def body(x, chunk):
+        targets, sources, vals = chunk
+        return x.at[targets].add(-vals * x[sources], mode='drop'), None
+    x, _ = lax.scan(body, x, chunks)
+    return x
+
+
+def level_schedule(targets, sources, vals, size, reverse=False):
+    """
+    groups the off-diagonal entries of a unit triangular matrix into padded chunks
+
+    an entry (target, source, val) means x[target] -= val * x[source]
+        where the source is solved before the target
+        i.e. source < target for forward substitution and source > target if reverse
+    the level of a row is one more than the largest level of the rows it depends on
+        and every chunk only holds entries whose targets are in the same level
+    """
+    order = np.argsort(targets, kind='stable')
+    targets, sources, vals = targets[order], sources[order], vals[order]
+    starts = np.searchsorted(targets, np.arange(size + 1))
+
+    levels = np.zeros(size, dtype=int)
+    rows = range(size - 1, -1, -1) if reverse else range(size)
+    for i in rows:
+        deps = sources[starts[i]:starts[i + 1]]
+        if deps.size > 0:
+            levels[i] = levels[deps].max() + 1
+
+    entry_levels = levels[targets]
+    order = np.argsort(entry_levels, kind='stable')
+    targets, sources, vals = targets[order], sources[order], vals[order]
+    entry_levels = entry_levels[order]
+
+    num_levels = max(levels.max(), 1)
+    chunk_size = max(int(np.ceil(targets.size / num_levels)), 1)
+
+    # split each level into chunks of size chunk_size
+    level_starts = np.searchsorted(entry_levels, np.arange(1, num_levels + 2))
+    chunk_targets, chunk_sources, chunk_vals = [], [], []
+    for j in range(num_levels):
+        for k in range(level_starts[j], level_starts[j + 1], chunk_size):
+            end = min(k + chunk_size, level_starts[j + 1])
+            pad = chunk_size - (end - k)
+            chunk_targets.append(np.pad(targets[k:end], (0, pad), constant_values=size))
+            chunk_sources.append(np.pad(sources[k:end], (0, pad)))
+            chunk_vals.append(np.pad(vals[k:end], (0, pad)))
+    if len(chunk_targets) == 0:
+        chunk_targets.append(np.full(chunk_size, size))
+        chunk_sources.append(np.zeros(chunk_size, dtype=int))
+        chunk_vals.append(np.zeros(chunk_size))
+    return jnp.array(np.stack(chunk_targets)), jnp.array(np.stack(chunk_sources)), \
+        jnp.array(np.stack(chunk_vals))
+
+
+def sparse_ldl_factor(K, signs=None, num_out=None):
+    """
+    factors the symmetric quasi-definite matrix K (dense or scipy sparse) on the host
+    a fill-reducing ordering of K + K^T is chosen and the pivots are kept on the diagonal
+        which is always possible for quasi-definite matrices
+    """
+    K = csc_matrix(K)
+    K.eliminate_zeros()
+    size = K.shape[0]
+    lu = splu(K, permc_spec='MMD_AT_PLUS_A', diag_pivot_thresh=0,
+              options=dict(SymmetricMode=True))
+    if not np.array_equal(lu.perm_r, lu.perm_c):
+        raise ValueError('the matrix is not quasi-definite: pivoting left the diagonal')
+
+    # strictly lower triangular part of the unit lower triangular L
+    L = lu.L.tocoo()
+    lower = L.row > L.col
+    rows, cols, vals = L.row[lower], L.col[lower], L.data[lower]
+    fwd = level_schedule(rows, cols, vals, size)
+    bwd = level_schedule(cols, rows, vals, size, reverse=True)
+
+    d = jnp.array(lu.U.diagonal())
+    perm = jnp.array(np.argsort(lu.perm_c))
+    signs = jnp.ones(size) if signs is None else jnp.array(signs)
+    num_out = size if num_out is None else num_out
+    return SparseLDLFactor(fwd, bwd, d, perm, signs, num_out)
+
+
+def scs_sparse_factor(P, A, scale_vec):
+    """
+    sparse factor of M + diag(scale_vec) with M = [P A^T; -A 0]
+        flipping the sign of the last m rows gives the quasi-definite matrix
+        [P + diag(scale_vec[:n])  A^T; A  -diag(scale_vec[n:])]
+    """
+    m, n = A.shape
+    P, A = csc_matrix(np.array(P)), csc_matrix(np.array(A))
+    scale_vec = np.array(scale_vec)
+    K = bmat([[P + diags(scale_vec[:n]), A.T], [A, -diags(scale_vec[n:])]])
+    signs = np.concatenate([np.ones(n), -np.ones(m)])
+    return sparse_ldl_factor(K, signs=signs)
+
+
+def osqp_sparse_factor(P, A, rho_vec, sigma):
+    """
+    sparse factor of P + sigma I + A^T diag(rho_vec) A through the quasi-definite kkt matrix
+        [P + sigma I  A^T; A  -diag(1 / rho_vec)]
+    the solve pads the right-hand side with zeros and returns the x block
+    """
+    m, n = A.shape
+    P, A = csc_matrix(np.array(P)), csc_matrix(np.array(A))
+    rho_vec = np.broadcast_to(np.array(rho_vec, dtype=float), (m,))
+    K = bmat([[P + sigma * identity(n), A.T], [A, -diags(1 / rho_vec)]])
+    return sparse_ldl_factor(K, num_out=n)
@@ -1,9 +1,10 @@
 import os
+from functools import partial
 
 import jax.numpy as jnp
 import matplotlib.pyplot as plt
 import numpy as np
-from jax import random
+from jax import jit, lax, random, tree_util
 
 
 def count_files_in_directory(directory):
@@ -25,6 +26,46 @@ def setup_permutation(key_count, N_train, epochs_jit):
     return permutation
 
 
+def get_bucket_size(num):
+    """
+    returns the smallest power of two that is at least num, the batch size that a batch of
+        num problems is padded to (see pad_rows)
+    """
+    return 1 << (int(num) - 1).bit_length()
+
+
+def pad_rows(x, size):
+    """
+    pads the leading (batch) axis of x to size rows by repeating its first row
+        (a copy of a real problem keeps the padded rows finite, e.g., their factors invertible)
+    """
+    num_pad = size - x.shape[0]
+    if num_pad == 0:
+        return x
+    return jnp.concatenate([x, jnp.broadcast_to(x[:1], (num_pad,) + x.shape[1:])])
+
+
+@partial(jit, static_argnums=(1,))
+def pad_batch(batch, size):
+    """
+    pads the leading axis of every array of the pytree batch to size rows (see pad_rows)
+    """
+    return tree_util.tree_map(partial(pad_rows, size=size), batch)
+
+
+@partial(jit, static_argnums=(1, 2))
+def cut_batch(out, num, mean_loss):
+    """
+    cuts the leading axis of every array of the pytree out back to its first num rows
+    if mean_loss, out is the (loss, out) of a padded batch and (loss, out) of the first num
+        rows is returned, the loss being the mean of the cut out[0]
+    """
+    if mean_loss:
+        out = tree_util.tree_map(lambda x: x[:num], out[1])
+        return out[0].mean(), out
+    return tree_util.tree_map(lambda x: x[:num], out)
+
+
 def sample_plot(input, title, num_plot):
     num_plot = np.min([num_plot, 4])
     for i in range(num_plot):
@@ -92,3 +133,22 @@ def python_fori_loop(lower, upper, body_fun, init_val):
     for i in range(lower, upper):
         val = body_fun(i, val)
     return val
+
+
+# non jit scan
+def python_scan(f, init, xs):
+    if len(xs) == 0:
+        return lax.scan(f, init, xs)
+    carry, ys = init, []
+    for x in xs:
+        carry, y = f(carry, x)
+        ys.append(y)
+    return carry, tree_util.tree_map(lambda *y: jnp.stack(y), *ys)
+
+
+# non jit while loop
+def python_while_loop(cond_fun, body_fun, init_val):
+    val = init_val
+    while cond_fun(val):
+        val = body_fun(val)
+    return val
@@ -0,0 +1,166 @@
+from functools import partial
+
+import jax
+import jax.numpy as jnp
+import numpy as np
+from jax import lax, tree_util
+
+from l2ws.utils.anderson_utils import anderson_scan
+from l2ws.utils.generic_utils import python_scan
+
+# how reverse mode differentiates the training unrolls
+#   'unroll': straight through the scan (every intermediate of every step is stored)
+#   'checkpoint': segments of the scan are recomputed on the backward pass
+#   'implicit': adjoint recursion with the jacobian at the last iterate
+DIFF_MODES = ['unroll', 'checkpoint', 'implicit']
+
+
+def check_diff_mode(diff_mode, loss_method=None):
+    """
+    raises a ValueError if diff_mode is unknown or cannot differentiate loss_method
+        (the implicit mode only propagates the gradient of the last iterates)
+    """
+    if diff_mode not in DIFF_MODES:
+        raise ValueError(f"diff_mode must be one of {DIFF_MODES}, got {diff_mode}")
+    if diff_mode == 'implicit' and loss_method in ['constant_sum', 'increasing_sum']:
+        raise ValueError(f"diff_mode 'implicit' does not support loss_method {loss_method}")
+
+
+def train_scan(f, init, xs, jit, anderson=None, diff_mode='unroll', segment_length=None):
+    """
+    runs the training scan f(carry, x) -> (carry, y) over xs
+        carry[0] is the iterate (see anderson_scan) and y holds the losses of the step
+
+    diff_mode (see DIFF_MODES) sets how the scan is differentiated
+        'checkpoint' gives the same gradient as 'unroll' with O(sqrt(k)) memory
+            (segment_length=None) or O(k / segment_length + segment_length) memory
+        'implicit' approximates the gradient with O(1) memory in k (see implicit_scan)
+    """
+    scan = lax.scan if jit else python_scan
+    if diff_mode == 'checkpoint':
+        scan = partial(checkpoint_scan, jit=jit, segment_length=segment_length)
+    elif diff_mode == 'implicit':
+        scan = partial(implicit_scan, scan=partial(anderson_scan, jit=jit, anderson=anderson))
+        return scan(f, init, xs)
+    return anderson_scan(f, init, xs, jit, anderson, scan=scan)
+
+
+def checkpoint_scan(f, init, xs, jit, segment_length=None):
+    """
+    runs the scan in segments of segment_length steps where each segment is wrapped in
+        jax.checkpoint: reverse mode stores the carry at the start of every segment and
+        recomputes the steps of one segment at a time on the backward pass
+
+    segment_length=None uses ceil(sqrt(len(xs)))
+    """
+    scan = lax.scan if jit else python_scan
+    num_iters = len(xs)
+    if num_iters == 0:
+        return scan(f, init, xs)
+    if segment_length is None:
+        segment_length = int(np.ceil(np.sqrt(num_iters)))
+    num_segments, remainder = divmod(num_iters, segment_length)
+    num_full = num_segments * segment_length
+
+    # the outer scan runs over the segments, the inner scan over the steps of one segment
+    segment = jax.checkpoint(lambda carry, xs: scan(f, carry, xs))
+    carry, ys = scan(segment, init, xs[:num_full].reshape((num_segments, segment_length)))
+    ys = tree_util.tree_map(lambda y: y.reshape((num_full,) + y.shape[2:]), ys)
+    if remainder > 0:
+        carry, ys_last = segment(carry, xs[num_full:])
+        ys = tree_util.tree_map(lambda y, y_last: jnp.concatenate([y, y_last]), ys, ys_last)
+    return carry, ys
+
+
+def implicit_scan(f, init, xs, scan):
+    """
+    runs the scan with an adjoint gradient that does not store the iterates
+
+    the last step is differentiated directly; the steps before it are differentiated with
+        the adjoint recursion lambda_i = J^T lambda_{i + 1} where J is the jacobian of the
+        step at the input of the last step (the iterates are assumed to be close to a fixed
+        point where the jacobian is constant, e.g., once the active set of a piecewise affine
+        operator is identified)
+    the adjoint is not the implicit fixed point gradient since the fixed point does not depend
+        on the warm start, only the iterates do
+
+    the cotangents of the outputs y (the losses) are dropped for the steps before the last one
+    """
+    if len(xs) < 2:
+        return scan(f, init, xs)
+
+    # the carry takes the types of the output of a step (e.g., fista's t = 1 is a float)
+    out_types, _ = jax.eval_shape(f, init, xs[0])
+    init = tuple(tree_util.tree_map(lambda x, t: jnp.asarray(x, dtype=t.dtype),
+                                    tuple(init), tuple(out_types)))
+
+    # the arrays in the closure of f (e.g., the problem data) become explicit inputs
+    converted_f, consts = jax.closure_convert(f, init, xs[0])
+    carry_leaves, carry_tree = tree_util.tree_flatten(init)
+    float_carry = [is_float(x) for x in carry_leaves]
+    float_consts = [is_float(x) for x in consts]
+
+    @jax.custom_vjp
+    def adjoint_scan(carry, *consts):
+        return scan(lambda carry, x: converted_f(carry, x, *consts), carry, xs[:-1])
+
+    def adjoint_scan_fwd(carry, *consts):
+        out = adjoint_scan(carry, *consts)
+        return out, (out[0], consts)
+
+    def adjoint_scan_bwd(res, g):
+        carry, consts = res
+        carry_leaves = tree_util.tree_leaves(carry)
+
+        # only the floating point leaves of the carry and the closure are differentiated
+        def step(carry_float, consts_float):
+            carry = tree_util.tree_unflatten(carry_tree,
+                                             merge(carry_leaves, carry_float, float_carry))
+            out, _ = converted_f(carry, xs[-1], *merge(consts, consts_float, float_consts))
+            return select(tree_util.tree_leaves(out), float_carry)
+        _, step_vjp = jax.vjp(step, select(carry_leaves, float_carry),
+                              select(consts, float_consts))
+
+        def adjoint_step(i, val):
+            lambd, consts_bar = val
+            lambd, consts_bar_i = step_vjp(lambd)
+            return lambd, [a + b for a, b in zip(consts_bar, consts_bar_i)]
+        lambd = select(tree_util.tree_leaves(g[0]), float_carry)
+        consts_bar = [jnp.zeros_like(x) for x in select(consts, float_consts)]
+        lambd, consts_bar = lax.fori_loop(0, len(xs) - 1, adjoint_step, (lambd, consts_bar))
+
+        carry_bar = merge([zero_cotangent(x) for x in carry_leaves], lambd, float_carry)
+        carry_bar = tree_util.tree_unflatten(carry_tree, carry_bar)
+        consts_bar = merge([zero_cotangent(x) for x in consts], consts_bar, float_consts)
+        return (carry_bar,) + tuple(consts_bar)
+    adjoint_scan.defvjp(adjoint_scan_fwd, adjoint_scan_bwd)
+
+    carry, ys = adjoint_scan(init, *consts)
+    carry, y_last = f(carry, xs[-1])
+    ys = tree_util.tree_map(lambda y, y_last: jnp.concatenate([y, y_last[None]]), ys, y_last)
+    return carry, ys
+
+
+def is_float(x):
+    return jnp.issubdtype(jnp.asarray(x).dtype, jnp.inexact)
+
+
+def select(leaves, mask):
+    return [leaf for leaf, keep in zip(leaves, mask) if keep]
+
+
+def merge(leaves, selected, mask):
+    """
+    inverse of select: replaces the leaves where mask is True with selected (in order)
+    """
+    selected = iter(selected)
+    return [next(selected) if keep else leaf for leaf, keep in zip(leaves, mask)]
+
+
+def zero_cotangent(x):
+    """
+    zero cotangent of x (float0 for integer arrays)
+    """
+    if is_float(x):
+        return jnp.zeros_like(x)
+    return np.zeros(jnp.shape(x), dtype=jax.dtypes.float0)
@@ -0,0 +1,103 @@
+import jax.numpy as jnp
+import numpy as np
+
+# learning rate schedules of the training (nn_cfg lr_schedule)
+#   the learning rate is a hyperparameter of the optimizer state (optax.inject_hyperparams)
+#   that update_lr sets after every epoch inside the jitted training blocks, so a decay does
+#   not recompile the training or reset the moments of the optimizer
+#   constant: the learning rate stays at lr
+#   plateau: divided by decay_factor (not below min_lr) when the mean training loss of the last
+#       avg_window_size epochs is not tolerance below the mean of the avg_window_size epochs
+#       before, it is then not decayed for another 2 * patience * avg_window_size epochs
+#   cosine: half cosine from lr to min_lr over the epochs
+#   step: multiplied by decay_lr every decay_every epochs
+LR_SCHEDULES = ('constant', 'plateau', 'cosine', 'step')
+PLATEAU_DEFAULTS = dict(min_lr=1e-7, decay_factor=5, avg_window_size=50, tolerance=1e-2,
+                        patience=2)
+
+
+def get_lr_schedule_params(nn_cfg, plateau_decay=None):
+    """
+    collects the parameters of the learning rate schedule from nn_cfg and the plateau_decay
+        dict (whose missing entries are filled in from PLATEAU_DEFAULTS)
+    """
+    params = dict(schedule=nn_cfg.get('lr_schedule', 'constant'),
+                  lr=nn_cfg.get('lr', 1e-3),
+                  min_lr=nn_cfg.get('min_lr', 1e-7),
+                  epochs=nn_cfg.get('epochs', 10),
+                  decay_lr=nn_cfg.get('decay_lr', False),
+                  decay_every=nn_cfg.get('decay_every', None))
+    plateau = dict(PLATEAU_DEFAULTS)
+    plateau.update(plateau_decay if plateau_decay is not None else {})
+    params['plateau'] = plateau
+
+    if params['schedule'] not in LR_SCHEDULES:
+        raise ValueError(f"lr_schedule must be one of {LR_SCHEDULES}")
+    if params['schedule'] == 'step' and not (0 < params['decay_lr'] < 1
+                                             and params['decay_every']):
+        raise ValueError("the step schedule needs 0 < decay_lr < 1 and decay_every")
+    return params
+
+
+def init_lr_state(params, dtype=None):
+    """
+    returns the device state of the learning rate schedule that is carried through training
+        (the losses are kept in dtype)
+        epoch: number of finished epochs
+        epoch_losses: mean training losses of the last 2 * avg_window_size epochs
+        dont_decay_until: epoch before which the plateau schedule does not decay
+        num_decays, decay_epochs: the epochs at which the plateau schedule decayed (-1 if unused)
+        batch_loss_sum: sum of the batch losses of the current epoch (streamed training)
+    """
+    plateau = params['plateau']
+    window = int(plateau['avg_window_size'])
+    max_decays = 1
+    if params['schedule'] == 'plateau' and params['lr'] > plateau['min_lr']:
+        ratio = np.log(params['lr'] / plateau['min_lr']) / np.log(plateau['decay_factor'])
+        max_decays = int(np.floor(ratio)) + 1
+    return dict(epoch=jnp.array(0),
+                epoch_losses=jnp.zeros(2 * window, dtype=dtype),
+                dont_decay_until=jnp.array(2 * window),
+                num_decays=jnp.array(0),
+                decay_epochs=-jnp.ones(max_decays, dtype=int),
+                batch_loss_sum=jnp.zeros((), dtype=dtype))
+
+
+def update_lr(lr, lr_state, epoch_loss, params):
+    """
+    called at the end of each epoch with its mean training loss
+    returns the learning rate of the next epoch and the updated lr_state
+    """
+    epoch = lr_state['epoch'] + 1
+    window = int(params['plateau']['avg_window_size'])
+    epoch_losses = jnp.roll(lr_state['epoch_losses'], -1).at[-1].set(epoch_loss)
+    lr_state = dict(lr_state, epoch=epoch, epoch_losses=epoch_losses)
+
+    if params['schedule'] == 'cosine':
+        frac = jnp.minimum(epoch / params['epochs'], 1)
+        cosine = .5 * (1 + jnp.cos(jnp.pi * frac))
+        new_lr = params['min_lr'] + (params['lr'] - params['min_lr']) * cosine
+    elif params['schedule'] == 'step':
+        new_lr = params['lr'] * params['decay_lr'] ** (epoch // int(params['decay_every']))
+    elif params['schedule'] == 'plateau':
+        plateau = params['plateau']
+        prev_window_loss = epoch_losses[:window].mean()
+        curr_window_loss = epoch_losses[window:].mean()
+        decay = (epoch >= lr_state['dont_decay_until']) \
+            & (lr / plateau['decay_factor'] >= plateau['min_lr']) \
+            & (prev_window_loss - curr_window_loss <= plateau['tolerance'])
+        new_lr = jnp.where(decay, lr / plateau['decay_factor'], lr)
+
+        # log the decay epoch and don't decay for another 2 * patience * window epochs
+        wait_time = 2 * plateau['patience'] * window
+        num_decays = lr_state['num_decays']
+        decay_epochs = lr_state['decay_epochs']
+        decay_epochs = jnp.where(decay, decay_epochs.at[num_decays].set(epoch), decay_epochs)
+        lr_state = dict(lr_state,
+                        dont_decay_until=jnp.where(decay, epoch + wait_time,
+                                                   lr_state['dont_decay_until']),
+                        num_decays=num_decays + decay,
+                        decay_epochs=decay_epochs)
+    else:
+        new_lr = lr
+    return jnp.asarray(new_lr, dtype=lr.dtype), lr_state
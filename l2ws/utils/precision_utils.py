@@ -0,0 +1,65 @@
+import jax
+import jax.numpy as jnp
+import numpy as np
+from jax import tree_util
+from jax.config import config
+
+# precision policies
+#   storage: dtype of the datasets (parameters, inputs, optimal solutions) and the factors
+#   compute: dtype of the neural network and of the fixed point iterations
+#   accumulation: dtype of the losses, norms, and residuals
+PRECISION_POLICIES = dict(
+    float64=dict(storage='float64', compute='float64', accumulation='float64'),
+    float32=dict(storage='float32', compute='float32', accumulation='float32'),
+    mixed=dict(storage='float32', compute='float32', accumulation='float64'),
+)
+
+
+def get_precision_policy(precision='float64'):
+    """
+    returns the policy dict of jnp dtypes with the keys storage, compute, and accumulation
+
+    precision is the name of one of the PRECISION_POLICIES or a dict that may also set
+        base (the name of the policy it overrides, float64 by default)
+    """
+    if isinstance(precision, str):
+        if precision not in PRECISION_POLICIES:
+            raise ValueError(f"precision must be one of {list(PRECISION_POLICIES)}, "
+                             f"got {precision}")
+        precision = dict(base=precision)
+    precision = dict(precision)
+    policy = dict(PRECISION_POLICIES[precision.pop('base', 'float64')])
+    policy.update(precision)
+    for key in ['storage', 'compute', 'accumulation']:
+        if policy[key] not in ['float32', 'float64']:
+            raise ValueError(f"the {key} dtype must be float32 or float64, got {policy[key]}")
+    return {key: jnp.dtype(policy[key]) for key in ['storage', 'compute', 'accumulation']}
+
+
+def enable_precision(policy):
+    """
+    enables float64 in jax the first time a policy needs it (one of its dtypes is float64)
+
+    x64 is never turned off again, so the process runs with the widest dtype that any of its
+        policies needs and the models created before keep their precision. the models pin
+        their own dtypes (the data is cast with cast_floating and the kernels accumulate in
+        the accumulation dtype), so a float32 policy gives the same dtypes with x64 enabled
+    this is the only place where the package changes the global jax config, the models and
+        the launcher call it when they are created (not when they are imported)
+    """
+    if any(dtype == jnp.float64 for dtype in policy.values()) and not config.jax_enable_x64:
+        config.update("jax_enable_x64", True)
+
+
+def cast_floating(tree, dtype):
+    """
+    casts the floating point arrays of a pytree (e.g., a factor) to dtype
+        integer arrays (e.g., the pivots of an lu factorization) and other leaves are kept
+    """
+    def cast(x):
+        if not isinstance(x, (np.ndarray, jax.Array)) or not jnp.issubdtype(x.dtype, jnp.floating):
+            return x
+        if isinstance(x, np.ndarray):
+            return x.astype(dtype, copy=False)
+        return jnp.asarray(x, dtype=dtype)
+    return tree_util.tree_map(cast, tree)
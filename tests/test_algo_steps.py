@@ -1,22 +1,86 @@
 import time
 
+import jax
 import jax.numpy as jnp
 import jax.scipy as jsp
 import numpy as np
 import scs
+from jax import grad, jit, vmap
+from jax.config import config
 from scipy.sparse import csc_matrix
 
 from l2ws.algo_steps import (
     create_M,
     create_projection_fn,
+    fixed_point_residual,
+    fixed_point_scan,
+    get_osqp_factor,
+    get_record_indices,
+    get_rho_bank,
+    get_scale_bank,
     get_scale_vec,
+    get_scaled_vec_and_factor,
+    get_scs_problem_data,
+    init_psd_state,
+    k_steps_eval_osqp,
     k_steps_eval_scs,
+    k_steps_tol_osqp,
+    k_steps_tol_scs,
+    k_steps_train_gd,
+    k_steps_train_osqp,
     k_steps_train_scs,
     lin_sys_solve,
+    record_iterate,
+    sdp_proj_single,
+    soc_proj_single,
+    vec_symm,
 )
 from l2ws.examples.robust_ls import random_robust_ls
 from l2ws.examples.sparse_pca import multiple_random_sparse_pca
 from l2ws.scs_problem import scs_jax
+from l2ws.utils.equilibration_utils import (
+    equilibrate_matrices,
+    get_cone_blocks,
+    get_ruiz_scaling,
+    scale_q_mat,
+    scale_solutions,
+)
+from l2ws.utils.factor_utils import osqp_sparse_factor
+from l2ws.utils.grad_utils import check_diff_mode
+
+config.update("jax_enable_x64", True)
+
+
+def robust_ls_scs_setup(m_orig=20, n_orig=25, rho_x=1, scale=.1):
+    """
+    returns the dict of a random robust least squares problem (P, A, c, b, cones) with its sizes
+        (m, n, zero_cone_size) and the data of scs: proj, M, scale_vec, factor (the lu factor of
+        M + diag(scale_vec)), q = (c, b), q_r = factor^{-1} q, rho_x and scale
+    """
+    P, A, c, b, cones = random_robust_ls(m_orig, n_orig, 1, 1, 1)
+    m, n = A.shape
+    zero_cone_size = cones['z']
+    M = create_M(P, A)
+    scale_vec = get_scale_vec(rho_x, scale, m, n, zero_cone_size)
+    factor = jsp.linalg.lu_factor(M + jnp.diag(scale_vec))
+    q = jnp.concatenate([c, b])
+    return dict(P=P, A=A, c=c, b=b, cones=cones, m=m, n=n, zero_cone_size=zero_cone_size,
+                proj=create_projection_fn(cones, n), M=M, scale_vec=scale_vec, factor=factor,
+                q=q, q_r=lin_sys_solve(factor, q), rho_x=rho_x, scale=scale)
+
+
+def box_qp_setup(n, m, sigma=1):
+    """
+    returns (P, A, q, rho, factor) of a random box-constrained qp for osqp with
+        q = (c, -1, 1), rho = 1, and the lu factor of P + sigma I + A^T diag(rho) A
+    """
+    np.random.seed(0)
+    P_half = np.random.normal(size=(n, n))
+    P = jnp.array(P_half @ P_half.T / n)
+    A = jnp.array(np.random.normal(size=(m, n)))
+    q = jnp.concatenate([jnp.array(np.random.normal(size=n)), -jnp.ones(m), jnp.ones(m)])
+    rho = jnp.ones(m)
+    return P, A, q, rho, get_osqp_factor(P, A, rho, sigma)
 
 
 def test_train_vs_eval():
@@ -52,6 +116,538 @@ def test_train_vs_eval():
     assert jnp.linalg.norm(z_final_eval - z_final_train) <= 1e-10
 
 
+def test_tol_early_exit():
+    """
+    tests that k_steps_tol_scs stops once the fixed point residual is below the tolerance
+        and that it agrees with k_steps_eval_scs at the stopping iteration
+    """
+    prob = robust_ls_scs_setup()
+    P, A, proj, factor, q_r = [prob[key] for key in ['P', 'A', 'proj', 'factor', 'q_r']]
+    m, n, zero_cone_size = prob['m'], prob['n'], prob['zero_cone_size']
+    rho_x, scale = prob['rho_x'], prob['scale']
+    k, tol = 1000, 1e-3
+    z0 = jnp.ones(m + n + 1)
+
+    tol_out = k_steps_tol_scs(k, z0, q_r, factor, proj, P, A, tol=tol, jit=True, hsde=True,
+                              zero_cone_size=zero_cone_size, rho_x=rho_x, scale=scale)
+    z_final_tol, num_iters, residual = tol_out[:3]
+    assert num_iters < k
+    assert residual <= tol
+
+    eval_out = k_steps_eval_scs(k, z0, q_r, factor, proj, P, A, None, None, jit=True,
+                                hsde=True, zero_cone_size=zero_cone_size, rho_x=rho_x, scale=scale)
+    iter_losses, z_all_plus_1 = eval_out[1], eval_out[2]
+    assert jnp.linalg.norm(z_all_plus_1[num_iters, :] - z_final_tol) <= 1e-10
+    assert jnp.abs(iter_losses[num_iters - 1] - residual) <= 1e-10
+    assert jnp.all(iter_losses[1:num_iters - 1] > tol)
+
+    # no step for k = 0 and the first (non-homogeneous) step is checked against tol
+    for k_small, tol_small, iters_small in [(0, tol, 0), (k, 1e10, 1)]:
+        out = k_steps_tol_scs(k_small, z0, q_r, factor, proj, P, A, tol=tol_small, jit=True,
+                              hsde=True, zero_cone_size=zero_cone_size, rho_x=rho_x, scale=scale)
+        assert out[1] == iters_small
+    assert jnp.linalg.norm(out[0] - z_all_plus_1[1, :]) <= 1e-10
+
+    # each problem in a batch stops at its own tolerance
+    tols = jnp.array([1e-2, 1e-3, 1e-4])
+    batch_tol = vmap(k_steps_tol_scs,
+                     in_axes=(None, None, None, None, None, None, None, 0, None, None, None))
+    batch_out = batch_tol(k, z0, q_r, factor, proj, P, A, tols, True, True, zero_cone_size)
+    batch_num_iters, batch_residuals = batch_out[1], batch_out[2]
+    assert jnp.all(jnp.diff(batch_num_iters) > 0)
+    assert jnp.all(batch_residuals <= tols)
+
+
+def test_record_policy():
+    """
+    tests that the iterate-history recording policies of k_steps_eval_scs keep exactly the
+        requested rows of the full history and do not change the iterates or losses
+    """
+    prob = robust_ls_scs_setup()
+    P, A, proj, factor, q_r = [prob[key] for key in ['P', 'A', 'proj', 'factor', 'q_r']]
+    m, n, zero_cone_size = prob['m'], prob['n'], prob['zero_cone_size']
+    rho_x, scale = prob['rho_x'], prob['scale']
+    k = 50
+    z0 = jnp.ones(m + n + 1)
+
+    def eval_scs(k, record):
+        return k_steps_eval_scs(k, z0, q_r, factor, proj, P, A, None, None, jit=True, hsde=True,
+                                zero_cone_size=zero_cone_size, rho_x=rho_x, scale=scale,
+                                record=record)
+    z_final, iter_losses, z_all_plus_1, _, _, u_all, v_all = eval_scs(k, None)
+    assert z_all_plus_1.shape[0] == k + 1
+
+    for record in [5, 'last', 'none', [0, 10, -1]]:
+        out = eval_scs(k, record)
+        assert jnp.linalg.norm(out[0] - z_final) <= 1e-10
+        assert jnp.linalg.norm(out[1] - iter_losses) <= 1e-10
+
+        indices = get_record_indices(k, record)
+        assert out[2].shape[0] == indices.size
+        assert jnp.linalg.norm(out[2] - z_all_plus_1[indices, :]) <= 1e-10
+
+        # u_i and v_i are stored whenever z_i is stored
+        steps = indices[indices >= 1] - 1
+        assert jnp.linalg.norm(out[5] - u_all[steps, :]) <= 1e-10
+        assert jnp.linalg.norm(out[6] - v_all[steps, :]) <= 1e-10
+
+    # the size of the history buffer does not grow with k
+    assert eval_scs(10 * k, 'last')[2].shape[0] == 1
+    assert eval_scs(10 * k, [0, 10, -1])[2].shape[0] == 3
+
+
+def test_anderson_acceleration():
+    """
+    tests that anderson acceleration of scs and osqp reduces the fixed point residual
+        and that the accelerated kernels can be vmapped and differentiated
+    """
+    prob = robust_ls_scs_setup()
+    P, A, proj, factor, q_r = [prob[key] for key in ['P', 'A', 'proj', 'factor', 'q_r']]
+    m, n, zero_cone_size = prob['m'], prob['n'], prob['zero_cone_size']
+    rho_x, scale = prob['rho_x'], prob['scale']
+    k = 300
+    z0 = jnp.ones(m + n + 1)
+
+    def eval_scs(anderson):
+        return k_steps_eval_scs(k, z0, q_r, factor, proj, P, A, None, None, jit=True, hsde=True,
+                                zero_cone_size=zero_cone_size, rho_x=rho_x, scale=scale,
+                                anderson=anderson)
+    plain_out, aa_out = eval_scs(None), eval_scs(dict(mem=10))
+    assert aa_out[1][-1] < 1e-2 * plain_out[1][-1]
+    assert aa_out[3][-1] < 1e-2 * plain_out[3][-1]
+
+    # vmap over the warm starts and differentiate the training loss
+    def train_loss(z0):
+        iter_losses = k_steps_train_scs(50, z0, q_r, factor, False, None, proj, True, True, m, n,
+                                        zero_cone_size, rho_x, scale, anderson=dict(mem=5))[1]
+        return iter_losses.mean()
+    z0_mat = jnp.outer(jnp.array([1.0, 2.0, 3.0]), z0)
+    assert jnp.all(jnp.isfinite(vmap(grad(train_loss))(z0_mat)))
+
+    # box-constrained qp with osqp
+    n_qp, m_qp, sigma = 30, 20, 1
+    P_qp, A_qp, q_qp, rho_qp, osqp_factor = box_qp_setup(n_qp, m_qp, sigma)
+    osqp_z0 = jnp.zeros(n_qp + m_qp)
+
+    plain_osqp = k_steps_eval_osqp(k, osqp_z0, q_qp, osqp_factor, P_qp, A_qp, rho_qp, sigma,
+                                   False, None, True)
+    aa_osqp = k_steps_eval_osqp(k, osqp_z0, q_qp, osqp_factor, P_qp, A_qp, rho_qp, sigma,
+                                False, None, True, anderson=dict(mem=10))
+    assert aa_osqp[1][-1] < 1e-2 * plain_osqp[1][-1]
+    aa_train = k_steps_train_osqp(k, osqp_z0, q_qp, osqp_factor, A_qp, rho_qp, sigma, False,
+                                  None, True, anderson=dict(mem=10))
+    assert jnp.linalg.norm(aa_train[0] - aa_osqp[0]) <= 1e-10
+
+
+def test_residual_steps():
+    """
+    tests that the strided residuals of scs and osqp match the residuals of every iteration
+        at the computed iterates and are nan elsewhere
+    """
+    prob = robust_ls_scs_setup()
+    P, A, proj, factor, q_r = [prob[key] for key in ['P', 'A', 'proj', 'factor', 'q_r']]
+    m, n, zero_cone_size = prob['m'], prob['n'], prob['zero_cone_size']
+    rho_x, scale = prob['rho_x'], prob['scale']
+    k = 40
+
+    def eval_scs(residual_steps):
+        return k_steps_eval_scs(k, jnp.ones(m + n + 1), q_r, factor, proj, P, A, None, None,
+                                jit=True, hsde=True, zero_cone_size=zero_cone_size, rho_x=rho_x,
+                                scale=scale, residual_steps=residual_steps)
+
+    # box-constrained qp with osqp
+    n_qp, m_qp = 25, 20
+    P_qp, A_qp, q_qp, rho_qp, osqp_factor = box_qp_setup(n_qp, m_qp)
+
+    def eval_osqp(residual_steps):
+        return k_steps_eval_osqp(k, jnp.zeros(m_qp + n_qp), q_qp, osqp_factor, P_qp, A_qp,
+                                 rho_qp, 1, False, None, True, residual_steps=residual_steps)
+
+    for eval_fn, residual_indices in [(eval_scs, (3, 4)), (eval_osqp, (3, 4))]:
+        full_out = eval_fn(None)
+        for residual_steps in [5, [10, -1]]:
+            out = eval_fn(residual_steps)
+            assert jnp.allclose(out[1], full_out[1])
+            computed = get_record_indices(k, residual_steps)
+            computed = computed[computed >= 2] - 1
+            for j in residual_indices:
+                assert jnp.allclose(out[j][computed], full_out[j][computed])
+                assert jnp.isnan(out[j][1:]).sum() == k - 1 - computed.size
+
+
+def test_adaptive_scale():
+    """
+    tests that the adaptive scale of scs
+    - matches the fixed scale exactly if the scale is never updated
+    - converges from a poorly chosen scale where the fixed scale does not
+    - keeps a separate scale for each problem under vmap
+    - has no more linear solves per step than the fixed scale under vmap
+    """
+    np.random.seed(0)
+    P, A, c, b, cones = random_robust_ls(30, 40, 1, 1, 1)
+    m, n = A.shape
+    zero_cone_size = cones['z']
+    proj = create_projection_fn(cones, n)
+    M = create_M(P, A)
+    k, scale = 600, 100
+    factor, scale_vec = get_scaled_vec_and_factor(M, 1, scale, m, n, zero_cone_size)
+    q = jnp.concatenate([c, b])
+
+    def eval_scs(q, scale_bank):
+        q_r = lin_sys_solve(factor, q)
+        return k_steps_eval_scs(k, jnp.ones(m + n + 1), q_r, factor, proj, P, A, None, None,
+                                jit=True, hsde=True, zero_cone_size=zero_cone_size, rho_x=1,
+                                scale=scale, q_data=q, scale_bank=scale_bank)
+    fixed_out = eval_scs(q, None)
+    never_out = eval_scs(q, get_scale_bank(M, 1, scale, m, n, zero_cone_size,
+                                           dict(min_iters=k + 1)))
+    for j in range(7):
+        assert jnp.array_equal(fixed_out[j], never_out[j], equal_nan=True)
+
+    scale_bank = get_scale_bank(M, 1, scale, m, n, zero_cone_size, True)
+    adaptive_out = eval_scs(q, scale_bank)
+    assert jnp.maximum(fixed_out[3][-1], fixed_out[4][-1]) > 1e-4
+    assert jnp.maximum(adaptive_out[3][-1], adaptive_out[4][-1]) < 1e-8
+
+    q_mat = jnp.stack([q, 10 * q])
+    batch_out = vmap(eval_scs, in_axes=(0, None))(q_mat, scale_bank)
+    assert jnp.allclose(batch_out[1][0], adaptive_out[1])
+    assert jnp.allclose(batch_out[1][1], eval_scs(q_mat[1], scale_bank)[1])
+
+    # the scan body of the batched evaluation solves as often as with the fixed scale
+    def count_step_solves(scale_bank):
+        jaxpr = jax.make_jaxpr(vmap(lambda q: eval_scs(q, scale_bank)))(q_mat).jaxpr
+        return sum(str(eqn.params['jaxpr']).count('triangular_solve') for eqn in jaxpr.eqns
+                   if eqn.primitive.name == 'scan')
+    assert count_step_solves(scale_bank) == count_step_solves(None) > 0
+
+
+def test_adaptive_rho():
+    """
+    tests that the adaptive rho of osqp
+    - matches the fixed rho exactly if rho is never updated
+    - reaches the tolerance from a poorly chosen rho where the fixed rho does not
+    """
+    rng = np.random.default_rng(0)
+    n, m, num_eq = 40, 30, 5
+    P_half = rng.normal(size=(n, n))
+    P, A = jnp.array(P_half @ P_half.T / n), jnp.array(rng.normal(size=(m, n)))
+    bounds = jnp.concatenate([.3 * jnp.ones(num_eq), jnp.ones(m - num_eq)])
+    q = jnp.concatenate([10 * jnp.array(rng.normal(size=n)), -bounds.at[:num_eq].set(-.3),
+                         bounds])
+    rho = 1e-3 * jnp.ones(m).at[:num_eq].set(1e3)
+    factor = get_osqp_factor(P, A, rho, 1)
+    k, z0 = 1000, jnp.zeros(n + m)
+
+    def eval_osqp(rho_bank):
+        return k_steps_eval_osqp(k, z0, q, factor, P, A, rho, 1, False, None, True,
+                                 rho_bank=rho_bank)
+    fixed_out = eval_osqp(None)
+    never_out = eval_osqp(get_rho_bank(P, A, rho, 1, dict(interval=k + 1)))
+    for j in range(5):
+        assert jnp.array_equal(fixed_out[j], never_out[j])
+
+    rho_bank = get_rho_bank(P, A, rho, 1, True)
+    adaptive_out = eval_osqp(rho_bank)
+    assert jnp.maximum(fixed_out[3][-1], fixed_out[4][-1]) > 1e-3
+    assert jnp.maximum(adaptive_out[3][-1], adaptive_out[4][-1]) < 1e-6
+
+    def tol_osqp(rho_bank):
+        return k_steps_tol_osqp(k, z0, q, factor, P, A, rho, 1, 1e-6, True,
+                                tol_metric='dual', rho_bank=rho_bank)[1]
+    assert tol_osqp(rho_bank) < tol_osqp(None) == k
+
+
+def test_scs_problem_data():
+    """
+    tests that the residuals of scs computed from the problem data q_data match the ones
+        computed from the solved q_r
+    """
+    prob = robust_ls_scs_setup()
+    P, A, proj, factor, q_r = [prob[key] for key in ['P', 'A', 'proj', 'factor', 'q_r']]
+    m, n, zero_cone_size = prob['m'], prob['n'], prob['zero_cone_size']
+    rho_x, scale = prob['rho_x'], prob['scale']
+    c, b, q, scale_vec = prob['c'], prob['b'], prob['q'], prob['scale_vec']
+    c_r, b_r = get_scs_problem_data(q_r, P, A, scale_vec)
+    assert jnp.allclose(c_r, c) and jnp.allclose(b_r, b)
+
+    def eval_scs(q_data):
+        return k_steps_eval_scs(30, jnp.ones(m + n + 1), q_r, factor, proj, P, A, None, None,
+                                jit=True, hsde=True, zero_cone_size=zero_cone_size, rho_x=rho_x,
+                                scale=scale, q_data=q_data)
+    out, data_out = eval_scs(None), eval_scs(q)
+    for j in range(5):
+        assert jnp.allclose(out[j], data_out[j])
+
+
+def test_ruiz_equilibration():
+    """
+    the ruiz scaling keeps the socs intact, the scaled problem has the scaled solution,
+        and scs needs fewer iterations on it when the columns of A are badly scaled
+    """
+    P, A, c, b, cones = random_robust_ls(30, 40, 1, 1, 1)
+    P, A, c, b = np.array(P), np.array(A), np.array(c), np.array(b)
+    m, n = A.shape
+    col_scaling = 10 ** np.random.default_rng(0).uniform(-2, 2, n)
+    P, A, c = P * np.outer(col_scaling, col_scaling), A * col_scaling, c * col_scaling
+
+    def solve(P, A, c, b):
+        solver = scs.SCS(dict(P=csc_matrix(P), A=csc_matrix(A), c=c, b=b), cones,
+                         normalize=False, acceleration_lookback=0, eps_abs=1e-9, eps_rel=1e-9,
+                         max_iters=100000, verbose=False)
+        return solver.solve()
+
+    D, E = get_ruiz_scaling(P, A, cones=cones)
+    for start, end in get_cone_blocks(cones, n):
+        assert np.ptp(D[start - n:end - n]) == 0
+
+    P_hat, A_hat = equilibrate_matrices(P, A, D, E)
+    q_hat = scale_q_mat(np.concatenate([c, b])[None, :], D, E, 'scs')[0, :]
+    sol = solve(P, A, c, b)
+    sol_hat = solve(P_hat, A_hat, q_hat[:n], q_hat[n:])
+    for z, z_hat in zip(scale_solutions(D, E, sol['x'], sol['y'], sol['s']),
+                        [sol_hat['x'], sol_hat['y'], sol_hat['s']]):
+        assert np.linalg.norm(z - z_hat) <= 1e-6 * np.linalg.norm(z)
+    assert sol_hat['info']['iter'] < sol['info']['iter']
+
+
+def test_fixed_point_scan():
+    """
+    tests that the scan engine stacks the requested metrics and records the iterates of the
+        history policy for a multi-entry state
+    """
+    np.random.seed(0)
+    n = 10
+    A = jnp.array(np.random.normal(size=(n, n))) / (2 * np.sqrt(n))
+    z0 = jnp.ones(n)
+
+    # a step with the state (z, z_prev) and the aux output A z
+    def step_fn(state):
+        z, z_prev = state
+        z_next = A @ z + .1 * (z - z_prev)
+        return (z_next, z), A @ z
+    metrics = dict(res=fixed_point_residual, aux_norm=lambda z, z_next, aux: jnp.linalg.norm(aux))
+    k = 9
+    for jit_bool in [True, False]:
+        for record in [None, 2, 'last']:
+            state, metric_vals, history = fixed_point_scan(step_fn, (z0, z0), 0, k, jit_bool,
+                                                           metrics, record_fn=record_iterate,
+                                                           record=record)
+
+            # plain python loop
+            state_loop, iterates = (z0, z0), [z0]
+            for i in range(k):
+                z = state_loop[0]
+                state_loop, aux = step_fn(state_loop)
+                assert jnp.abs(metric_vals['res'][i] - jnp.linalg.norm(state_loop[0] - z)) <= 1e-12
+                assert jnp.abs(metric_vals['aux_norm'][i] - jnp.linalg.norm(aux)) <= 1e-12
+                iterates.append(state_loop[0])
+            assert jnp.linalg.norm(state[0] - state_loop[0]) <= 1e-12
+            recorded = [iterates[i] for i in get_record_indices(k, record) if i > 0]
+            assert history[0].shape == (len(recorded), n)
+            assert jnp.linalg.norm(history[0] - jnp.stack(recorded)) <= 1e-12
+
+    # no metrics and no records
+    state, metric_vals, history = fixed_point_scan(step_fn, (z0, z0), 0, k, True)
+    assert metric_vals == {} and history == ()
+
+
+def test_diff_modes():
+    """
+    tests that the checkpointed training gradient matches differentiating through the loop
+        and that the implicit gradient is exact when the step is affine
+    """
+    n_orig = 25
+    prob = robust_ls_scs_setup(n_orig=n_orig)
+    P, A, proj, factor, q_r = [prob[key] for key in ['P', 'A', 'proj', 'factor', 'q_r']]
+    m, n, zero_cone_size = prob['m'], prob['n'], prob['zero_cone_size']
+    rho_x, scale = prob['rho_x'], prob['scale']
+    z0 = jnp.ones(m + n + 1)
+
+    def train_loss(z0, diff_mode, segment_length=None):
+        iter_losses = k_steps_train_scs(30, z0, q_r, factor, False, None, proj, True, True, m, n,
+                                        zero_cone_size, rho_x, scale, diff_mode=diff_mode,
+                                        segment_length=segment_length)[1]
+        return iter_losses[-1]
+    unroll_grad = grad(train_loss)(z0, 'unroll')
+    for segment_length in [None, 7]:
+        checkpoint_grad = grad(train_loss)(z0, 'checkpoint', segment_length)
+        assert jnp.linalg.norm(checkpoint_grad - unroll_grad) <= 1e-10
+    z0_mat = jnp.outer(jnp.array([1.0, 2.0]), z0)
+    assert jnp.all(jnp.isfinite(vmap(grad(train_loss), in_axes=(0, None))(z0_mat, 'implicit')))
+
+    # gradient descent on a quadratic has a constant jacobian
+    np.random.seed(0)
+    P_half = np.random.normal(size=(n_orig, n_orig))
+    P_quad = jnp.array(P_half @ P_half.T / n_orig + np.eye(n_orig))
+    c_quad = jnp.array(np.random.normal(size=n_orig))
+    gd_step = 1 / jnp.linalg.eigvalsh(P_quad)[-1]
+
+    def gd_loss(z0, diff_mode):
+        return k_steps_train_gd(50, z0, c_quad, P_quad, gd_step, False, None, True,
+                                diff_mode=diff_mode)[1][-1]
+    gd_z0 = jnp.ones(n_orig)
+    assert jnp.linalg.norm(grad(gd_loss)(gd_z0, 'implicit') - grad(gd_loss)(gd_z0, 'unroll')) \
+        <= 1e-10
+
+    # the implicit gradient drops the intermediate losses
+    try:
+        check_diff_mode('implicit', 'constant_sum')
+        assert False
+    except ValueError:
+        pass
+
+
+def test_sparse_ldl_factor():
+    """
+    tests that the sparse LDL^T factors solve the same linear systems as the dense lu factors
+        and give the same scs iterates
+    """
+    prob = robust_ls_scs_setup()
+    P, A, proj, lu_factor, q_r = [prob[key] for key in ['P', 'A', 'proj', 'factor', 'q_r']]
+    m, n, zero_cone_size = prob['m'], prob['n'], prob['zero_cone_size']
+    rho_x, scale = prob['rho_x'], prob['scale']
+    k = 100
+    z0 = jnp.ones(m + n + 1)
+    M, q = prob['M'], prob['q']
+
+    ldl_factor, _ = get_scaled_vec_and_factor(M, rho_x, scale, m, n, zero_cone_size,
+                                              factor_method='sparse_ldl')
+    assert jnp.linalg.norm(lin_sys_solve(ldl_factor, q) - q_r) <= 1e-10
+
+    lu_out = k_steps_eval_scs(k, z0, q_r, lu_factor, proj, P, A, None, None, jit=True,
+                              hsde=True, zero_cone_size=zero_cone_size, rho_x=rho_x, scale=scale)
+    ldl_out = k_steps_eval_scs(k, z0, q_r, ldl_factor, proj, P, A, None, None, jit=True,
+                               hsde=True, zero_cone_size=zero_cone_size, rho_x=rho_x,
+                               scale=scale)
+    assert jnp.linalg.norm(lu_out[0] - ldl_out[0]) <= 1e-8
+    assert jnp.linalg.norm(lu_out[1] - ldl_out[1]) <= 1e-8
+
+    # osqp system P + sigma I + A^T diag(rho) A
+    rho_vec, sigma = jnp.ones(m).at[:zero_cone_size].set(1000), 1
+    osqp_matrix = P + sigma * jnp.eye(n) + A.T @ jnp.diag(rho_vec) @ A
+    osqp_factor = osqp_sparse_factor(P, A, rho_vec, sigma)
+    rhs = jnp.ones(n)
+    assert jnp.linalg.norm(osqp_matrix @ lin_sys_solve(osqp_factor, rhs) - rhs) <= 1e-8
+
+
+def test_factor_methods():
+    """
+    tests that every factor_method solves the same scs and osqp linear systems as the
+        dense lu factorization
+    """
+    prob = robust_ls_scs_setup()
+    P, A, M, q, q_r = [prob[key] for key in ['P', 'A', 'M', 'q', 'q_r']]
+    m, n, zero_cone_size = prob['m'], prob['n'], prob['zero_cone_size']
+    rho_x, scale = prob['rho_x'], prob['scale']
+
+    # scs system M + diag(scale_vec)
+    for factor_method in ['ldl', 'inverse', 'sparse_ldl', 'cg', 'auto']:
+        factor, _ = get_scaled_vec_and_factor(M, rho_x, scale, m, n, zero_cone_size,
+                                              factor_method=factor_method)
+        assert jnp.linalg.norm(lin_sys_solve(factor, q) - q_r) <= 1e-8
+
+    # osqp system P + sigma I + A^T diag(rho) A
+    rho_vec, sigma = jnp.ones(m).at[:zero_cone_size].set(1000), 1
+    rhs = jnp.ones(n)
+    lu_factor = get_osqp_factor(P, A, rho_vec, sigma)
+    x = lin_sys_solve(lu_factor, rhs)
+    for factor_method in ['cholesky', 'inverse', 'sparse_ldl', 'cg', 'auto']:
+        factor = get_osqp_factor(P, A, rho_vec, sigma, factor_method=factor_method)
+        assert jnp.linalg.norm(lin_sys_solve(factor, rhs) - x) <= 1e-8
+
+
+def test_fused_projection():
+    """
+    tests that the fused projection matches projecting every cone block separately
+        when the second order and psd cone sizes are interleaved
+    """
+    n = 4
+    cones = dict(z=3, l=5, q=[3, 5, 3, 3, 7, 5], s=[2, 3, 2])
+    proj = create_projection_fn(cones, n)
+    sdp_vector_sizes = [int(row_size * (row_size + 1) / 2) for row_size in cones['s']]
+    size = n + cones['z'] + cones['l'] + sum(cones['q']) + sum(sdp_vector_sizes)
+
+    np.random.seed(0)
+    x = jnp.array(np.random.normal(size=size))
+
+    # project each cone block on its own
+    start = n + cones['z']
+    blocks = [x[:start], jnp.clip(x[start:start + cones['l']], a_min=0)]
+    start += cones['l']
+    for soc_size in cones['q']:
+        blocks.append(soc_proj_single(x[start:start + soc_size]))
+        start += soc_size
+    for row_size, vector_size in zip(cones['s'], sdp_vector_sizes):
+        blocks.append(sdp_proj_single(x[start:start + vector_size], row_size))
+        start += vector_size
+    assert jnp.linalg.norm(proj(x) - jnp.concatenate(blocks)) <= 1e-10
+
+    # the projection is idempotent and finite at zero
+    assert jnp.linalg.norm(proj(proj(x)) - proj(x)) <= 1e-6
+    assert jnp.linalg.norm(proj(jnp.zeros(size))) <= 1e-10
+
+
+def test_low_rank_psd_projection():
+    """
+    tests the low-rank psd projection: the warm-started subspace converges to the full
+        projection, the rank estimate falls back to the full eigendecomposition (for the whole
+        batch under vmap), and the psd_state is threaded through the scs eval kernel
+    """
+    n, row_size, psd_rank = 2, 20, 5
+    cones = dict(z=1, l=2, q=[3], s=[row_size, row_size])
+    proj = create_projection_fn(cones, n)
+    low_rank_proj = jit(create_projection_fn(cones, n, psd_rank=psd_rank))
+    psd_state = init_psd_state(cones, psd_rank)
+
+    np.random.seed(0)
+
+    def random_input(num_positive):
+        blocks = [jnp.array(np.random.normal(size=n + cones['z'] + cones['l'] + 3))]
+        for _ in cones['s']:
+            U = np.linalg.qr(np.random.normal(size=(row_size, row_size)))[0]
+            evals = -np.random.uniform(1, 2, size=row_size)
+            evals[:num_positive] = np.random.uniform(1, 2, size=num_positive)
+            blocks.append(vec_symm(jnp.array(U @ np.diag(evals) @ U.T)))
+        return jnp.concatenate(blocks)
+
+    # the positive part has rank 3 < psd_rank
+    x = random_input(3)
+    for i in range(10):
+        x_proj, psd_state = low_rank_proj(x, psd_state)
+    assert jnp.linalg.norm(x_proj - proj(x)) <= 1e-8
+
+    # the positive part has rank 8 > psd_rank
+    x = random_input(8)
+    x_proj, _ = low_rank_proj(x, psd_state)
+    assert jnp.linalg.norm(x_proj - proj(x)) <= 1e-10
+
+    x_batch = jnp.stack([random_input(3), random_input(8)])
+    x_proj_batch, psd_state_batch = vmap(low_rank_proj, in_axes=(0, None))(x_batch, psd_state)
+    assert jnp.linalg.norm(x_proj_batch - vmap(proj)(x_batch)) <= 1e-10
+    assert psd_state_batch[0].shape == (2, 2, row_size, psd_rank)
+
+    # scs on a sparse pca problem
+    P, A, cones, q_mat, theta_mat_jax, A_tensor = multiple_random_sparse_pca(
+        n_orig=10, k=3, r=3, N=1)
+    m, n = A.shape
+    zero_cone_size = cones['z']
+    rho_x, scale = 1, .1
+    scale_vec = get_scale_vec(rho_x, scale, m, n, zero_cone_size)
+    factor = jsp.linalg.lu_factor(create_M(P, A) + jnp.diag(scale_vec))
+    q_r = lin_sys_solve(factor, q_mat[0, :])
+    z0 = jnp.ones(m + n + 1)
+    eval_out = k_steps_eval_scs(50, z0, q_r, factor, create_projection_fn(cones, n), P, A,
+                                None, None, jit=True, hsde=True,
+                                zero_cone_size=zero_cone_size, rho_x=rho_x, scale=scale)
+    low_rank_eval_out = k_steps_eval_scs(50, z0, q_r, factor,
+                                         create_projection_fn(cones, n, psd_rank=4), P, A,
+                                         None, None, jit=True, hsde=True,
+                                         zero_cone_size=zero_cone_size, rho_x=rho_x,
+                                         scale=scale, psd_state=init_psd_state(cones, 4))
+    assert jnp.linalg.norm(eval_out[0] - low_rank_eval_out[0]) <= 1e-8
+
+
 def test_jit_speed():
     # problem setup
     m_orig, n_orig = 30, 40
@@ -1,11 +1,14 @@
 import cvxpy as cp
 import jax.numpy as jnp
 import numpy as np
+from jax.config import config
 
 from l2ws.examples.robust_ls import multiple_random_robust_ls
 from l2ws.examples.sparse_pca import multiple_random_sparse_pca
 from l2ws.scs_problem import scs_jax
 
+config.update("jax_enable_x64", True)
+
 
 def test_phase_retrieval():
     pass
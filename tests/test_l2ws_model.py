@@ -1,11 +1,22 @@
+import time
+
+import jax
 import jax.numpy as jnp
 import numpy as np
 import scs
+from jax import core, random, tree_util
+from jax.config import config
 from scipy.sparse import csc_matrix
 
 from l2ws.algo_steps import create_M, create_projection_fn, get_scaled_vec_and_factor
 from l2ws.examples.robust_ls import multiple_random_robust_ls
+from l2ws.ista_model import ISTAmodel
 from l2ws.scs_model import SCSmodel
+from l2ws.utils.compile_utils import WarmUp
+from l2ws.utils.data_utils import BatchStream
+from l2ws.utils.precision_utils import get_precision_policy
+
+config.update("jax_enable_x64", True)
 
 
 def multiple_random_robust_ls_setup(m_orig, n_orig, rho, b_center, b_range, N_train, N_test, rho_x,
@@ -26,12 +37,40 @@ def multiple_random_robust_ls_setup(m_orig, n_orig, rho, b_center, b_range, N_tr
 
     static_prob_data = dict(P=P, A=A, cones=cones, proj=proj,
                             static_M=static_M, static_algo_factor=static_algo_factor,
-                            m=m, n=n)
+                            m=m, n=n, rho_x=rho_x, scale=scale)
     varying_prob_data = dict(q_mat_train=q_mat_train, q_mat_test=q_mat_test,
                              train_inputs=train_inputs, test_inputs=test_inputs)
     return static_prob_data, varying_prob_data
 
 
+def small_robust_ls_setup(N_train=10, N_test=5):
+    """
+    the small robust least squares problems (and the scs factor with rho_x = scale = 1) of the
+        training tests
+    """
+    return multiple_random_robust_ls_setup(20, 25, 1, 1, 1, N_train, N_test, 1, 1)
+
+
+def get_scs_algo_dict(static_prob_data, varying_prob_data, **overrides):
+    """
+    returns the algo_dict of an SCSmodel on the problems of multiple_random_robust_ls_setup,
+        overrides replaces or adds entries
+    """
+    algo_dict = dict(algorithm='scs',
+                     m=static_prob_data['m'],
+                     n=static_prob_data['n'],
+                     proj=static_prob_data['proj'],
+                     cones=static_prob_data['cones'],
+                     q_mat_train=varying_prob_data['q_mat_train'],
+                     q_mat_test=varying_prob_data['q_mat_test'],
+                     static_M=static_prob_data['static_M'],
+                     static_algo_factor=static_prob_data['static_algo_factor'],
+                     rho_x=static_prob_data['rho_x'],
+                     scale=static_prob_data['scale'])
+    algo_dict.update(overrides)
+    return algo_dict
+
+
 def test_minimal_l2ws_model():
     """
     tests that we can initialize an L2WSmodel with the minimal amount of information needed
@@ -160,3 +199,405 @@ def test_minimal_l2ws_model():
     assert jnp.linalg.norm(x_jax - x_c) < 1e-10
     assert jnp.linalg.norm(y_jax - y_c) < 1e-10
     assert jnp.linalg.norm(s_jax - s_c) < 1e-10
+
+
+def test_precision_policy():
+    """
+    tests that the mixed precision policy stores the data and runs the iterations in float32
+        while the losses are accumulated in float64, and that it matches the float64 policy
+    """
+    N_train, N_test = 10, 5
+    m_orig, n_orig = 30, 40
+    rho_x, scale, alpha_relax = 1, 1, 1
+    static_prob_data, varying_prob_data = multiple_random_robust_ls_setup(
+        m_orig, n_orig, 1, 1, 1, N_train, N_test, rho_x, scale)
+
+    losses = {}
+    for precision in ['float64', 'mixed']:
+        algo_dict = get_scs_algo_dict(static_prob_data, varying_prob_data,
+                                      alpha_relax=alpha_relax, precision=precision)
+        l2ws_model = SCSmodel(train_unrolls=20,
+                              train_inputs=varying_prob_data['train_inputs'],
+                              test_inputs=varying_prob_data['test_inputs'],
+                              algo_dict=algo_dict)
+        loss, eval_out, _ = l2ws_model.evaluate(50, l2ws_model.train_inputs,
+                                                l2ws_model.q_mat_train, z_stars=None,
+                                                fixed_ws=False, tag='train')
+        iter_losses, z_all = eval_out[1], eval_out[2]
+        if precision == 'mixed':
+            assert l2ws_model.q_mat_train.dtype == jnp.float32
+            assert z_all.dtype == jnp.float32
+            assert iter_losses.dtype == jnp.float64
+        losses[precision] = iter_losses
+
+    # the fixed point residuals agree up to single precision
+    assert jnp.allclose(losses['mixed'], losses['float64'], rtol=1e-3, atol=1e-5)
+
+    # a float32 accumulation is kept with x64 enabled (by the float64 models) and float64 data
+    algo_dict = get_scs_algo_dict(static_prob_data, varying_prob_data, alpha_relax=alpha_relax,
+                                  precision=dict(base='float32', storage='float64'))
+    l2ws_model = SCSmodel(train_unrolls=20,
+                          train_inputs=varying_prob_data['train_inputs'],
+                          test_inputs=varying_prob_data['test_inputs'],
+                          algo_dict=algo_dict)
+    assert config.jax_enable_x64
+    assert l2ws_model.q_mat_train.dtype == jnp.float64
+    loss, eval_out, _ = l2ws_model.evaluate(50, l2ws_model.train_inputs,
+                                            l2ws_model.q_mat_train, z_stars=None,
+                                            fixed_ws=False, tag='train')
+    assert eval_out[1].dtype == jnp.float32 and eval_out[4].dtype == jnp.float32
+    tol_out = l2ws_model.evaluate_to_tol(50, l2ws_model.train_inputs, l2ws_model.q_mat_train,
+                                         1e-3)[1]
+    assert tol_out[2].dtype == jnp.float32
+
+    try:
+        get_precision_policy('float16')
+        assert False
+    except ValueError:
+        pass
+
+
+def test_cached_r():
+    """
+    tests that the loss functions give the same results with the cached r = (I + M)^{-1} q
+        as with the solve inside the loss functions, and that the cache follows the factor
+    """
+    N_train, N_test = 10, 5
+    rho_x, scale = 1, .5
+    static_prob_data, varying_prob_data = multiple_random_robust_ls_setup(
+        30, 40, 1, 1, 1, N_train, N_test, rho_x, scale)
+    algo_dict = get_scs_algo_dict(static_prob_data, varying_prob_data)
+    l2ws_model = SCSmodel(train_unrolls=20,
+                          train_inputs=varying_prob_data['train_inputs'],
+                          test_inputs=varying_prob_data['test_inputs'],
+                          algo_dict=algo_dict)
+    q_mat, r_mat = l2ws_model.get_q_mat(train=True)
+    assert r_mat is l2ws_model.r_mat_train
+
+    train_loss = l2ws_model.loss_fn_train(l2ws_model.params, l2ws_model.train_inputs,
+                                          (q_mat, r_mat), 20, None)
+    assert jnp.allclose(train_loss, l2ws_model.loss_fn_train(
+        l2ws_model.params, l2ws_model.train_inputs, q_mat, 20, None))
+    out = l2ws_model.evaluate(50, l2ws_model.train_inputs, (q_mat, r_mat), None, False)[1]
+    solve_out = l2ws_model.evaluate(50, l2ws_model.train_inputs, q_mat, None, False)[1]
+    for j in [1, 2, 4, 5]:
+        assert jnp.allclose(out[j], solve_out[j], equal_nan=True)
+
+    # a new factor invalidates the cache
+    M = static_prob_data['static_M']
+    factor, scale_vec = get_scaled_vec_and_factor(M, rho_x, 2 * scale, static_prob_data['m'],
+                                                  static_prob_data['n'],
+                                                  static_prob_data['cones']['z'])
+    l2ws_model.factor_static = factor
+    new_r_mat = l2ws_model.get_q_mat(train=True)[1]
+    assert not jnp.allclose(new_r_mat, r_mat)
+    assert jnp.allclose((M + jnp.diag(scale_vec)) @ new_r_mat[0], q_mat[0])
+
+
+def test_ista_gram():
+    """
+    tests that the gram formulation of ista (chosen for a tall A) gives the same losses,
+        iterates, and objective gaps as the formulation with A
+    """
+    N_train, N_test, m, n = 8, 4, 60, 20
+    np.random.seed(0)
+    A = jnp.array(np.random.normal(size=(m, n)))
+    b_mat = jnp.array(np.random.normal(size=(N_train + N_test, m)))
+    z_stars = jnp.array(np.random.normal(size=(N_train + N_test, n)))
+    ista_step = 1 / jnp.linalg.norm(A, 2) ** 2
+
+    def create_model(gram):
+        algo_dict = dict(algorithm='ista', A=A, lambd=.1, ista_step=ista_step, gram=gram,
+                         b_mat_train=b_mat[:N_train, :], b_mat_test=b_mat[N_train:, :])
+        return ISTAmodel(train_unrolls=20,
+                         train_inputs=b_mat[:N_train, :],
+                         test_inputs=b_mat[N_train:, :],
+                         z_stars_train=z_stars[:N_train, :],
+                         z_stars_test=z_stars[N_train:, :],
+                         algo_dict=algo_dict)
+    gram_model, model = create_model(None), create_model(False)
+    assert gram_model.gram and gram_model.get_q_mat(False).shape == (N_test, n)
+
+    model.params = gram_model.params
+    gram_out = gram_model.evaluate(50, gram_model.test_inputs, gram_model.get_q_mat(False),
+                                   gram_model.z_stars_test, False)[1]
+    out = model.evaluate(50, model.test_inputs, model.get_q_mat(False), model.z_stars_test,
+                         False)[1]
+    for gram_vals, vals in zip(gram_out, out):
+        if vals is not None:
+            assert jnp.allclose(gram_vals, vals, rtol=1e-8, atol=1e-10)
+
+
+def test_train_epochs():
+    """
+    tests that the jitted training block gives the same losses and parameters as the
+        optimizer steps one batch at a time on the permutations drawn from the same key
+    """
+    N_train = 10
+    static_prob_data, varying_prob_data = small_robust_ls_setup(N_train)
+    algo_dict = get_scs_algo_dict(static_prob_data, varying_prob_data)
+    l2ws_model = SCSmodel(train_unrolls=5,
+                          train_inputs=varying_prob_data['train_inputs'],
+                          test_inputs=varying_prob_data['test_inputs'],
+                          nn_cfg=dict(batch_size=5, intermediate_layer_sizes=[10]),
+                          algo_dict=algo_dict)
+    num_epochs, key = 2, random.PRNGKey(3)
+
+    # the same permutations as the jitted block draws from key
+    params, state, step_key = l2ws_model.params, l2ws_model.state, key
+    step_losses = []
+    for epoch in range(num_epochs):
+        step_key, subkey = random.split(step_key)
+        permutation = random.permutation(subkey, N_train)
+        for i in range(l2ws_model.num_batches):
+            batch_indices = permutation[i * l2ws_model.batch_size:(i + 1) * l2ws_model.batch_size]
+            loss, params, state = l2ws_model.train_batch(batch_indices, params, state)
+            step_losses.append(loss)
+
+    epoch_params, _, epoch_key, losses = l2ws_model.train_epochs(l2ws_model.params,
+                                                                 l2ws_model.state, key,
+                                                                 num_epochs)
+    assert losses.shape == (num_epochs * l2ws_model.num_batches,)
+    assert jnp.array_equal(epoch_key, step_key)
+    assert jnp.allclose(losses, jnp.array(step_losses))
+    for epoch_weight, weight in zip(tree_util.tree_leaves(epoch_params),
+                                    tree_util.tree_leaves(params)):
+        assert jnp.allclose(epoch_weight, weight)
+
+
+def test_lr_schedules():
+    """
+    tests that the plateau and cosine schedules change the learning rate inside the jitted
+        training blocks without recompiling them or restarting the optimizer
+    """
+    static_prob_data, varying_prob_data = small_robust_ls_setup()
+    algo_dict = get_scs_algo_dict(static_prob_data, varying_prob_data)
+
+    def train_model(nn_cfg, plateau_decay, num_blocks, num_epochs):
+        l2ws_model = SCSmodel(train_unrolls=5,
+                              train_inputs=varying_prob_data['train_inputs'],
+                              test_inputs=varying_prob_data['test_inputs'],
+                              nn_cfg=dict(batch_size=5, intermediate_layer_sizes=[10], **nn_cfg),
+                              plateau_decay=plateau_decay,
+                              algo_dict=algo_dict)
+        key = random.PRNGKey(0)
+        for _ in range(num_blocks):
+            l2ws_model.params, l2ws_model.state, key, _ = l2ws_model.train_epochs(
+                l2ws_model.params, l2ws_model.state, key, num_epochs)
+        assert l2ws_model.train_epochs_fns[num_epochs]._cache_size() == 1
+
+        # the moments of adam are never reset
+        opt_state = l2ws_model.state[0]
+        assert opt_state.inner_state[0].count == num_blocks * num_epochs * l2ws_model.num_batches
+        return l2ws_model
+
+    # a huge tolerance detects a plateau as soon as the windows allow it
+    plateau_decay = dict(min_lr=1e-6, decay_factor=10, avg_window_size=1, tolerance=1e10,
+                         patience=1)
+    l2ws_model = train_model(dict(lr=1e-3, lr_schedule='plateau'), plateau_decay, 2, 4)
+    assert l2ws_model.get_epoch_decay_points() == [2, 4, 6]
+    assert np.isclose(l2ws_model.get_lr(), 1e-6)
+
+    l2ws_model = train_model(dict(lr=1e-3, min_lr=1e-5, epochs=8, lr_schedule='cosine'), None,
+                             1, 4)
+    assert np.isclose(l2ws_model.get_lr(), 1e-5 + (1e-3 - 1e-5) / 2)
+
+
+def test_compile_warm_up(caplog):
+    """
+    tests that the executables compiled by the warm-up in the background thread are the ones
+        the evaluation and the training later call (nothing is compiled again)
+    """
+    static_prob_data, varying_prob_data = small_robust_ls_setup()
+    algo_dict = get_scs_algo_dict(static_prob_data, varying_prob_data)
+    l2ws_model = SCSmodel(train_unrolls=5,
+                          eval_unrolls=50,
+                          train_inputs=varying_prob_data['train_inputs'],
+                          test_inputs=varying_prob_data['test_inputs'],
+                          nn_cfg=dict(batch_size=5, intermediate_layer_sizes=[10]),
+                          algo_dict=algo_dict)
+    q_mat_test = l2ws_model.get_q_mat(False)
+    eval_args = dict(test=(l2ws_model.test_inputs, q_mat_test, None, False, None))
+    warm_up = WarmUp(l2ws_model.get_compile_jobs(2, 50, eval_args))
+    for name in ['eval_test', 'short_test_eval', 'train_epochs']:
+        compile_time, wait_time = warm_up.wait(name)
+        assert compile_time > 0
+    assert warm_up.wait('train_epochs') is None
+
+    config.update('jax_log_compiles', True)
+    try:
+        l2ws_model.evaluate(50, l2ws_model.test_inputs, q_mat_test, None, False)
+        l2ws_model.short_test_eval()
+        l2ws_model.train_epochs(l2ws_model.params, l2ws_model.state, random.PRNGKey(1), 2)
+    finally:
+        config.update('jax_log_compiles', False)
+    assert not any('Compiling' in record.getMessage() for record in caplog.records)
+
+
+def test_static_factor_batch_major():
+    """
+    tests that the evaluation with a static factor runs batch-major: in the loop body the
+        triangular solves of the lu_solve are each one solve of the unbatched factor with
+        the batch as the right-hand-side columns, and the matvecs with the problem matrices
+        are matrix-matrix products over the batch
+    """
+    N_test = 8
+    static_prob_data, varying_prob_data = small_robust_ls_setup(N_test=N_test)
+    algo_dict = get_scs_algo_dict(static_prob_data, varying_prob_data, bucket_batches=False)
+    l2ws_model = SCSmodel(train_unrolls=5,
+                          train_inputs=varying_prob_data['train_inputs'],
+                          test_inputs=varying_prob_data['test_inputs'],
+                          nn_cfg=dict(intermediate_layer_sizes=[10]),
+                          algo_dict=algo_dict)
+    assert l2ws_model.factor_static_bool
+
+    def eval_loss(params, inputs, q_mat):
+        return l2ws_model.loss_fn_eval(params, inputs, q_mat, 20, None)
+    jaxpr = jax.make_jaxpr(eval_loss)(l2ws_model.params, l2ws_model.test_inputs,
+                                      l2ws_model.get_q_mat(False)).jaxpr
+
+    def loop_eqns(jaxpr, in_loop=False):
+        for eqn in jaxpr.eqns:
+            if in_loop:
+                yield eqn
+            for param in eqn.params.values():
+                for sub in (param if isinstance(param, (tuple, list)) else [param]):
+                    if isinstance(sub, (core.Jaxpr, core.ClosedJaxpr)):
+                        yield from loop_eqns(getattr(sub, 'jaxpr', sub),
+                                             in_loop or eqn.primitive.name == 'scan')
+    eqns = list(loop_eqns(jaxpr))
+    solves = [eqn for eqn in eqns if eqn.primitive.name == 'triangular_solve']
+    dim = static_prob_data['m'] + static_prob_data['n']
+    assert len(solves) == 2
+    for eqn in solves:
+        assert [x.aval.shape for x in eqn.invars] == [(dim, dim), (dim, N_test)]
+    matmuls = [eqn for eqn in eqns if eqn.primitive.name == 'dot_general'
+               and eqn.invars[0].aval.ndim == 2 and eqn.outvars[0].aval.ndim == 2]
+    assert len(matmuls) > 0
+    assert all(N_test in eqn.outvars[0].aval.shape for eqn in matmuls)
+
+
+def test_bucketed_eval():
+    """
+    tests that the evaluation of batches padded to power of two buckets matches the
+        evaluation without padding and that batch sizes in the same bucket reuse the
+        executable
+    """
+    static_prob_data, varying_prob_data = small_robust_ls_setup(N_test=8)
+    models = []
+    for bucket_batches in [True, False]:
+        models.append(SCSmodel(train_unrolls=5,
+                               eval_unrolls=20,
+                               train_inputs=varying_prob_data['train_inputs'],
+                               test_inputs=varying_prob_data['test_inputs'],
+                               nn_cfg=dict(intermediate_layer_sizes=[10]),
+                               algo_dict=get_scs_algo_dict(static_prob_data, varying_prob_data,
+                                                           bucket_batches=bucket_batches)))
+    bucketed_model, model = models
+    model.params = bucketed_model.params
+
+    for num in [3, 4, 7, 5, 8]:
+        inputs = bucketed_model.test_inputs[:num, :]
+        q_mat = tree_util.tree_map(lambda x: x[:num, :], bucketed_model.get_q_mat(False))
+        bucketed_loss, bucketed_out, _ = bucketed_model.evaluate(20, inputs, q_mat, None, False)
+        loss, out, _ = model.evaluate(20, inputs, q_mat, None, False)
+        assert jnp.allclose(bucketed_loss, loss)
+        for bucketed_vals, vals in zip(bucketed_out, out):
+            if vals is not None:
+                assert bucketed_vals.shape == vals.shape
+                assert jnp.allclose(bucketed_vals, vals, equal_nan=True)
+
+    # the buckets of 4 and 8 problems
+    assert bucketed_model.bucket_counts == {'hits': 3, 'misses': 2}
+
+
+def test_train_stream(tmp_path):
+    """
+    tests that training on the chunks streamed from memory-mapped arrays gives the same losses,
+        parameters, and learning rate as the optimizer steps on the same batches on the device
+    """
+    N_train = 10
+    static_prob_data, varying_prob_data = small_robust_ls_setup(N_train)
+    host_data = {}
+    for name in ['q_mat_train', 'train_inputs']:
+        x = np.asarray(varying_prob_data[name])
+        host_data[name] = np.lib.format.open_memmap(str(tmp_path / f"{name}.npy"), mode='w+',
+                                                    dtype=x.dtype, shape=x.shape)
+        host_data[name][:] = x
+
+    def create_model(stream, q_mat_train, train_inputs):
+        algo_dict = get_scs_algo_dict(static_prob_data, varying_prob_data,
+                                      q_mat_train=q_mat_train, stream=stream)
+        nn_cfg = dict(batch_size=5, intermediate_layer_sizes=[10], lr_schedule='cosine',
+                      epochs=4)
+        return SCSmodel(train_unrolls=5, train_inputs=train_inputs,
+                        test_inputs=varying_prob_data['test_inputs'], nn_cfg=nn_cfg,
+                        algo_dict=algo_dict)
+    stream_model = create_model(dict(chunk_batches=1, seed=3), host_data['q_mat_train'],
+                                host_data['train_inputs'])
+    model = create_model(None, varying_prob_data['q_mat_train'],
+                         varying_prob_data['train_inputs'])
+    num_epochs = 2
+
+    # the batches of the stream, one permutation per epoch and sorted rows in each batch
+    rng = np.random.default_rng(3)
+    params, state, step_losses = model.params, model.state, []
+    for epoch in range(num_epochs):
+        permutation = rng.permutation(N_train)
+        for i in range(model.num_batches):
+            batch_indices = np.sort(permutation[i * model.batch_size:(i + 1) * model.batch_size])
+            loss, params, state = model.train_batch(batch_indices, params, state)
+            step_losses.append(loss)
+        state = model.update_lr(state, jnp.array(step_losses[-model.num_batches:]).mean())
+
+    stream_params, stream_state, losses = stream_model.train_stream(
+        stream_model.params, stream_model.state, num_epochs)
+    assert losses.shape == (num_epochs * stream_model.num_batches,)
+    assert jnp.allclose(losses, jnp.array(step_losses))
+    for stream_weight, weight in zip(tree_util.tree_leaves(stream_params),
+                                     tree_util.tree_leaves(params)):
+        assert jnp.allclose(stream_weight, weight)
+    assert stream_state[1]['epoch'] == num_epochs
+    assert jnp.allclose(stream_state[0].hyperparams['learning_rate'],
+                        state[0].hyperparams['learning_rate'])
+    thread = stream_model.batch_stream.thread
+    stream_model.close_stream()
+    assert stream_model.batch_stream is None and not thread.is_alive()
+
+
+def test_batch_stream():
+    """
+    tests that the batch stream keeps at most buffer_size chunks on the device and that an
+        exception in the prefetch thread is raised by next_chunk instead of blocking it
+    """
+    data = (np.arange(40.).reshape(20, 2), np.arange(20.))
+    for buffer_size in [1, 2, 3]:
+        stream = BatchStream(data, 5, 2, buffer_size=buffer_size)
+        chunk, epoch_ends = stream.next_chunk()
+        assert chunk[0].shape == (2, 5, 2) and chunk[1].shape == (2, 5)
+        assert list(epoch_ends) == [False, False]
+
+        # the training chunk takes one of the buffer_size slots, once the others are
+        #   prefetched no slot is left for another chunk
+        deadline = time.time() + 60
+        while stream.chunks.qsize() < buffer_size - 1 and time.time() < deadline:
+            time.sleep(.01)
+        assert stream.chunks.qsize() == buffer_size - 1
+        assert not stream.slots.acquire(blocking=False)
+        assert list(stream.next_chunk()[1]) == [False, True]
+        stream.close()
+        assert not stream.thread.is_alive() and stream.chunks.empty()
+
+    class FailingRows(object):
+        shape = (20,)
+
+        def __getitem__(self, indices):
+            raise IndexError('no rows')
+    stream = BatchStream(FailingRows(), 5, 2)
+    for _ in range(2):
+        try:
+            stream.next_chunk()
+            assert False
+        except IndexError:
+            pass
+    stream.close()